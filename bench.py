@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta, date
+
+# bot.py читает токен при импорте; для замеров сеть не нужна
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("YOUR_USER_ID", "1")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot
+
+# ==========================
+# Синтетические пользователи
+# ==========================
+def make_population(n: int, seed: int = 42):
+    rnd = random.Random(seed)
+    start = datetime(1940, 1, 1)
+    span = (datetime(2015, 12, 31) - start).days
+    users = bot.UserStore()
+    for i in range(n):
+        uid = 100_000_000 + i
+        users.set_known(uid)
+        # ~80% ввели дату рождения
+        if rnd.random() < 0.8:
+            users.set_birth_date(uid, start + timedelta(days=rnd.randrange(span)))
+            users.set_active(uid)
+    return users
+
+def store_bytes(users):
+    # Колонки и таблица поиска по id
+    return sum(sys.getsizeof(c) for c in (users.ids, users.birth, users.monthday, users.flags, users._slots))
+
+# ==========================
+# Замеры
+# ==========================
+def measure(fn, repeat=1, setup=None):
+    # Лучшее время из repeat запусков (секунды). Без tracemalloc: трассировка
+    # замедляет выделение памяти, и код с большим числом объектов — сильнее
+    best = float("inf")
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def measure_peak(fn, setup=None):
+    # Пиковая память (байты) — отдельным запуском под tracemalloc
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_render(samples: int):
+    results = {}
+    bot.get_render_templates()
+    weeks = [random.Random(i).randrange(0, bot.TOTAL_WEEKS) for i in range(samples)]
+
+    started = time.perf_counter()
+    images = [bot.create_weeks_image(w, w // 52) for w in weeks]
+    elapsed = time.perf_counter() - started
+    results["render_images_per_s"] = samples / elapsed
+    results["render_ms"] = elapsed / samples * 1000
+
+    # Каждый формат: время кодирования, средний размер и цена сжатия —
+    # мс процессора на каждый КБ, сэкономленный относительно полноцветного PNG
+    for fmt in ("png", "png8", "webp", "webp_lossy", "jpeg"):
+        started = time.perf_counter()
+        sizes = [len(bot.encode_image(img, fmt)) for img in images]
+        elapsed = time.perf_counter() - started
+        results[f"{fmt}_encode_ms"] = elapsed / samples * 1000
+        results[f"{fmt}_bytes_avg"] = sum(sizes) / len(sizes)
+        if fmt != "png":
+            saved_kb = (results["png_bytes_avg"] - results[f"{fmt}_bytes_avg"]) / 1024
+            extra_ms = results[f"{fmt}_encode_ms"] - results["png_encode_ms"]
+            results[f"{fmt}_ms_per_kb_saved"] = extra_ms / saved_kb if saved_kb > 0 else None
+    return results
+
+def bench_population(n: int, workdir: str):
+    results = {}
+    users = make_population(n)
+    some_user = users.active_ids()[0]
+    results["users_store_bytes"] = store_bytes(users)
+
+    # Статистика: полный обход против индекса возрастов
+    results["median_scan_ms"] = measure(lambda: bot.get_median_age(users), 3) * 1000
+    age_index = bot.AgeIndex()
+    results["age_index_build_ms"] = measure(lambda: age_index.rebuild(users)) * 1000
+    results["median_index_us"] = measure(lambda: bot.get_median_age(users, age_index), 100) * 1e6
+    results["report_text_scan_ms"] = measure(lambda: bot.generate_report_text(some_user, users), 3) * 1000
+    results["report_text_index_us"] = measure(
+        lambda: bot.generate_report_text(some_user, users, age_index), 100
+    ) * 1e6
+    results["lookup_us"] = measure(lambda: users.birth_date(some_user), 1000) * 1e6
+
+    # Рассылки: выборка дня недели и дней рождения проходом по колонкам
+    today = date.today()
+    results["weekday_scan_ms"] = measure(lambda: users.weekday_ids(today.weekday()), 3) * 1000
+    weekday = users.weekday_ids(today.weekday())
+    results["days_lived_ms"] = measure(lambda: users.days_lived(weekday, today), 3) * 1000
+    results["birthday_scan_ms"] = measure(lambda: users.due_on(today), 3) * 1000
+    # План волны дня недели: окно в час и бюджет 30 сообщений/с
+    results["send_plan_ms"] = measure(lambda: bot.SendPlan("weekly", weekday, 2, 3600, 30), 3) * 1000
+
+    # JSON: полная перезапись и загрузка
+    os.chdir(workdir)
+    for path in (bot.USERS_FILE, bot.BIRTHDAYS_FILE, bot.ACTIVE_FILE, bot.DB_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+    save_all = lambda: bot.save_all(users)
+    results["json_save_all_ms"] = measure(save_all) * 1000
+    results["json_save_all_peak_bytes"] = measure_peak(save_all)
+    results["json_load_ms"] = measure(bot.load_data) * 1000
+    results["json_load_peak_bytes"] = measure_peak(bot.load_data)
+
+    # SQLite: импорт, загрузка и запись одного пользователя. Импорт идёт только
+    # в пустую базу, поэтому перед каждым запуском база удаляется
+    def drop_db():
+        for suffix in ("", "-wal", "-shm", ".snapshot"):
+            if os.path.exists(bot.DB_FILE + suffix):
+                os.remove(bot.DB_FILE + suffix)
+
+    import_json = lambda: bot.SqliteStorage(bot.DB_FILE).close()
+    results["sqlite_import_ms"] = measure(import_json, setup=drop_db) * 1000
+    results["sqlite_import_peak_bytes"] = measure_peak(import_json, setup=drop_db)
+    storage = bot.SqliteStorage(bot.DB_FILE)
+    results["sqlite_load_ms"] = measure(storage.load) * 1000
+    results["sqlite_load_peak_bytes"] = measure_peak(storage.load)
+    results["sqlite_save_user_us"] = measure(
+        lambda: storage.save_users([some_user], users), 50
+    ) * 1e6
+    storage.close()
+    return results
+
+# ==========================
+# Сравнение с эталоном
+# ==========================
+def compare(results, baseline, threshold):
+    # Метрики времени (_ms/_us) и памяти (_bytes) — чем меньше, тем лучше,
+    # пропускная способность (_per_s) — чем больше, тем лучше
+    regressions = []
+    for section, values in results.items():
+        for key, value in values.items():
+            old = baseline.get(section, {}).get(key)
+            if not old or value is None or key.endswith("_ms_per_kb_saved"):
+                continue
+            ratio = old / value if key.endswith("_per_s") else value / old
+            if ratio > threshold:
+                regressions.append(f"{section}.{key}: {old:.3f} -> {value:.3f} (x{ratio:.2f})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки рендеринга, статистики и хранения")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="размеры популяций через запятую")
+    parser.add_argument("--render-samples", type=int, default=200)
+    parser.add_argument("--output", help="куда записать результаты (JSON)")
+    parser.add_argument("--baseline", help="JSON предыдущего запуска для сравнения")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="во сколько раз метрика может ухудшиться относительно эталона")
+    args = parser.parse_args()
+
+    results = {"render": bench_render(args.render_samples)}
+    print(f"render: {json.dumps(results['render'])}", flush=True)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        try:
+            for n in (int(s) for s in args.sizes.split(",") if s):
+                results[f"users_{n}"] = bench_population(n, workdir)
+                print(f"users_{n}: {json.dumps(results[f'users_{n}'])}", flush=True)
+        finally:
+            os.chdir(cwd)
+
+    results["meta"] = {"python": sys.version.split()[0], "at": datetime.now().isoformat(timespec="seconds")}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare({k: v for k, v in results.items() if k != "meta"}, baseline, args.threshold)
+        if regressions:
+            print("❌ Регрессии:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("✅ Регрессий нет")
+
+if __name__ == "__main__":
+    main()
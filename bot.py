@@ -1,15 +1,40 @@
 import os
+import sys
 import json
+import struct
 import logging
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
+import asyncio
+import bisect
+import sqlite3
+import contextlib
+import hmac
+import secrets
+import signal
+import functools
+import fcntl
+import importlib.util
+import multiprocessing
+import queue
+import io
+import gzip
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, date, timezone
+from telegram import (
+    Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton,
+    InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+)
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    filters, ContextTypes
+    Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler,
+    TypeHandler, filters, ContextTypes
 )
-from telegram.request import HTTPXRequest
-from PIL import Image, ImageDraw, ImageFont
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+import httpx
+# Pillow и dateutil импортируются там, где нужны: первый ответ после старта их не ждёт
 
 # ==========================
 # Настройки
@@ -23,6 +48,132 @@ USERS_FILE = "users.json"
 BIRTHDAYS_FILE = "birthdays.json"
 ACTIVE_FILE = "active_users.json"
 
+# Хранилище: "sqlite" (по умолчанию) или "json" (старые файлы целиком)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+DB_FILE = os.environ.get("DB_FILE", "users.db")
+
+IMAGE_CACHE_SIZE = int(os.environ.get("IMAGE_CACHE_SIZE", "1024"))
+
+# Формат картинок: "png8" — PNG с палитрой (по умолчанию: вдвое меньше и втрое быстрее
+# полноцветного), "png" — полноцветный PNG, "webp" — WebP без потерь (IMAGE_QUALITY —
+# усилие сжатия), "webp_lossy" — WebP с потерями и качеством IMAGE_QUALITY, "jpeg" —
+# JPEG с качеством IMAGE_QUALITY. Сетка из мелких клеток с потерями сжимается плохо:
+# webp_lossy и jpeg в десятки раз больше png8, при запуске об этом предупреждение.
+# Telegram всё равно пережимает фото у себя, формат влияет на объём загрузки и время кодирования.
+IMAGE_FORMATS = ("png8", "png", "webp", "webp_lossy", "jpeg")
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "png8")
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "80"))
+
+# Рендеринг: "process" — отдельные процессы (все ядра), "thread" — потоки
+RENDER_EXECUTOR = os.environ.get("RENDER_EXECUTOR", "process")
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", str(os.cpu_count() or 1)))
+# Сколько задач может ждать в очереди пула сверх работающих; остальные ждут слота
+RENDER_QUEUE_SIZE = int(os.environ.get("RENDER_QUEUE_SIZE", "32"))
+
+# Сколько еженедельных рассылок отправляется одновременно
+WEEKLY_CONCURRENCY = int(os.environ.get("WEEKLY_CONCURRENCY", "20"))
+# Повторы отправки при сетевых сбоях (пауза 2, 4, 8 ... с)
+WEEKLY_RETRIES = 3
+# Заблокировавшие бота пользователи удаляются пачкой не чаще раза в столько секунд
+REAPER_INTERVAL_SECONDS = int(os.environ.get("REAPER_INTERVAL_SECONDS", "30"))
+# Ежедневные волны (еженедельная рассылка, поздравления) растягиваются на столько
+# минут после WEEKLY_TIME / BIRTHDAY_TIME: у каждого пользователя своё постоянное
+# время внутри окна (0 — все сразу, как раньше)
+SEND_WINDOW_MINUTES = float(os.environ.get("SEND_WINDOW_MINUTES", "60"))
+# Бюджет волны, сообщений в секунду (0 — без ограничения): если пользователям окна
+# его не хватает, волна продлевается
+SEND_RATE = float(os.environ.get("SEND_RATE", "0"))
+# За сколько секунд до слота отправки картинка рендерится и кладётся в кэш
+PRERENDER_AHEAD_SECONDS = float(os.environ.get("PRERENDER_AHEAD_SECONDS", "30"))
+# Как часто волна записывает, докуда дошла: после аварийной остановки
+# повторятся отправки не больше чем за это время
+WAVE_CHECKPOINT_SECONDS = 2
+
+# Рассылка администратора: общий лимит Telegram ~30 сообщений/с
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_CHUNK = int(os.environ.get("BROADCAST_CHUNK", "200"))
+BROADCAST_RETRIES = 3
+BROADCAST_STATE_FILE = "broadcast_state.json"
+BROADCAST_QUEUE_FILE = "broadcast_queue.json"
+# Режим получения обновлений: "polling" или "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+# Сколько обновлений обрабатывается одновременно (1 — по одному, как раньше).
+# Обновления одного пользователя всё равно обрабатываются по порядку
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "32"))
+# Сколько ещё обновлений может быть принято в работу и ждать своей очереди
+UPDATE_PENDING = int(os.environ.get("UPDATE_PENDING", "256"))
+# Число процессов-обработчиков. Больше 1 — пользователи делятся по user_id % BOT_WORKERS,
+# состояние общее (SQLite), а расписание ведёт один из процессов — лидер по lock-файлу
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "1"))
+SCHEDULER_LOCK_FILE = "scheduler.lock"
+SHARD_QUEUE_SIZE = 1000
+# Как часто шард публикует свою гистограмму возрастов и пробует стать лидером
+SHARD_SYNC_SECONDS = 15
+# Публичный адрес для setWebhook; без него сервер просто слушает порт (локальная проверка)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8080"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# Обновления без этого заголовка X-Telegram-Bot-Api-Secret-Token отклоняются.
+# Без WEBHOOK_SECRET он генерируется на каждый запуск и передаётся в setWebhook,
+# поэтому без WEBHOOK_URL (webhook зарегистрирован не ботом) секрет обязателен
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Сколько обновлений может ждать обработки; дальше Telegram получает 503 и повторит позже
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+# Соединения с Bot API: getUpdates и остальные вызовы идут через разные пулы,
+# чтобы долгий опрос не отнимал соединение у отправок. HTTP_POOL_SIZE — соединений
+# для отправок (рассылки, еженедельная волна и ответы пользователям идут одновременно).
+# HTTP_VERSION "2" требует python-telegram-bot[http2]; getUpdates всегда по HTTP/1.1.
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "64"))
+HTTP_KEEPALIVE_SECONDS = float(os.environ.get("HTTP_KEEPALIVE_SECONDS", "30"))
+HTTP_VERSION = os.environ.get("HTTP_VERSION", "1.1")
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "10"))
+# Запись: текст уходит мгновенно, загрузка картинки или выгрузки — дольше
+HTTP_WRITE_TIMEOUT = float(os.environ.get("HTTP_WRITE_TIMEOUT", "5"))
+HTTP_MEDIA_WRITE_TIMEOUT = float(os.environ.get("HTTP_MEDIA_WRITE_TIMEOUT", "60"))
+# Сколько запрос ждёт свободного соединения из пула
+HTTP_POOL_TIMEOUT = float(os.environ.get("HTTP_POOL_TIMEOUT", "10"))
+
+# Метрики в формате Prometheus: GET /metrics и GET /health на METRICS_HOST:METRICS_PORT
+# (0 — не поднимать). Публичный порт webhook отдаёт только WEBHOOK_PATH и краткий /health
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+# Время задач очереди (часовой пояс JobQueue — UTC)
+WEEKLY_TIME = datetime.strptime("09:00", "%H:%M").time()
+BIRTHDAY_TIME = datetime.strptime("08:00", "%H:%M").time()
+
+# Вложения рассылаются по file_id, без скачивания и повторной загрузки
+BROADCAST_MEDIA = ("photo", "video", "animation", "document", "audio", "voice")
+ALBUM_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+# Сколько ждать остальные части альбома после первой
+ALBUM_WAIT_SECONDS = 1.5
+
+# Снимок пользователей для быстрого старта: пишется при остановке и раз в столько секунд
+# (0 — только при остановке). Рядом с базой: users.db.snapshot
+SNAPSHOT_INTERVAL_SECONDS = int(os.environ.get("SNAPSHOT_INTERVAL_SECONDS", "300"))
+
+# Профилирование по /profile: как часто снимаются стеки, сколько функций в отчёте
+# и самая долгая запись (для /profile 500u — предел ожидания обновлений)
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", "30"))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "600"))
+
+# Выгрузка пользователей: бот может отправить документ до 50 МБ, берём с запасом.
+# Не меньше EXPORT_MIN_PART_BYTES: сжатая часть закрывается с запасом в 1 МБ
+EXPORT_PART_BYTES = int(os.environ.get("EXPORT_PART_BYTES", str(45 * 1024 * 1024)))
+EXPORT_MIN_PART_BYTES = 4 * 1024 * 1024
+EXPORT_FORMATS = ("csv", "jsonl")
+
 # ==========================
 # Пользовательское меню (без кнопки отписки)
 # ==========================
@@ -31,19 +182,439 @@ USER_KEYBOARD = [
     ["🕒 Мои единицы времени", "📊 Моя статистика"]
 ]
 
+# ==========================
+# Метрики
+# ==========================
+class Metrics:
+    # Счётчики и гистограммы в обычных dict: инкремент — одна операция со словарём.
+    # labels — кортеж пар (имя, значение), его лучше создавать заранее.
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    BYTES_BUCKETS = (5000, 10000, 20000, 40000, 80000, 160000, 320000)
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = []
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        hist = self.histograms.get((name, labels))
+        if hist is None:
+            hist = self.histograms[(name, labels)] = [buckets, [0] * (len(buckets) + 1), 0.0, 0]
+        hist[1][bisect.bisect_left(hist[0], value)] += 1
+        hist[2] += value
+        hist[3] += 1
+
+    def gauge(self, fn):
+        # fn() -> [(name, labels, value)], вызывается только при выдаче /metrics
+        self.gauges.append(fn)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, counts, total, count) in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for fn in self.gauges:
+            for name, labels, value in fn():
+                if name not in typed:
+                    lines.append(f"# TYPE {name} gauge")
+                    typed.add(name)
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def instrumented(handler_name):
+    # Время и ошибки обработчика: bot_handler_seconds / bot_handler_errors_total
+    labels = (("handler", handler_name),)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await fn(update, context)
+            except Exception:
+                metrics.inc("bot_handler_errors_total", labels)
+                raise
+            finally:
+                metrics.observe("bot_handler_seconds", time.perf_counter() - started, labels)
+        return wrapper
+    return decorator
+
+def observe_job_lag(job_name, scheduled):
+    # Насколько позже запланированного времени задача реально стартовала
+    now = datetime.now(timezone.utc)
+    planned = datetime.combine(now.date(), scheduled, tzinfo=timezone.utc)
+    metrics.observe("bot_job_lag_seconds", max(0.0, (now - planned).total_seconds()), (("job", job_name),))
+
+class InstrumentedRequest(HTTPXRequest):
+    # Время каждого вызова Bot API и классы ошибок (RetryAfter, Forbidden, TimedOut, ...).
+    # Загруженность пула pool: bot_http_pool_in_use из bot_http_pool_size, запросы,
+    # которым не досталось свободного соединения сразу (bot_http_pool_saturated_total)
+    # и не досталось за pool_timeout (bot_http_pool_timeouts_total)
+    def __init__(self, pool="api", connection_pool_size=1, keepalive_expiry=5.0, media_write_timeout=20.0, **kwargs):
+        self.pool_labels = (("pool", pool),)
+        self.pool_size = connection_pool_size
+        self.keepalive_expiry = keepalive_expiry
+        self.media_write_timeout = media_write_timeout
+        self.in_use = 0
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+
+    def _build_client(self):
+        # HTTPXRequest не даёт задать время жизни простаивающего соединения
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        return super()._build_client()
+
+    async def do_request(
+        self,
+        url,
+        method,
+        request_data=None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ):
+        if write_timeout is BaseRequest.DEFAULT_NONE and request_data is not None and request_data.multipart_data:
+            write_timeout = self.media_write_timeout
+        if self.in_use >= self.pool_size:
+            metrics.inc("bot_http_pool_saturated_total", self.pool_labels)
+        self.in_use += 1
+        try:
+            return await super().do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+            )
+        except TimedOut as e:
+            if isinstance(e.__cause__, httpx.PoolTimeout):
+                metrics.inc("bot_http_pool_timeouts_total", self.pool_labels)
+            raise
+        finally:
+            self.in_use -= 1
+
+    async def post(self, url, *args, **kwargs):
+        labels = (("method", url.rsplit("/", 1)[-1]),)
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_telegram_errors_total", labels + (("error", type(e).__name__),))
+            raise
+        finally:
+            metrics.observe("bot_telegram_request_seconds", time.perf_counter() - started, labels)
+
+# ==========================
+# Пользователи
+# ==========================
+def age_limit(day, years: int) -> int:
+    # Порядковый номер последней даты рождения, при которой на day исполнилось years лет
+    # (29 февраля в невисокосный год — это 28-е, как в age_on)
+    try:
+        return date(day.year - years, day.month, day.day).toordinal()
+    except ValueError:
+        return date(day.year - years, 3, 1).toordinal() - 1
+
+def is_leap(year: int) -> bool:
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+class UserStore:
+    # Все пользователи в колонках, по строке на пользователя:
+    #   ids      — user_id, int64
+    #   birth    — дата рождения как date.toordinal(), int32 (0 — не введена)
+    #   monthday — месяц * 32 + день рождения, uint16 (поиск дней рождения без разбора дат)
+    #   flags    — KNOWN | ACTIVE
+    # Это ~20 байт на пользователя вместо 200+ у set/dict с datetime, и ни одного
+    # объекта на запись. Строка по user_id ищется хеш-таблицей с открытой адресацией
+    # в array("i") (номер строки + 1, 0 — пусто). Строки не удаляются: после /stop
+    # остаётся пустая строка, и вернувшийся пользователь занимает её снова.
+    KNOWN = 1
+    ACTIVE = 2
+    HASH_MUL = 0x9E3779B97F4A7C15
+    HASH_MASK = (1 << 64) - 1
+
+    def __init__(self):
+        self.ids = array("q")
+        self.birth = array("i")
+        self.monthday = array("H")
+        self.flags = bytearray()
+        self.known_count = 0
+        self.active_count = 0
+        self._resize(1024)
+
+    def _set_slots(self, slots):
+        # Размер таблицы — степень двойки; заполнена она не больше чем наполовину
+        size = len(slots)
+        self._slots = slots
+        self._mask = size - 1
+        self._shift = 64 - (size.bit_length() - 1)
+
+    def _resize(self, size: int):
+        self._set_slots(array("i", bytes(4 * size)))
+        slots, mask, shift, mul, m64 = self._slots, self._mask, self._shift, self.HASH_MUL, self.HASH_MASK
+        for row, user_id in enumerate(self.ids):
+            i = ((user_id * mul) & m64) >> shift
+            while slots[i]:
+                i = (i + 1) & mask
+            slots[i] = row + 1
+
+    def _find(self, user_id: int):
+        # (строка или -1, ячейка таблицы, куда её можно вписать)
+        slots, mask, ids = self._slots, self._mask, self.ids
+        i = ((user_id * self.HASH_MUL) & self.HASH_MASK) >> self._shift
+        while True:
+            row = slots[i] - 1
+            if row < 0 or ids[row] == user_id:
+                return row, i
+            i = (i + 1) & mask
+
+    def _row(self, user_id: int) -> int:
+        row, i = self._find(user_id)
+        if row >= 0:
+            return row
+        row = len(self.ids)
+        self.ids.append(user_id)
+        self.birth.append(0)
+        self.monthday.append(0)
+        self.flags.append(0)
+        self._slots[i] = row + 1
+        if len(self.ids) * 2 > len(self._slots):
+            self._resize(len(self._slots) * 2)
+        return row
+
+    def _set_flag(self, row: int, flag: int, on: bool):
+        old = self.flags[row]
+        new = old | flag if on else old & ~flag
+        if new == old:
+            return
+        self.flags[row] = new
+        delta = 1 if on else -1
+        if flag == self.KNOWN:
+            self.known_count += delta
+        else:
+            self.active_count += delta
+
+    # Один пользователь
+    def is_known(self, user_id: int) -> bool:
+        row = self._find(user_id)[0]
+        return row >= 0 and bool(self.flags[row] & self.KNOWN)
+
+    def is_active(self, user_id: int) -> bool:
+        row = self._find(user_id)[0]
+        return row >= 0 and bool(self.flags[row] & self.ACTIVE)
+
+    def birth_date(self, user_id: int):
+        row = self._find(user_id)[0]
+        if row < 0 or not self.birth[row]:
+            return None
+        return datetime.fromordinal(self.birth[row])
+
+    def record(self, user_id: int):
+        # (known, active, birth_date) — то, что пишет хранилище
+        row = self._find(user_id)[0]
+        if row < 0:
+            return False, False, None
+        flags = self.flags[row]
+        birth = self.birth[row]
+        return bool(flags & self.KNOWN), bool(flags & self.ACTIVE), datetime.fromordinal(birth) if birth else None
+
+    def set_known(self, user_id: int, known: bool = True):
+        self._set_flag(self._row(user_id), self.KNOWN, known)
+
+    def set_active(self, user_id: int, active: bool = True):
+        self._set_flag(self._row(user_id), self.ACTIVE, active)
+
+    def set_birth_date(self, user_id: int, birth_date):
+        row = self._row(user_id)
+        self.birth[row] = birth_date.toordinal() if birth_date else 0
+        self.monthday[row] = birth_date.month * 32 + birth_date.day if birth_date else 0
+
+    def put(self, user_id: int, known: bool, active: bool, birth: int, monthday: int):
+        # Строка из хранилища: дата уже порядковым номером и месяцем-днём
+        row = self._row(user_id)
+        self._set_flag(row, self.KNOWN, known)
+        self._set_flag(row, self.ACTIVE, active)
+        self.birth[row] = birth
+        self.monthday[row] = monthday
+
+    def extend(self, rows):
+        # Загрузка: (user_id, known, active, birth, monthday) с user_id, которых ещё нет.
+        # Строки дописываются в колонки, таблица поиска строится один раз в конце.
+        ids, birth, monthday, flags = self.ids, self.birth, self.monthday, self.flags
+        known_flag, active_flag = self.KNOWN, self.ACTIVE
+        for user_id, known, active, b, md in rows:
+            ids.append(user_id)
+            birth.append(b)
+            monthday.append(md)
+            flags.append((known_flag if known else 0) | (active_flag if active else 0))
+        self.known_count = sum(1 for f in flags if f & known_flag)
+        self.active_count = sum(1 for f in flags if f & active_flag)
+        size = len(self._slots)
+        while size < len(ids) * 2:
+            size *= 2
+        self._resize(size)
+
+    def remove(self, user_id: int):
+        row = self._find(user_id)[0]
+        if row >= 0:
+            self._set_flag(row, self.KNOWN, False)
+            self._set_flag(row, self.ACTIVE, False)
+            self.birth[row] = 0
+            self.monthday[row] = 0
+
+    # Снимок: заголовок, колонки и таблица поиска байтами как есть — загрузка
+    # не разбирает ни строк, ни дат и не пересчитывает хеши.
+    # seq — номер последнего изменения в хранилище, которое в снимке уже учтено.
+    SNAPSHOT_MAGIC = b"LBUS"
+    SNAPSHOT_VERSION = 1
+    # magic, версия, big-endian, seq, строк, ячеек таблицы, known, active
+    SNAPSHOT_HEADER = struct.Struct("<4sBBxxqqqqq")
+
+    def snapshot_parts(self, seq: int):
+        # Копии колонок: файл можно дописывать в другом потоке, пока store меняется
+        header = self.SNAPSHOT_HEADER.pack(
+            self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, sys.byteorder == "big",
+            seq, len(self.ids), len(self._slots), self.known_count, self.active_count
+        )
+        return [header, self.ids.tobytes(), self.birth.tobytes(), self.monthday.tobytes(),
+                bytes(self.flags), self._slots.tobytes()]
+
+    @classmethod
+    def from_snapshot(cls, data: bytes):
+        # -> (UserStore, seq); ValueError, если файл чужой, другой версии или обрезан
+        head = cls.SNAPSHOT_HEADER
+        if len(data) < head.size:
+            raise ValueError("снимок обрезан")
+        magic, version, big, seq, rows, slots, known, active = head.unpack_from(data)
+        if magic != cls.SNAPSHOT_MAGIC or version != cls.SNAPSHOT_VERSION or big != (sys.byteorder == "big"):
+            raise ValueError("неизвестный формат снимка")
+        if head.size + 15 * rows + 4 * slots != len(data) or slots < 2 * rows or slots & (slots - 1):
+            raise ValueError("снимок повреждён")
+
+        users = cls.__new__(cls)
+        view = memoryview(data)
+        offset = head.size
+        columns = []
+        for typecode, count in (("q", rows), ("i", rows), ("H", rows), ("B", rows), ("i", slots)):
+            column = array(typecode)
+            size = column.itemsize * count
+            column.frombytes(view[offset:offset + size])
+            offset += size
+            columns.append(column)
+        users.ids, users.birth, users.monthday, flags, table = columns
+        users.flags = bytearray(flags)
+        users.known_count = known
+        users.active_count = active
+        users._set_slots(table)
+        return users, seq
+
+    # Все пользователи сразу
+    def user_ids(self):
+        return [uid for uid, f, b in zip(self.ids, self.flags, self.birth) if f or b]
+
+    def known_ids(self):
+        known = self.KNOWN
+        return [uid for uid, f in zip(self.ids, self.flags) if f & known]
+
+    def active_ids(self):
+        active = self.ACTIVE
+        return [uid for uid, f in zip(self.ids, self.flags) if f & active]
+
+    def birthdays(self):
+        # (user_id, порядковый номер даты) всех, у кого дата сохранена
+        return [(uid, b) for uid, b in zip(self.ids, self.birth) if b]
+
+    def weekday_ids(self, weekday: int):
+        # Активные, родившиеся в этот день недели: date.weekday() == (toordinal() + 6) % 7
+        active = self.ACTIVE
+        return [
+            uid for uid, f, b in zip(self.ids, self.flags, self.birth)
+            if f & active and b and (b + 6) % 7 == weekday
+        ]
+
+    def born_on_ids(self, month: int, day: int):
+        active = self.ACTIVE
+        key = month * 32 + day
+        return [uid for uid, f, md in zip(self.ids, self.flags, self.monthday) if md == key and f & active]
+
+    def due_on(self, day):
+        # Родившихся 29 февраля в невисокосный год поздравляем 28-го
+        user_ids = self.born_on_ids(day.month, day.day)
+        if day.month == 2 and day.day == 28 and not is_leap(day.year):
+            user_ids.extend(self.born_on_ids(2, 29))
+        return user_ids
+
+    def aging_on(self, day):
+        # У кого age_on() вырос по сравнению со вчерашним днём:
+        # 29 февраля по age_on() в невисокосный год «наступает» 1 марта
+        user_ids = self.born_on_ids(day.month, day.day)
+        if day.month == 3 and day.day == 1 and not is_leap(day.year):
+            user_ids.extend(self.born_on_ids(2, 29))
+        return user_ids
+
+    def days_lived(self, user_ids, day):
+        # Прожитые дни на day для каждого из user_ids (None — даты нет)
+        today = day.toordinal()
+        birth = self.birth
+        result = []
+        for uid in user_ids:
+            row = self._find(uid)[0]
+            b = birth[row] if row >= 0 else 0
+            result.append(today - b if b else None)
+        return result
+
+    def age_counts(self, day, max_age: int):
+        # Гистограмма возрастов активных на day (старше max_age — в последней корзине).
+        # Возраст не меньше k, пока дата рождения не позже age_limit(day, k), так что
+        # возраст — число таких порогов: один bisect по порядковому номеру на пользователя.
+        limits = [age_limit(day, k) for k in range(max_age, 0, -1)]
+        counts = [0] * (max_age + 1)
+        active = self.ACTIVE
+        find = bisect.bisect_left
+        for f, b in zip(self.flags, self.birth):
+            if f & active and b:
+                counts[max_age - find(limits, b)] += 1
+        return counts
+
 # ==========================
 # Загрузка и сохранение
 # ==========================
 def load_data():
-    known_users = set()
-    user_birthdays = {}
-    active_users = set()
+    users = UserStore()
 
-    for file, var in [(USERS_FILE, known_users), (ACTIVE_FILE, active_users)]:
+    for file, mark in [(USERS_FILE, users.set_known), (ACTIVE_FILE, users.set_active)]:
         if os.path.exists(file):
             try:
                 with open(file, "r", encoding="utf-8") as f:
-                    var.update(set(json.load(f)))
+                    for uid in json.load(f):
+                        mark(uid)
             except:
                 pass
 
@@ -51,94 +622,685 @@ def load_data():
         try:
             with open(BIRTHDAYS_FILE, "r", encoding="utf-8") as f:
                 raw = json.load(f)
-                user_birthdays.update({int(k): datetime.fromisoformat(v) for k, v in raw.items()})
+                for k, v in raw.items():
+                    users.set_birth_date(int(k), datetime.fromisoformat(v))
         except:
             pass
 
-    return known_users, user_birthdays, active_users
+    return users
+
+def _dump_json(path, data):
+    # Пишем во временный файл и подменяем: падение посреди записи не обрежет данные
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
 
-def save_all(known_users, user_birthdays, active_users):
+def save_all(users):
     try:
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(list(known_users), f)
-        with open(BIRTHDAYS_FILE, "w", encoding="utf-8") as f:
-            json.dump({str(k): v.isoformat() for k, v in user_birthdays.items()}, f)
-        with open(ACTIVE_FILE, "w", encoding="utf-8") as f:
-            json.dump(list(active_users), f)
+        _dump_json(USERS_FILE, users.known_ids())
+        _dump_json(BIRTHDAYS_FILE, {str(k): datetime.fromordinal(b).isoformat() for k, b in users.birthdays()})
+        _dump_json(ACTIVE_FILE, users.active_ids())
     except Exception as e:
         logging.error(f"Ошибка сохранения: {e}")
 
-# ==========================
-# Визуализация
-# ==========================
-def create_weeks_image(lived_weeks: int, birth_date: datetime):
-    CELL_SIZE = 12
-    GRID_WIDTH = 52
-    LIFESPAN_YEARS = 90
-    GRID_HEIGHT = LIFESPAN_YEARS
-    MARGIN = 20
-    TOP_PAD = 60
-    BOTTOM_PAD = 60
+class JsonStorage:
+    # Старый формат: любое изменение переписывает все три файла
+    def load(self):
+        return load_data()
 
-    W = GRID_WIDTH * CELL_SIZE + 2 * MARGIN
-    H = GRID_HEIGHT * CELL_SIZE + TOP_PAD + BOTTOM_PAD
+    def iter_users(self):
+        users = load_data()
+        for uid in sorted(users.user_ids()):
+            known, active, bd = users.record(uid)
+            yield uid, int(known), int(active), bd.isoformat() if bd else None
 
-    img = Image.new("RGB", (W, H), (255, 255, 255))
-    draw = ImageDraw.Draw(img)
+    def save_users(self, user_ids, users):
+        save_all(users)
+
+    # Снимков и отметок задач у JSON-хранилища нет: оно и так читает файлы целиком
+    def change_seq(self):
+        return None
+
+    def get_meta(self, key):
+        return None
+
+    def set_meta(self, key, value):
+        pass
+
+    def close(self):
+        pass
+
+class SqliteStorage:
+    # Одна строка на пользователя; запись — upsert/delete только изменившихся строк
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "user_id INTEGER PRIMARY KEY, "
+            "known INTEGER NOT NULL DEFAULT 0, "
+            "active INTEGER NOT NULL DEFAULT 0, "
+            "birth_date TEXT)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # Журнал изменений: при старте из снимка перечитываются только эти пользователи
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL)"
+        )
+        self._import_json()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self.conn.execute("BEGIN")
+        try:
+            yield
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
 
-    font_large = font_small = None
+    def _import_json(self):
+        # Однократный перенос из users.json / birthdays.json / active_users.json
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+            return
+        users = load_data()
+        user_ids = users.user_ids()
+        with self._transaction():
+            self._write(user_ids, users)
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('json_imported', ?)",
+                (datetime.now().isoformat(),)
+            )
+        if user_ids:
+            logging.info(f"Импортировано из JSON: {len(user_ids)} пользователей")
+
+    # Дата сразу колонками UserStore: порядковый номер (юлианский день 0001-01-01 —
+    # 1721425.5) и месяц * 32 + день, без datetime на каждую строку
+    SELECT_USERS = (
+        "SELECT user_id, known, active, "
+        "COALESCE(CAST(julianday(birth_date) - 1721424.5 AS INTEGER), 0), "
+        "COALESCE(CAST(strftime('%m', birth_date) AS INTEGER) * 32"
+        " + CAST(strftime('%d', birth_date) AS INTEGER), 0) FROM users"
+    )
+
+    def load(self, shard=None):
+        # shard — (номер, всего): только пользователи с user_id % всего == номер
+        users = self._load_snapshot(shard)
+        if users is not None:
+            return users
+        users = UserStore()
+        query = self.SELECT_USERS
+        params = ()
+        if shard:
+            query += " WHERE user_id % ? = ?"
+            params = (shard[1], shard[0])
+        # Курсор отдаёт строки по одной, весь результат в память не читается
+        users.extend(self.conn.execute(query, params))
+        return users
+
+    def snapshot_path(self, shard=None):
+        if shard:
+            return f"{self.path}.{shard[0]}of{shard[1]}.snapshot"
+        return f"{self.path}.snapshot"
+
+    @staticmethod
+    def _snapshot_key(shard):
+        # Действующий снимок записан в meta: snapshot:<шардов>:<номер> -> seq
+        index, count = shard or (0, 1)
+        return f"snapshot:{count}:{index}"
+
+    def change_seq(self):
+        row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def _load_snapshot(self, shard):
+        # Снимок плюс пользователи, изменённые после него; None — читать всю базу
+        try:
+            with open(self.snapshot_path(shard), "rb") as f:
+                users, seq = UserStore.from_snapshot(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Снимок пользователей не прочитан: {e}")
+            return None
+        if seq > self.change_seq():
+            # База старше снимка (восстановлена из копии или создана заново)
+            logging.warning("Снимок пользователей новее базы, читаю базу целиком")
+            return None
+        if self.get_meta(self._snapshot_key(shard)) != str(seq):
+            # Снимок другой раскладки по шардам (BOT_WORKERS менялся) или не дописанный:
+            # нужные ему изменения могли быть уже удалены
+            logging.warning("Снимок пользователей недействителен, читаю базу целиком")
+            return None
+
+        where = " WHERE seq > ?"
+        params = (seq,)
+        if shard:
+            where += " AND user_id % ? = ?"
+            params += (shard[1], shard[0])
+        changed = {uid for (uid,) in self.conn.execute("SELECT DISTINCT user_id FROM changes" + where, params)}
+        query = self.SELECT_USERS + " WHERE user_id IN (SELECT user_id FROM changes" + where + ")"
+        for row in self.conn.execute(query, params):
+            users.put(*row)
+            changed.discard(row[0])
+        # Оставшихся уже нет в базе
+        for uid in changed:
+            users.remove(uid)
+        return users
+
+    def write_snapshot(self, parts, shard=None):
+        # Можно вызывать из другого потока: соединение с базой не используется
+        path = self.snapshot_path(shard)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            for part in parts:
+                f.write(part)
+        os.replace(tmp, path)
+
+    def commit_snapshot(self, seq: int, shard=None):
+        # Снимок на диске становится действующим, а записанное в него больше не нужно
+        # перечитывать. Журнал общий для всех раскладок по шардам, поэтому снимки
+        # другой раскладки перестают быть действующими: их изменения сейчас удаляются.
+        count = shard[1] if shard else 1
+        query = "DELETE FROM changes WHERE seq <= ?"
+        params = (seq,)
+        if shard:
+            query += " AND user_id % ? = ?"
+            params += (shard[1], shard[0])
+        with self._transaction():
+            self.conn.execute(
+                "DELETE FROM meta WHERE key LIKE 'snapshot:%' AND key NOT LIKE ?", (f"snapshot:{count}:%",)
+            )
+            self.set_meta(self._snapshot_key(shard), str(seq))
+            self.conn.execute(query, params)
+
+    def _write(self, user_ids, users):
+        upserts = []
+        deletes = []
+        for uid in user_ids:
+            known, active, birth_date = users.record(uid)
+            if known or active or birth_date:
+                upserts.append((uid, int(known), int(active), birth_date.isoformat() if birth_date else None))
+            else:
+                deletes.append((uid,))
+        if upserts:
+            self.conn.executemany(
+                "INSERT INTO users (user_id, known, active, birth_date) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                "known = excluded.known, active = excluded.active, birth_date = excluded.birth_date",
+                upserts
+            )
+        if deletes:
+            self.conn.executemany("DELETE FROM users WHERE user_id = ?", deletes)
+        self.conn.executemany("INSERT INTO changes (user_id) VALUES (?)", ((uid,) for uid in user_ids))
+
+    def save_users(self, user_ids, users):
+        try:
+            with self._transaction():
+                self._write(user_ids, users)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения: {e}")
+
+    def iter_users(self):
+        # Своё соединение: читает снимок базы на момент начала и не занимает основное.
+        # Генератор может продолжаться в другом потоке, отсюда check_same_thread=False.
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            yield from conn.execute("SELECT user_id, known, active, birth_date FROM users ORDER BY user_id")
+        finally:
+            conn.close()
+
+    def count_users(self):
+        known, active = self.conn.execute(
+            "SELECT COALESCE(SUM(known), 0), COALESCE(SUM(active), 0) FROM users"
+        ).fetchone()
+        return known, active
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+
+    def publish_ages(self, shard: int, counts):
+        self.set_meta(f"ages:{shard}", json.dumps(counts))
+
+    def shard_ages(self, shards: int, exclude: int):
+        # Сумма гистограмм возрастов, опубликованных остальными шардами
+        keys = [f"ages:{i}" for i in range(shards) if i != exclude]
+        total = None
+        for (value,) in self.conn.execute(
+            "SELECT value FROM meta WHERE key IN (%s)" % ",".join("?" * len(keys)), keys
+        ):
+            counts = json.loads(value)
+            total = counts if total is None else [a + b for a, b in zip(total, counts)]
+        return total
+
+    def close(self):
+        self.conn.close()
+
+def open_storage():
+    if STORAGE_BACKEND == "json":
+        return JsonStorage()
+    return SqliteStorage(DB_FILE)
+
+def persist_bot_data(data, user_ids):
+    # Сохраняет текущее состояние указанных пользователей из bot_data
+    started = time.perf_counter()
+    data["storage"].save_users(user_ids, data["users"])
+    metrics.observe("bot_storage_write_seconds", time.perf_counter() - started)
+
+def persist_users(context: ContextTypes.DEFAULT_TYPE, user_ids):
+    persist_bot_data(context.application.bot_data, user_ids)
+
+async def save_snapshot(application: Application):
+    # Колонки копируются здесь, между изменениями; файл пишется в потоке, а журнал
+    # изменений чистится, только когда снимок уже на диске
+    data = application.bot_data
+    storage = data["storage"]
+    seq = storage.change_seq()
+    if seq is None:
+        return
+    shard = data["shards"].key if "shards" in data else None
+    started = time.perf_counter()
     try:
-        font_large = ImageFont.truetype("arial.ttf", 20)
-        font_small = ImageFont.truetype("arial.ttf", 12)
+        parts = data["users"].snapshot_parts(seq)
+        await asyncio.get_running_loop().run_in_executor(None, storage.write_snapshot, parts, shard)
+        storage.commit_snapshot(seq, shard)
+    except Exception as e:
+        logging.error(f"Снимок пользователей не записан: {e}")
+        return
+    metrics.observe("bot_snapshot_seconds", time.perf_counter() - started)
+
+async def snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    await save_snapshot(context.application)
+
+# ==========================
+# Изменение пользователей
+# ==========================
+# Обновления разных пользователей обрабатываются параллельно, поэтому каждое
+# изменение — одна синхронная функция: без await внутри её не прервёт другой
+# обработчик, и UserStore, индекс возрастов и хранилище остаются согласованными.
+def set_user_birth_date(data, user_id: int, birth_date: datetime):
+    users = data["users"]
+    age_index = data["age_index"]
+    age_index.discard_user(user_id, users)
+    users.set_known(user_id)
+    users.set_birth_date(user_id, birth_date)
+    users.set_active(user_id)
+    age_index.add_user(user_id, users)
+    persist_bot_data(data, [user_id])
+
+def unsubscribe_user(data, user_id: int) -> bool:
+    # /stop: пользователь забывается целиком, вместе с датой рождения
+    users = data["users"]
+    if not users.is_known(user_id):
+        return False
+    data["age_index"].discard_user(user_id, users)
+    users.remove(user_id)
+    persist_bot_data(data, [user_id])
+    return True
+
+def remove_users(data, user_ids):
+    # Недоступные пользователи: забываются целиком, как после /stop, одной записью.
+    # Еженедельная рассылка и поздравления выбирают пользователей по флагам,
+    # так что отдельных задач, которые нужно снимать, у пользователя нет.
+    users = data["users"]
+    age_index = data["age_index"]
+    for uid in user_ids:
+        age_index.discard_user(uid, users)
+        users.remove(uid)
+    persist_bot_data(data, user_ids)
+
+# ==========================
+# Визуализация
+# ==========================
+CELL_SIZE = 12
+GRID_WIDTH = 52
+LIFESPAN_YEARS = 90
+GRID_HEIGHT = LIFESPAN_YEARS
+MARGIN = 20
+TOP_PAD = 60
+BOTTOM_PAD = 60
+IMAGE_W = GRID_WIDTH * CELL_SIZE + 2 * MARGIN
+IMAGE_H = GRID_HEIGHT * CELL_SIZE + TOP_PAD + BOTTOM_PAD
+TOTAL_WEEKS = GRID_WIDTH * GRID_HEIGHT
+
+LIVED_COLOR = (76, 175, 80)  # Зелёный
+REMAINING_COLOR = (230, 230, 230)
+TEXT_COLOR = (30, 30, 30)
+MUTED_COLOR = (100, 100, 100)
+TITLE_PREFIX = "Ты прожил(а) "
+# Градаций сглаживания для чисел заголовка: они занимают конец палитры шаблонов
+TITLE_LEVELS = 32
+TITLE_HEIGHT = 40
+TITLE_MASK_LUT = [0] + [255] * 255
+
+def load_fonts():
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype("arial.ttf", 20), ImageFont.truetype("arial.ttf", 12)
     except:
         try:
-            font_large = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 20)
-            font_small = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 12)
+            return (
+                ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 20),
+                ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 12),
+            )
         except:
-            pass
+            # Тот же шрифт, который Pillow подставляет при font=None, но загруженный один раз
+            default = ImageFont.load_default()
+            return default, default
+
+def _draw_template(cell_color, font_large, font_small):
+    # Всё, кроме чисел в заголовке: легенда, сетка одного цвета, разметка по 5 лет, подпись
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", (IMAGE_W, IMAGE_H), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
 
-    age_years = (datetime.today() - birth_date).days // 365
-    title = f"Ты прожил(а) {lived_weeks} недель ({age_years} лет)"
-    draw.text((MARGIN, 10), title, fill=(30, 30, 30), font=font_large)
+    draw.text((MARGIN, 10), TITLE_PREFIX, fill=TEXT_COLOR, font=font_large)
 
-    draw.rectangle([MARGIN, 40, MARGIN + 15, 55], fill=(76, 175, 80))  # Зелёный
-    draw.text((MARGIN + 20, 40), "Прожито", fill=(30, 30, 30), font=font_small)
+    draw.rectangle([MARGIN, 40, MARGIN + 15, 55], fill=LIVED_COLOR)
+    draw.text((MARGIN + 20, 40), "Прожито", fill=TEXT_COLOR, font=font_small)
 
     draw.rectangle([MARGIN + 100, 40, MARGIN + 115, 55], fill=(220, 220, 220))
-    draw.text((MARGIN + 120, 40), "Осталось", fill=(30, 30, 30), font=font_small)
+    draw.text((MARGIN + 120, 40), "Осталось", fill=TEXT_COLOR, font=font_small)
 
-    total = GRID_WIDTH * GRID_HEIGHT
-    lived = min(lived_weeks, total)
-    for i in range(total):
+    for i in range(TOTAL_WEEKS):
         row = i // GRID_WIDTH
         col = i % GRID_WIDTH
         x0 = MARGIN + col * CELL_SIZE
         y0 = TOP_PAD + row * CELL_SIZE
         x1 = x0 + CELL_SIZE - 2
         y1 = y0 + CELL_SIZE - 2
-        color = (76, 175, 80) if i < lived else (230, 230, 230)
-        draw.rectangle([x0, y0, x1, y1], fill=color, outline=(245, 245, 245))
+        draw.rectangle([x0, y0, x1, y1], fill=cell_color, outline=(245, 245, 245))
 
     for year in range(5, LIFESPAN_YEARS + 1, 5):
         x_center = MARGIN + (GRID_WIDTH * CELL_SIZE) // 2
         y_text = TOP_PAD + (year * CELL_SIZE) + 2
-        draw.text((x_center - 8, y_text), str(year), fill=(100, 100, 100), font=font_small)
+        draw.text((x_center - 8, y_text), str(year), fill=MUTED_COLOR, font=font_small)
         y_line = TOP_PAD + (year * CELL_SIZE)
         draw.line([MARGIN, y_line, MARGIN + GRID_WIDTH * CELL_SIZE, y_line], fill=(200, 200, 200), width=1)
 
     draw.text(
-        (MARGIN, H - 30),
+        (MARGIN, IMAGE_H - 30),
         "1 клетка = 1 неделя жизни • Всего ~4680 недель (90 лет)",
-        fill=(100, 100, 100),
+        fill=MUTED_COLOR,
         font=font_small
     )
+    return img
+
+@functools.lru_cache(maxsize=None)
+def get_render_templates():
+    # Строится один раз на процесс: шрифты и два полных шаблона —
+    # вся сетка «осталось» и вся сетка «прожито»
+    from PIL import Image
+    font_large, font_small = load_fonts()
+    remaining = _draw_template(REMAINING_COLOR, font_large, font_small)
+    lived = _draw_template(LIVED_COLOR, font_large, font_small)
+
+    # Заголовок рисуется с той же (дробной) позиции пера, на которой оно
+    # оказалось бы при отрисовке всей строки целиком
+    title_x = MARGIN + font_large.getlength(TITLE_PREFIX)
+
+    # Шаблоны переводятся в палитру вместе, чтобы индексы цветов совпадали.
+    # С шрифтом по умолчанию цветов в них около 220, и median cut при таком числе
+    # сохраняет их точно (сопоставление с готовой палитрой в Pillow приблизительное,
+    # поэтому не оно). Если цветов больше (другой шрифт, другое сглаживание),
+    # палитра была бы с потерями — тогда шаблоны остаются RGB, и png8 даёт обычный PNG.
+    both = Image.new("RGB", (IMAGE_W, IMAGE_H * 2))
+    both.paste(remaining, (0, 0))
+    both.paste(lived, (0, IMAGE_H))
+    if both.getcolors(256 - TITLE_LEVELS) is None:
+        logging.warning("В шаблонах больше цветов, чем помещается в палитру: картинки будут RGB")
+        return remaining, lived, font_large, title_x, None
+    both = both.quantize(colors=256 - TITLE_LEVELS, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    palette = both.getpalette()
+    base = min(len(palette) // 3, 256 - TITLE_LEVELS)
+    palette = palette[:base * 3]
+    # Остаток палитры — переход от белого к цвету текста
+    for level in range(TITLE_LEVELS):
+        a = level / (TITLE_LEVELS - 1)
+        palette.extend(round(255 + (c - 255) * a) for c in TEXT_COLOR)
+    both.putpalette(palette)
+    remaining = both.crop((0, 0, IMAGE_W, IMAGE_H))
+    lived = both.crop((0, IMAGE_H, IMAGE_W, IMAGE_H * 2))
+    title_lut = [base + round(a * (TITLE_LEVELS - 1) / 255) for a in range(256)]
+    return remaining, lived, font_large, title_x, title_lut
+
+def create_weeks_image(lived_weeks: int, age_years: int):
+    from PIL import Image, ImageDraw
+    remaining_tpl, lived_tpl, font_large, title_x, title_lut = get_render_templates()
+    img = remaining_tpl.copy()
+
+    # Прожитые недели — это целые строки сверху плюс начало следующей строки,
+    # поэтому хватает двух копирований прямоугольников из шаблона «прожито»
+    lived = max(0, min(lived_weeks, TOTAL_WEEKS))
+    full_rows, partial = divmod(lived, GRID_WIDTH)
+    if full_rows:
+        box = (0, TOP_PAD, IMAGE_W, TOP_PAD + full_rows * CELL_SIZE)
+        img.paste(lived_tpl.crop(box), box)
+    if partial:
+        y0 = TOP_PAD + full_rows * CELL_SIZE
+        box = (0, y0, MARGIN + partial * CELL_SIZE, y0 + CELL_SIZE)
+        img.paste(lived_tpl.crop(box), box)
+
+    title = f"{lived_weeks} недель ({age_years} лет)"
+    if title_lut is None:
+        ImageDraw.Draw(img).text((title_x, 10), title, fill=TEXT_COLOR, font=font_large)
+        return img
+
+    # Картинка в палитре, поэтому числа заголовка рисуются маской сглаживания,
+    # а её уровни переводятся в индексы градаций текста
+    mask = Image.new("L", (IMAGE_W, TITLE_HEIGHT), 0)
+    ImageDraw.Draw(mask).text((title_x, 10), title, fill=255, font=font_large)
+    box = mask.getbbox()
+    if box:
+        glyphs = mask.crop(box)
+        shades = Image.frombytes("P", glyphs.size, glyphs.point(title_lut).tobytes())
+        shades.putpalette(img.getpalette())
+        img.paste(shades, box[:2], glyphs.point(TITLE_MASK_LUT))
 
     return img
 
+_encode_local = threading.local()
+
+def encode_image(img, fmt: str = IMAGE_FORMAT, quality: int = IMAGE_QUALITY) -> bytes:
+    # Буфер переиспользуется в пределах потока, на диск ничего не пишется
+    buf = getattr(_encode_local, "buf", None)
+    if buf is None:
+        buf = _encode_local.buf = io.BytesIO()
+    buf.seek(0)
+    buf.truncate()
+    if fmt == "png8":
+        # optimize: zlib 9 и урезанная палитра — на 20% меньше при +3 мс на картинку,
+        # а картинка кодируется один раз и дальше уходит из кэша по file_id
+        img.save(buf, format="PNG", optimize=True)
+    elif fmt == "png":
+        img.convert("RGB").save(buf, format="PNG")
+    elif fmt == "webp":
+        img.convert("RGB").save(buf, format="WEBP", lossless=True, quality=quality)
+    elif fmt == "webp_lossy":
+        img.convert("RGB").save(buf, format="WEBP", quality=quality)
+    elif fmt == "jpeg":
+        img.convert("RGB").save(buf, format="JPEG", quality=quality, optimize=True)
+    else:
+        raise ValueError(f"Неизвестный формат картинки: {fmt}")
+    return buf.getvalue()
+
+def check_image_format():
+    if IMAGE_FORMAT not in IMAGE_FORMATS:
+        raise ValueError(f"❗ IMAGE_FORMAT должен быть одним из: {', '.join(IMAGE_FORMATS)}")
+    if IMAGE_FORMAT in ("jpeg", "webp_lossy"):
+        logging.warning(
+            f"IMAGE_FORMAT={IMAGE_FORMAT}: картинка в десятки раз больше, чем png8 "
+            f"(bench.py сравнивает форматы)"
+        )
+
+def render_weeks_image(lived_weeks: int, age_years: int) -> bytes:
+    return encode_image(create_weeks_image(lived_weeks, age_years))
+
+# ==========================
+# Пул рендеринга
+# ==========================
+class RenderPool:
+    # Рендер и кодирование картинки выполняются вне event loop. Число задач,
+    # отданных пулу, ограничено workers + queue_size: при всплеске лишние
+    # запросы ждут на семафоре и не копят картинки в памяти.
+    def __init__(self, kind: str, workers: int, queue_size: int):
+        self.kind = kind
+        self.workers = max(1, workers)
+        self._slots = asyncio.Semaphore(self.workers + max(0, queue_size))
+        self._executor = None
+        self.format_labels = (("format", IMAGE_FORMAT),)
+
+    def start(self):
+        if self._executor is not None:
+            return
+        if self.kind == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")
+        else:
+            # Шаблоны строятся в каждом процессе заранее, а не на первом запросе
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=get_render_templates)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def warm(self):
+        # Процессы пула запускаются при первой задаче: запускаем их заранее,
+        # чтобы первая картинка пользователю не ждала импорта Pillow и шаблонов
+        self.start()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, warm_render) for _ in range(self.workers)))
+
+    async def render(self, lived_weeks: int, age_years: int) -> bytes:
+        self.start()
+        waited = time.perf_counter()
+        async with self._slots:
+            started = time.perf_counter()
+            metrics.observe("bot_render_wait_seconds", started - waited)
+            loop = asyncio.get_running_loop()
+            image = await loop.run_in_executor(self._executor, render_weeks_image, lived_weeks, age_years)
+        metrics.observe("bot_render_seconds", time.perf_counter() - started)
+        metrics.observe("bot_render_image_bytes", len(image), self.format_labels, Metrics.BYTES_BUCKETS)
+        return image
+
+def warm_render():
+    get_render_templates()
+
+render_pool = RenderPool(RENDER_EXECUTOR, RENDER_WORKERS, RENDER_QUEUE_SIZE)
+
+# ==========================
+# Кэш готовых картинок
+# ==========================
+class CachedImage:
+    __slots__ = ("image", "file_id")
+
+    def __init__(self, image: bytes):
+        self.image = image
+        self.file_id = None
+
+class ImageCache:
+    # LRU по (lived_weeks, age_years): картинка зависит только от этой пары.
+    # После первой загрузки хранит file_id от Telegram, и дальше фото
+    # отправляется ссылкой без повторного рендера и загрузки.
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            metrics.inc("bot_image_cache_misses_total")
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        metrics.inc("bot_image_cache_hits_total")
+        return entry
+
+    def put(self, key, image: bytes):
+        entry = CachedImage(image)
+        if self.maxsize <= 0:
+            return entry
+        old = self._entries.get(key)
+        if old is not None:
+            self.bytes -= len(old.image)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self.bytes += len(image)
+        while len(self._entries) > self.maxsize:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= len(evicted.image)
+            self.evictions += 1
+            metrics.inc("bot_image_cache_evictions_total")
+        return entry
+
+    def stats_text(self):
+        average = self.bytes / len(self) / 1024 if len(self) else 0
+        return (
+            f"🖼️ Кэш картинок: {len(self)}/{self.maxsize}, "
+            f"попаданий {self.hits}, промахов {self.misses}, вытеснений {self.evictions}\n"
+            f"📦 Средний размер: {average:.1f} КБ ({IMAGE_FORMAT})"
+        )
+
+image_cache = ImageCache(IMAGE_CACHE_SIZE)
+metrics.gauge(lambda: [
+    ("bot_image_cache_entries", (), len(image_cache)),
+    ("bot_image_cache_bytes", (), image_cache.bytes),
+])
+
+def weeks_image_key(days: int):
+    return days // 7, days // 365
+
+async def prepare_weeks_image(days: int):
+    # Рендер заранее, до отправки: в свой слот фото возьмётся из кэша
+    key = weeks_image_key(days)
+    if key not in image_cache:
+        image_cache.put(key, await render_pool.render(*key))
+
+async def send_weeks_photo(send_photo, days: int):
+    # send_photo — context.bot.send_photo с chat_id или update.message.reply_photo,
+    # days — прожитые дни
+    key = weeks_image_key(days)
+    entry = image_cache.get(key)
+    if entry is None:
+        entry = image_cache.put(key, await render_pool.render(*key))
+    elif entry.file_id:
+        try:
+            return await send_photo(photo=entry.file_id)
+        except BadRequest:
+            entry.file_id = None
+
+    message = await send_photo(photo=entry.image)
+    if message and message.photo:
+        entry.file_id = message.photo[-1].file_id
+    return message
+
 # ==========================
 # Вспомогательные функции
 # ==========================
 def get_days_to_birthday(birth_date: datetime):
+    from dateutil.relativedelta import relativedelta
     today = datetime.today()
     try:
         this_year_birthday = birth_date.replace(year=today.year)
@@ -150,26 +1312,23 @@ def get_days_to_birthday(birth_date: datetime):
         next_birthday = this_year_birthday
     return (next_birthday - today).days
 
-def get_median_age(active_users, user_birthdays):
-    if not active_users:
-        return 0
-    ages = []
-    today = datetime.today()
-    for uid in active_users:
-        bd = user_birthdays.get(uid)
-        if bd:
-            age = today.year - bd.year
-            if (today.month, today.day) < (bd.month, bd.day):
-                age -= 1
-            ages.append(age)
-    if not ages:
-        return 0
-    ages.sort()
-    n = len(ages)
-    return ages[n // 2] if n % 2 == 1 else (ages[n // 2 - 1] + ages[n // 2]) // 2
+def age_on(birth_date, day):
+    age = day.year - birth_date.year
+    if (day.month, day.day) < (birth_date.month, birth_date.day):
+        age -= 1
+    return age
+
+def get_median_age(users, age_index=None):
+    if age_index is None:
+        # Без готового индекса — гистограмма одним проходом по колонкам
+        age_index = AgeIndex()
+        age_index.rebuild(users)
+    else:
+        age_index.ensure_current(users)
+    return age_index.median()
 
-def generate_report_text(user_id: int, user_birthdays, active_users):
-    birth_date = user_birthdays.get(user_id)
+def generate_report_text(user_id: int, users, age_index=None):
+    birth_date = users.birth_date(user_id)
     if not birth_date:
         return None
 
@@ -179,10 +1338,8 @@ def generate_report_text(user_id: int, user_birthdays, active_users):
     total_weeks = 90 * 52
     percentage = min(100.0, weeks / total_weeks * 100)
     days_to_bd = get_days_to_birthday(birth_date)
-    median_age = get_median_age(active_users, user_birthdays)
-    user_age = today.year - birth_date.year
-    if (today.month, today.day) < (birth_date.month, birth_date.day):
-        user_age -= 1
+    median_age = get_median_age(users, age_index)
+    user_age = age_on(birth_date, today)
 
     comparison_text = ""
     if median_age > 0:
@@ -201,64 +1358,399 @@ def generate_report_text(user_id: int, user_birthdays, active_users):
     )
 
 # ==========================
-# Рассылки
+# Индекс возрастов
 # ==========================
-async def send_weekly_update(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    user_id = job.user_id
-    birth_date = context.application.bot_data.get("birthdays", {}).get(user_id)
-    if not birth_date:
-        return
+class AgeIndex:
+    # Гистограмма возрастов активных пользователей с датой рождения.
+    # Медиана и перцентили считаются проходом по MAX_AGE + 1 корзинам,
+    # т.е. не зависят от числа пользователей.
+    MAX_AGE = 130
+
+    def __init__(self):
+        self.counts = [0] * (self.MAX_AGE + 1)
+        self.total = 0
+        self.as_of = None
+        # В режиме шардов — сумма гистограмм остальных процессов (обновляется sync_shard)
+        self.shared = None
+
+    def _bucket(self, birth_date):
+        return max(0, min(self.MAX_AGE, age_on(birth_date, self.as_of)))
+
+    # Пока индекс не построен (до warm_up), изменения пропускаются: rebuild
+    # всё равно посчитает их по UserStore
+    def add(self, birth_date):
+        if self.as_of is None:
+            return
+        self.counts[self._bucket(birth_date)] += 1
+        self.total += 1
 
-    today = datetime.today()
-    days = (today - birth_date).days
-    weeks = days // 7
+    def remove(self, birth_date):
+        if self.as_of is None:
+            return
+        self.counts[self._bucket(birth_date)] -= 1
+        self.total -= 1
+
+    # Вызывать до изменения пользователя в UserStore
+    def discard_user(self, user_id, users):
+        if users.is_active(user_id):
+            bd = users.birth_date(user_id)
+            if bd:
+                self.remove(bd)
+
+    # Вызывать после изменения пользователя в UserStore
+    def add_user(self, user_id, users):
+        if users.is_active(user_id):
+            bd = users.birth_date(user_id)
+            if bd:
+                self.add(bd)
+
+    def rebuild(self, users):
+        self.as_of = date.today()
+        self.counts = users.age_counts(self.as_of, self.MAX_AGE)
+        self.total = sum(self.counts)
+
+    def ensure_current(self, users):
+        # Возраст меняется со сменой даты. За одни сутки он меняется только
+        # у тех, чей день рождения сегодня, — их и переносим;
+        # при большем разрыве пересчитываем всё.
+        today = date.today()
+        if self.as_of == today:
+            return
+        if self.as_of is None or (today - self.as_of).days != 1:
+            self.rebuild(users)
+            return
 
-    img = create_weeks_image(weeks, birth_date)
-    path = f"weekly_{user_id}.png"
-    img.save(path)
+        moved = []
+        for uid in users.aging_on(today):
+            bd = users.birth_date(uid)
+            if bd:
+                self.remove(bd)
+                moved.append(bd)
+        self.as_of = today
+        for bd in moved:
+            self.add(bd)
+
+    def _merged(self):
+        if not self.shared:
+            return self.counts, self.total
+        return [a + b for a, b in zip(self.counts, self.shared)], self.total + sum(self.shared)
+
+    @staticmethod
+    def _kth(counts, k):
+        seen = 0
+        for age, count in enumerate(counts):
+            seen += count
+            if seen > k:
+                return age
+        return 0
 
-    try:
-        with open(path, "rb") as f:
-            photo_data = f.read()
-        await context.bot.send_message(chat_id=user_id, text=f"🔄 Обновление!\n📅 {days} дней\n🗓️ {weeks} недель")
-        await context.bot.send_photo(chat_id=user_id, photo=photo_data)
-    except Exception as e:
-        logging.warning(f"Не отправлено {user_id}: {e}")
-        known_users = context.application.bot_data.get("known_users", set())
-        active_users = context.application.bot_data.get("active_users", set())
-        if user_id in known_users:
-            known_users.discard(user_id)
-            active_users.discard(user_id)
-            context.application.bot_data["known_users"] = known_users
-            context.application.bot_data["active_users"] = active_users
-            save_all(known_users, context.application.bot_data["birthdays"], active_users)
-    finally:
-        if os.path.exists(path):
+    def median(self):
+        counts, n = self._merged()
+        if n <= 0:
+            return 0
+        if n % 2 == 1:
+            return self._kth(counts, n // 2)
+        return (self._kth(counts, n // 2 - 1) + self._kth(counts, n // 2)) // 2
+
+    def percentile(self, p: float):
+        counts, n = self._merged()
+        if n <= 0:
+            return 0
+        k = min(n - 1, max(0, int(p / 100 * n + 0.5) - 1))
+        return self._kth(counts, k)
+
+async def rollover_age_index(context: ContextTypes.DEFAULT_TYPE):
+    data = context.application.bot_data
+    data["age_index"].ensure_current(data["users"])
+
+# ==========================
+# Недоступные пользователи
+# ==========================
+def is_dead_chat_error(error):
+    # Бот заблокирован, аккаунт удалён или чата больше нет
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and "chat not found" in str(error).lower()
+
+def classify_send_error(error):
+    # "dead" — пользователь недоступен навсегда, "retry" — сетевой сбой (таймаут,
+    # обрыв соединения), стоит повторить, "failed" — ошибка именно этого сообщения
+    if is_dead_chat_error(error):
+        return "dead"
+    if isinstance(error, NetworkError) and not isinstance(error, BadRequest):
+        return "retry"
+    return "failed"
+
+class Reaper:
+    # Недоступные пользователи копятся и удаляются пачкой: одна запись в хранилище
+    # раз в REAPER_INTERVAL_SECONDS, сколько бы отправок ни упало за это время
+    def __init__(self, data):
+        self.data = data
+        self.pending = set()
+        self.reaped = 0
+
+    def add(self, user_id: int):
+        self.pending.add(user_id)
+
+    def spare(self, user_id: int):
+        # Пользователь снова написал боту — удалять его уже не нужно
+        self.pending.discard(user_id)
+
+    def flush(self) -> int:
+        if not self.pending:
+            return 0
+        user_ids = sorted(self.pending)
+        self.pending = set()
+        remove_users(self.data, user_ids)
+        self.reaped += len(user_ids)
+        metrics.inc("bot_users_reaped_total", value=len(user_ids))
+        logging.info(f"Удалено недоступных пользователей: {len(user_ids)}")
+        return len(user_ids)
+
+async def reap_dead_users(context: ContextTypes.DEFAULT_TYPE):
+    context.application.bot_data["reaper"].flush()
+
+# ==========================
+# Планировщик отправок
+# ==========================
+class SendPlan:
+    # План ежедневной волны: каждому пользователю — смещение от начала в секундах.
+    # Смещение — хеш user_id, растянутый на окно, поэтому у пользователя каждую неделю
+    # одно и то же время. С бюджетом rate соседние по плану отправки раздвигаются ещё
+    # и не меньше чем на cost / rate (cost — сообщений на пользователя).
+    # Кривые «план» и «факт»: bot_send_planned и bot_send_done (сколько отправок уже
+    # положено и сколько сделано), опоздание слота — bot_send_slot_lag_seconds.
+    # start — продолжение прерванной волны: в план попадают только пользователи
+    # с хешем от start, и они раскладываются на оставшуюся часть окна.
+    def __init__(self, name: str, user_ids, cost: int, window: float, rate: float, start: int = 0):
+        self.name = name
+        self.labels = (("wave", name),)
+        mul, mask = UserStore.HASH_MUL, UserStore.HASH_MASK
+        hashes = [(uid * mul) & mask for uid in user_ids]
+        # Порядок отправки: индексы в user_ids
+        self.order = sorted((i for i in range(len(user_ids)) if hashes[i] >= start), key=hashes.__getitem__)
+        self.hashes = [hashes[i] for i in self.order]
+        scale = window / (1 << 64)
+        step = cost / rate if rate > 0 else 0.0
+        offsets = []
+        slot = -step
+        for h in self.hashes:
+            slot = max((h - start) * scale, slot + step)
+            offsets.append(slot)
+        self.offsets = offsets
+        self.started = None
+        self.done = 0
+        self.failed = 0
+        self.max_lag = 0.0
+        # Отправки завершаются не по порядку: отмечены завершённые позиции плана,
+        # а _next — первая незавершённая
+        self._finished = bytearray(len(self.order))
+        self._next = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def planned(self) -> int:
+        if self.started is None:
+            return 0
+        return bisect.bisect_right(self.offsets, time.monotonic() - self.started)
+
+    def resume_point(self):
+        # Хеш первого пользователя, которому ещё не отправлено; None — волна пройдена
+        return self.hashes[self._next] if self._next < len(self.hashes) else None
+
+    def _complete(self, position: int):
+        self.done += 1
+        self._finished[position] = 1
+        while self._next < len(self._finished) and self._finished[self._next]:
+            self._next += 1
+
+    async def run(self, send, prepare=None, concurrency: int = WEEKLY_CONCURRENCY, checkpoint=None):
+        # send(i) и prepare(i) получают индекс в user_ids. prepare идёт впереди плана
+        # на PRERENDER_AHEAD_SECONDS; не успевает — send сделает всё сам.
+        # checkpoint(resume_point()) вызывается раз в WAVE_CHECKPOINT_SECONDS и в конце,
+        # в том числе при отмене: отменённые отправки остаются непройденными.
+        # Ошибка одной отправки волну не прерывает: она пишется в лог и в
+        # bot_send_failed_total, а отправка считается пройденной.
+        self.started = time.monotonic()
+        slots = asyncio.Semaphore(concurrency)
+        running = set()
+        prefetch = asyncio.ensure_future(self._prepare(prepare)) if prepare and self.order else None
+        saved = self.started
+
+        async def deliver(position, i):
             try:
-                os.remove(path)
-            except:
-                pass
+                await send(i)
+            except Exception:
+                self.failed += 1
+                metrics.inc("bot_send_failed_total", self.labels)
+                logging.exception(f"Волна {self.name}: отправка не удалась")
+            finally:
+                slots.release()
+            # CancelledError сюда не доходит: отменённая отправка не пройдена
+            self._complete(position)
 
-async def check_and_send_birthday(context: ContextTypes.DEFAULT_TYPE):
-    user_id = context.job.user_id
-    birth_date = context.application.bot_data.get("birthdays", {}).get(user_id)
-    if not birth_date:
-        return
+        try:
+            for position, (offset, i) in enumerate(zip(self.offsets, self.order)):
+                delay = self.started + offset - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await slots.acquire()
+                now = time.monotonic()
+                lag = max(0.0, now - self.started - offset)
+                self.max_lag = max(self.max_lag, lag)
+                metrics.observe("bot_send_slot_lag_seconds", lag, self.labels)
+                task = asyncio.ensure_future(deliver(position, i))
+                running.add(task)
+                task.add_done_callback(running.discard)
+                if checkpoint is not None and now - saved >= WAVE_CHECKPOINT_SECONDS:
+                    checkpoint(self.resume_point())
+                    saved = now
+            if running:
+                await asyncio.gather(*running)
+        finally:
+            if prefetch is not None:
+                prefetch.cancel()
+            for task in list(running):
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+            if checkpoint is not None:
+                checkpoint(self.resume_point())
+        logging.info(
+            f"Волна {self.name}: {len(self)} за {time.monotonic() - self.started:.0f} с, "
+            f"ошибок {self.failed} (по плану {self.offsets[-1] if self.offsets else 0:.0f} с), "
+            f"наибольшее опоздание слота {self.max_lag:.1f} с"
+        )
 
-    today = datetime.today()
-    if birth_date.month == 2 and birth_date.day == 29:
-        is_leap = (today.year % 4 == 0 and (today.year % 100 != 0 or today.year % 400 == 0))
-        if today.month == 2 and today.day == 28 and not is_leap:
-            pass
-        elif today.month == 2 and today.day == 29 and is_leap:
-            pass
+    async def _prepare(self, prepare):
+        for offset, i in zip(self.offsets, self.order):
+            delay = self.started + offset - PRERENDER_AHEAD_SECONDS - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await prepare(i)
+            except Exception as e:
+                logging.warning(f"Волна {self.name}: не подготовлено заранее: {e}")
+
+# Последняя волна каждого вида — для кривых план/факт в /metrics
+send_plans = {}
+metrics.gauge(lambda: [
+    sample
+    for plan in send_plans.values()
+    for sample in (
+        ("bot_send_plan_size", plan.labels, len(plan)),
+        ("bot_send_planned", plan.labels, plan.planned()),
+        ("bot_send_done", plan.labels, plan.done),
+    )
+])
+
+def plan_wave(name: str, user_ids, cost: int, start: int = 0) -> SendPlan:
+    plan = SendPlan(name, user_ids, cost, SEND_WINDOW_MINUTES * 60, SEND_RATE, start)
+    send_plans[name] = plan
+    return plan
+
+def wave_key(application: Application, name: str) -> str:
+    # У каждого шарда своя волна по своим пользователям
+    shards = application.bot_data.get("shards")
+    return f"wave:{name}:{shards.index}" if shards is not None else f"wave:{name}"
+
+def unfinished_wave(application: Application, name: str):
+    # Сегодняшняя прерванная волна: {"day", "data", "next"} или None
+    saved = application.bot_data["storage"].get_meta(wave_key(application, name))
+    if not saved:
+        return None
+    state = json.loads(saved)
+    if state["day"] != datetime.now(timezone.utc).date().isoformat():
+        return None
+    return state
+
+async def run_wave(application: Application, name: str, data, user_ids, cost: int, send, prepare=None) -> bool:
+    # Волна идёт отдельной задачей, которую BotApplication.stop отменяет, а не ждёт
+    # до конца окна. Докуда она дошла, лежит в meta (wave_key); та же задача,
+    # запущенная в тот же день снова (resume_waves после перезапуска), продолжает
+    # с этого места. False — волна прервана.
+    storage = application.bot_data["storage"]
+    key = wave_key(application, name)
+    today = datetime.now(timezone.utc).date().isoformat()
+    state = unfinished_wave(application, name)
+    start = state["next"] if state else 0
+
+    def checkpoint(position):
+        if position is None:
+            storage.set_meta(key, "")
         else:
+            storage.set_meta(key, json.dumps({"day": today, "data": data, "next": position}))
+
+    # Сначала место в волне, потом отметка о запуске: после сбоя между ними
+    # волна всё равно продолжится, а не потеряется
+    checkpoint(start)
+    mark_job_run(application, name)
+    plan = plan_wave(name, user_ids, cost, start)
+    if start:
+        logging.info(f"Волна {name}: продолжаю, осталось {len(plan)} из {len(user_ids)}")
+    task = track_task(application, asyncio.ensure_future(plan.run(send, prepare, checkpoint=checkpoint)))
+    try:
+        await task
+    except asyncio.CancelledError:
+        logging.info(f"Волна {name} остановлена на {plan.done} из {len(plan)}, продолжится после запуска")
+        return False
+    return True
+
+# ==========================
+# Рассылки
+# ==========================
+async def send_weekly_update(context: ContextTypes.DEFAULT_TYPE, user_id: int, days: int):
+    weeks = days // 7
+    text_sent = False
+    attempt = 0
+    while True:
+        try:
+            if not text_sent:
+                await context.bot.send_message(chat_id=user_id, text=f"🔄 Обновление!\n📅 {days} дней\n🗓️ {weeks} недель")
+                text_sent = True
+            await send_weeks_photo(functools.partial(context.bot.send_photo, chat_id=user_id), days)
             return
-    else:
-        if not (today.month == birth_date.month and today.day == birth_date.day):
-            return
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            kind = classify_send_error(e)
+            if kind == "dead":
+                context.application.bot_data["reaper"].add(user_id)
+                return
+            attempt += 1
+            if kind == "failed" or attempt > WEEKLY_RETRIES:
+                logging.warning(f"Не отправлено {user_id}: {e}")
+                return
+            await asyncio.sleep(2 ** attempt)
+
+async def send_weekly_bucket(context: ContextTypes.DEFAULT_TYPE):
+    # Одна задача на день недели: один проход по колонкам находит всех, кто родился
+    # в этот день недели, второй — сколько каждый прожил. Отправки идут по плану
+    # (SEND_WINDOW_MINUTES, SEND_RATE), картинки рендерятся чуть раньше своих слотов
+    observe_job_lag("weekly", WEEKLY_TIME)
+    users = context.application.bot_data["users"]
+    user_ids = users.weekday_ids(context.job.data)
+    days = users.days_lived(user_ids, date.today())
+
+    async def send(i):
+        await send_weekly_update(context, user_ids[i], days[i])
+
+    async def prepare(i):
+        await prepare_weeks_image(days[i])
+
+    # Текст и фото — два сообщения на пользователя
+    if not await run_wave(context.application, "weekly", context.job.data, user_ids, 2, send, prepare):
+        return
+    context.application.bot_data["reaper"].flush()
+    logging.info(f"Еженедельная рассылка: {len(user_ids)} пользователей")
 
+async def send_birthday_greeting(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    birth_date = context.application.bot_data["users"].birth_date(user_id)
+    if not birth_date:
+        return
+
+    today = datetime.today()
     age = today.year - birth_date.year
     try:
         await context.bot.send_message(
@@ -268,40 +1760,81 @@ async def check_and_send_birthday(context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logging.warning(f"Не удалось поздравить {user_id}: {e}")
 
-def schedule_birthday_greeting(job_queue, user_id, birth_date):
-    if job_queue is None:
-        return
-    for job in job_queue.get_jobs_by_name(f"birthday_{user_id}"):
-        job.schedule_removal()
-    job_queue.run_daily(
-        check_and_send_birthday,
-        time=datetime.strptime("08:00", "%H:%M").time(),
-        user_id=user_id,
-        name=f"birthday_{user_id}"
-    )
+async def send_birthday_greetings(context: ContextTypes.DEFAULT_TYPE):
+    # Одна задача в день: только те, у кого сегодня день рождения
+    observe_job_lag("birthday", BIRTHDAY_TIME)
+    user_ids = context.application.bot_data["users"].due_on(date.today())
+
+    async def send(i):
+        await send_birthday_greeting(context, user_ids[i])
 
-def schedule_weekly_update(job_queue, user_id, birth_date):
-    if job_queue is None:
+    if not await run_wave(context.application, "birthday", None, user_ids, 1, send):
         return
-    for job in job_queue.get_jobs_by_name(f"weekly_{user_id}"):
-        job.schedule_removal()
+    if user_ids:
+        logging.info(f"Поздравлений отправлено: {len(user_ids)}")
+
+def mark_job_run(application: Application, job: str):
+    # Отметка ставится до отправки, чтобы catch_up_jobs не начал волну заново;
+    # прерванную волну продолжает resume_waves по её месту (run_wave)
+    application.bot_data["storage"].set_meta(f"job:{job}", datetime.now(timezone.utc).date().isoformat())
+
+def catch_up_jobs(application: Application, weekly=None, birthday=None):
+    # Рассылки, время которых прошло, пока бот был остановлен (деплой, перезапуск).
+    # Без отметки (первый запуск) догонять нечего. weekly/birthday — как в
+    # schedule_*: у шардов это рассылка задачи всем шардам.
+    storage = application.bot_data["storage"]
+    now = datetime.now(timezone.utc)
+    today = now.date().isoformat()
+    last = storage.get_meta("job:birthday")
+    if last and last < today and now.time() > BIRTHDAY_TIME:
+        logging.info("Догоняю пропущенные поздравления")
+        application.job_queue.run_once(birthday or send_birthday_greetings, 0, name="birthday_sweep")
+    last = storage.get_meta("job:weekly")
+    if last and last < today and now.time() > WEEKLY_TIME:
+        logging.info("Догоняю пропущенную еженедельную рассылку")
+        application.job_queue.run_once(
+            weekly or send_weekly_bucket, 0, data=now.weekday(), name=f"weekly_bucket_{now.weekday()}"
+        )
+
+def resume_waves(application: Application):
+    # Волны, прерванные сегодня остановкой или сбоем процесса. У шардов каждый
+    # продолжает свою сам: отметка о запуске общая, а места в волне — свои
+    state = unfinished_wave(application, "weekly")
+    if state:
+        application.job_queue.run_once(
+            send_weekly_bucket, 0, data=state["data"], name=f"weekly_bucket_{state['data']}"
+        )
+    if unfinished_wave(application, "birthday"):
+        application.job_queue.run_once(send_birthday_greetings, 0, name="birthday_sweep")
+
+def schedule_birthday_job(job_queue, callback=None):
     job_queue.run_daily(
-        send_weekly_update,
-        time=datetime.strptime("09:00", "%H:%M").time(),
-        days=(birth_date.weekday(),),
-        user_id=user_id,
-        name=f"weekly_{user_id}"
+        callback or send_birthday_greetings,
+        time=BIRTHDAY_TIME,
+        name="birthday_sweep"
     )
 
+def schedule_weekly_jobs(job_queue, callback=None):
+    # Семь задач на всё время работы, сколько бы ни было пользователей.
+    # В run_daily дни считаются от воскресенья (0), а weekday() — от понедельника.
+    for weekday in range(7):
+        job_queue.run_daily(
+            callback or send_weekly_bucket,
+            time=WEEKLY_TIME,
+            days=((weekday + 1) % 7,),
+            data=weekday,
+            name=f"weekly_bucket_{weekday}"
+        )
+
 # ==========================
 # Обработчики
 # ==========================
+@instrumented("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    known_users = context.application.bot_data["known_users"]
-    known_users.add(user_id)
-    context.application.bot_data["known_users"] = known_users
-    save_all(known_users, context.application.bot_data["birthdays"], context.application.bot_data["active_users"])
+    context.application.bot_data["reaper"].spare(user_id)
+    context.application.bot_data["users"].set_known(user_id)
+    persist_users(context, [user_id])
 
     reply_markup = ReplyKeyboardMarkup(USER_KEYBOARD, resize_keyboard=True)
     await update.message.reply_text(
@@ -311,32 +1844,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+@instrumented("stop")
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    known_users = context.application.bot_data["known_users"]
-    active_users = context.application.bot_data["active_users"]
-    birthdays = context.application.bot_data["birthdays"]
-
-    if user_id in known_users:
-        known_users.discard(user_id)
-        active_users.discard(user_id)
-        birthdays.pop(user_id, None)
-        context.application.bot_data["known_users"] = known_users
-        context.application.bot_data["active_users"] = active_users
-        context.application.bot_data["birthdays"] = birthdays
-        save_all(known_users, birthdays, active_users)
-
-        if context.job_queue:
-            for name in [f"weekly_{user_id}", f"birthday_{user_id}"]:
-                for job in context.job_queue.get_jobs_by_name(name):
-                    job.schedule_removal()
+    if unsubscribe_user(context.application.bot_data, user_id):
         await update.message.reply_text("✅ Ты отписался(ась).")
     else:
         await update.message.reply_text("Ты не подписан.")
 
+@instrumented("time_units")
 async def time_units(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    birth = context.application.bot_data["birthdays"].get(user_id)
+    birth = context.application.bot_data["users"].birth_date(user_id)
     if not birth:
         await update.message.reply_text("Сначала введи дату рождения через кнопку 📅!")
         return
@@ -354,34 +1873,26 @@ async def time_units(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"💫 {seconds:,} секунд"
     )
 
+@instrumented("show_my_stats")
 async def show_my_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    report = generate_report_text(user_id, context.application.bot_data["birthdays"], context.application.bot_data["active_users"])
+    users = context.application.bot_data["users"]
+    report = generate_report_text(user_id, users, context.application.bot_data["age_index"])
     if not report:
         await update.message.reply_text("Сначала введи дату рождения через кнопку 📅!")
         return
 
+    # Дата читается до первого await: пока уходит отчёт, Reaper может удалить пользователя
+    days = (datetime.today() - users.birth_date(user_id)).days
     await update.message.reply_text(report)
-    birth_date = context.application.bot_data["birthdays"][user_id]
-    weeks = (datetime.today() - birth_date).days // 7
-    img = create_weeks_image(weeks, birth_date)
-    path = f"stats_{user_id}.png"
-    img.save(path)
-
-    try:
-        with open(path, "rb") as f:
-            photo_data = f.read()
-        await update.message.reply_photo(photo=photo_data)
-    finally:
-        if os.path.exists(path):
-            try:
-                os.remove(path)
-            except:
-                pass
+    await send_weeks_photo(update.message.reply_photo, days)
 
+@instrumented("handle_message")
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text.strip()
+    # Любое сообщение, и кнопка меню тоже, — пользователь доступен, удалять его не нужно
+    context.application.bot_data["reaper"].spare(user_id)
 
     if text == "🕒 Мои единицы времени":
         await time_units(update, context)
@@ -393,9 +1904,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Введите дату рождения в формате ДД.ММ.ГГГГ\nПример: 05.03.1998")
         return
 
-    known_users = context.application.bot_data["known_users"]
-    known_users.add(user_id)
-    context.application.bot_data["known_users"] = known_users
+    users = context.application.bot_data["users"]
+    users.set_known(user_id)
 
     clean = text.replace("/", ".").strip()
     parts = clean.split(".")
@@ -417,38 +1927,500 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("📅 Дата не может быть в будущем!")
             return
 
-        birthdays = context.application.bot_data["birthdays"]
-        active_users = context.application.bot_data["active_users"]
-        birthdays[user_id] = birth_date
-        active_users.add(user_id)
-        context.application.bot_data["birthdays"] = birthdays
-        context.application.bot_data["active_users"] = active_users
-        save_all(known_users, birthdays, active_users)
-
-        schedule_weekly_update(context.job_queue, user_id, birth_date)
-        schedule_birthday_greeting(context.job_queue, user_id, birth_date)
+        # Еженедельная рассылка и поздравления находят пользователя по колонкам сами
+        set_user_birth_date(context.application.bot_data, user_id, birth_date)
 
-        report = generate_report_text(user_id, birthdays, active_users)
+        report = generate_report_text(user_id, users, context.application.bot_data["age_index"])
         await update.message.reply_text(report)
 
-        img = create_weeks_image((datetime.today() - birth_date).days // 7, birth_date)
-        path = f"result_{user_id}.png"
-        img.save(path)
-
-        try:
-            with open(path, "rb") as f:
-                photo_data = f.read()
-            await update.message.reply_photo(photo=photo_data)
-        finally:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except:
-                    pass
+        await send_weeks_photo(update.message.reply_photo, (datetime.today() - birth_date).days)
 
     except (ValueError, OverflowError):
         await update.message.reply_text("❌ Не удалось распознать дату. Пример: 01.01.2000")
 
+# ==========================
+# Движок рассылок
+# ==========================
+class TokenBucket:
+    # rate токенов в секунду, не больше capacity подряд
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        # RetryAfter действует на весь бот, а не на один чат. Токены копятся заново
+        # с конца паузы, иначе сразу после неё ушла бы целая пачка capacity
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def load_broadcast_state():
+    if not os.path.exists(BROADCAST_STATE_FILE):
+        return None
+    try:
+        with open(BROADCAST_STATE_FILE, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        with open(BROADCAST_QUEUE_FILE, "r", encoding="utf-8") as f:
+            state["user_ids"] = json.load(f)
+        return state
+    except Exception as e:
+        logging.error(f"Не удалось прочитать состояние рассылки: {e}")
+        return None
+
+def clear_broadcast_state():
+    for path in (BROADCAST_STATE_FILE, BROADCAST_QUEUE_FILE):
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except:
+                pass
+
+def discard_broadcast_state():
+    # Упавшая рассылка не должна блокировать новые и повторяться после каждого
+    # перезапуска: её файлы откладываются рядом (*.failed) для разбора
+    for path in (BROADCAST_STATE_FILE, BROADCAST_QUEUE_FILE):
+        if os.path.exists(path):
+            try:
+                os.replace(path, f"{path}.failed")
+            except OSError as e:
+                logging.error(f"Не удалось отложить {path}: {e}")
+
+class Broadcast:
+    # Рассылка идёт кусками по BROADCAST_CHUNK. После каждого куска на диск
+    # пишется смещение, так что после перезапуска повторится не больше одного куска.
+    def __init__(self, application: Application, state: dict):
+        self.app = application
+        self.state = state
+        self.user_ids = state.pop("user_ids")
+        self.bucket = TokenBucket(BROADCAST_RATE)
+        self.album = None
+        if state["kind"] == "album":
+            self.album = [
+                ALBUM_MEDIA[item["kind"]](media=item["file_id"], caption=item["caption"])
+                for item in state["media"]
+            ]
+        self.last_progress = 0.0
+
+    @classmethod
+    def create(cls, application, user_ids, payload, status_message=None):
+        # payload — результат broadcast_payload() или альбом {"kind": "album", "media": [...]}
+        state = {
+            **payload,
+            "offset": 0,
+            "success": 0,
+            "failed": 0,
+            "dropped": 0,
+            "total": len(user_ids),
+            "status_chat_id": status_message.chat_id if status_message else None,
+            "status_message_id": status_message.message_id if status_message else None,
+        }
+        _dump_json(BROADCAST_QUEUE_FILE, user_ids)
+        broadcast = cls(application, dict(state, user_ids=user_ids))
+        broadcast.checkpoint()
+        return broadcast
+
+    def checkpoint(self):
+        try:
+            _dump_json(BROADCAST_STATE_FILE, self.state)
+        except Exception as e:
+            logging.error(f"Не удалось сохранить состояние рассылки: {e}")
+
+    def progress_text(self, done=False, error=None):
+        s = self.state
+        if error is not None:
+            head = f"❌ Рассылка прервана ({error})"
+        else:
+            head = "✅ Рассылка завершена" if done else "📨 Рассылка идёт"
+        return (
+            f"{head}: {s['offset']}/{s['total']}\n"
+            f"Отправлено: {s['success']}, ошибок: {s['failed']}, удалено: {s['dropped']}"
+        )
+
+    async def report(self, done=False, error=None):
+        s = self.state
+        now = time.monotonic()
+        if not done and error is None and now - self.last_progress < 5:
+            return
+        self.last_progress = now
+        text = self.progress_text(done, error)
+        try:
+            if s["status_message_id"]:
+                await self.app.bot.edit_message_text(
+                    chat_id=s["status_chat_id"], message_id=s["status_message_id"], text=text
+                )
+            else:
+                await self.app.bot.send_message(chat_id=YOUR_USER_ID, text=text)
+        except Exception as e:
+            logging.warning(f"Не удалось обновить прогресс рассылки: {e}")
+
+    async def send_to(self, user_id):
+        s = self.state
+        if s["kind"] == "text":
+            await self.app.bot.send_message(chat_id=user_id, text=s["text"])
+        elif s["kind"] == "album":
+            await self.app.bot.send_media_group(chat_id=user_id, media=self.album)
+        else:
+            send = getattr(self.app.bot, f"send_{s['kind']}")
+            await send(user_id, s["file_id"], caption=s["caption"])
+
+    async def deliver(self, user_id):
+        # "ok", "dead" (удалить пользователя) или "failed"
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self.send_to(user_id)
+                return "ok"
+            except RetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except Exception as e:
+                kind = classify_send_error(e)
+                if kind == "dead":
+                    return "dead"
+                attempt += 1
+                if kind == "failed" or attempt > BROADCAST_RETRIES:
+                    logging.warning(f"Рассылка: не отправлено {user_id}: {e}")
+                    return "failed"
+                await asyncio.sleep(2 ** attempt)
+
+    async def run(self):
+        s = self.state
+        data = self.app.bot_data
+        while s["offset"] < len(self.user_ids):
+            chunk = self.user_ids[s["offset"]:s["offset"] + BROADCAST_CHUNK]
+            pending = iter(chunk)
+            dead = []
+
+            async def worker():
+                for uid in pending:
+                    result = await self.deliver(uid)
+                    if result == "ok":
+                        s["success"] += 1
+                    else:
+                        s["failed"] += 1
+                        if result == "dead":
+                            dead.append(uid)
+
+            await asyncio.gather(*(worker() for _ in range(min(BROADCAST_CONCURRENCY, len(chunk)))))
+
+            reaper = data["reaper"]
+            for uid in dead:
+                reaper.add(uid)
+            s["dropped"] += len(dead)
+            s["offset"] += len(chunk)
+            self.checkpoint()
+            await self.report()
+
+        clear_broadcast_state()
+        await self.report(done=True)
+
+def broadcast_payload(message):
+    for kind in BROADCAST_MEDIA:
+        media = getattr(message, kind)
+        if media:
+            if kind == "photo":
+                media = media[-1]
+            caption = message.caption
+            if kind == "photo" and not caption:
+                caption = "Сообщение от бота"
+            return {"kind": kind, "file_id": media.file_id, "caption": caption}
+    return {"kind": "text", "text": message.text}
+
+async def start_broadcast(application: Application, broadcast: Broadcast):
+    try:
+        await broadcast.run()
+    except Exception as e:
+        # При остановке бота рассылку отменяет BotApplication.stop. CancelledError —
+        # не Exception, так что файлы рассылки остаются и она продолжится после старта
+        logging.exception("Рассылка прервана:")
+        discard_broadcast_state()
+        await broadcast.report(error=e)
+
+def run_broadcast(application: Application, broadcast: Broadcast):
+    # Рассылка идёт фоном и не задерживает обработку остальных сообщений
+    track_task(application, application.create_task(start_broadcast(application, broadcast)))
+
+# ==========================
+# Выгрузка
+# ==========================
+def export_line(fmt: str, row) -> str:
+    # Строки собираются форматированием: json.dumps на миллионе строк втрое медленнее
+    user_id, known, active, birth_date = row
+    if fmt == "jsonl":
+        birth_date = f'"{birth_date[:10]}"' if birth_date else "null"
+        return (
+            f'{{"user_id": {user_id}, "known": {"true" if known else "false"}, '
+            f'"active": {"true" if active else "false"}, "birth_date": {birth_date}}}\n'
+        )
+    return f"{user_id},{known},{active},{birth_date[:10] if birth_date else ''}\n"
+
+def export_parts(rows, fmt: str, compress: bool, part_bytes: int = EXPORT_PART_BYTES):
+    # Отдаёт готовые части по одной: в памяти не больше одной части, на диск ничего
+    # не пишется. Каждая часть — самостоятельный файл (у CSV свой заголовок).
+    # Сжатый поток мог ещё не вытолкнуть хвост в буфер, поэтому часть закрываем с запасом
+    # (1 МБ, но не больше половины части — иначе каждая строка закрывала бы свою часть).
+    limit = max(part_bytes // 2, part_bytes - 1024 * 1024) if compress else part_bytes
+    buffer = None
+    stream = None
+    for row in rows:
+        if stream is None:
+            buffer = io.BytesIO()
+            stream = gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6) if compress else buffer
+            if fmt == "csv":
+                stream.write(b"user_id,known,active,birth_date\n")
+        stream.write(export_line(fmt, row).encode("utf-8"))
+        if buffer.tell() >= limit:
+            if compress:
+                stream.close()
+            yield buffer.getvalue()
+            stream = None
+    if stream is not None:
+        if compress:
+            stream.close()
+        yield buffer.getvalue()
+
+async def send_export(application: Application, chat_id: int, fmt: str, compress: bool):
+    data = application.bot_data
+    if data.get("export_running"):
+        await application.bot.send_message(chat_id=chat_id, text="⏳ Выгрузка уже идёт.")
+        return
+    data["export_running"] = True
+    try:
+        loop = asyncio.get_running_loop()
+        parts = export_parts(data["storage"].iter_users(), fmt, compress)
+        stamp = datetime.now().strftime("%Y%m%d_%H%M")
+        suffix = f".{fmt}.gz" if compress else f".{fmt}"
+        number = 0
+        while True:
+            # Чтение базы и сжатие — в потоке, чтобы бот продолжал отвечать
+            part = await loop.run_in_executor(None, next, parts, None)
+            if part is None:
+                break
+            number += 1
+            await application.bot.send_document(
+                chat_id=chat_id,
+                document=part,
+                filename=f"users_{stamp}_part{number}{suffix}",
+                read_timeout=120,
+                write_timeout=120
+            )
+        if number == 0:
+            await application.bot.send_message(chat_id=chat_id, text="Пользователей пока нет.")
+    except Exception as e:
+        logging.exception("Ошибка выгрузки")
+        await application.bot.send_message(chat_id=chat_id, text=f"❌ Выгрузка не удалась: {e}")
+    finally:
+        data["export_running"] = False
+
+# ==========================
+# Профилирование
+# ==========================
+class Profiler:
+    # Семплирующий профилировщик: отдельный поток раз в interval снимает стеки всех
+    # потоков процесса. Пока запись не идёт, нет ни потока, ни счётчика обновлений —
+    # бот работает как без профилировщика.
+    # Видно время, когда поток занят: ожидание ответа Bot API и рендеринг в процессах
+    # пула (RENDER_EXECUTOR=process) сюда не попадают — их время есть в /metrics.
+    # Поток ждёт событий или работы: (файл, функция) верхнего кадра
+    IDLE_FRAMES = {
+        ("selectors.py", "select"),
+        ("threading.py", "wait"),
+        ("queue.py", "get"),
+        ("thread.py", "_worker"),
+    }
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        # (поток, стек от корня к вершине) -> срезов; простой потоков — отдельно
+        self.stacks = Counter()
+        self.idle = Counter()
+        self.ticks = 0
+        self.seconds = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self.seconds = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.seconds = time.perf_counter() - self.seconds
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        labels = {}
+        while not self._stop.wait(self.interval):
+            self.ticks += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = names.get(ident)
+                if name is None:
+                    names.update((t.ident, t.name) for t in threading.enumerate())
+                    name = names.get(ident, str(ident))
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in self.IDLE_FRAMES:
+                    self.idle[name] += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        qualname = getattr(code, "co_qualname", code.co_name)
+                        label = f"{qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                        labels[code] = label
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[name, tuple(stack)] += 1
+
+    def report(self, top: int) -> str:
+        # Доли — от времени записи: 100% собственного времени — поток был занят одной функцией
+        ticks = max(1, self.ticks)
+        busy = Counter()
+        own = Counter()
+        total = Counter()
+        for (thread, stack), n in self.stacks.items():
+            busy[thread] += n
+            own[stack[-1]] += n
+            for label in set(stack):
+                total[label] += n
+        lines = [
+            f"Запись {self.seconds:.1f} с, {self.ticks} срезов по {self.interval * 1000:g} мс",
+            "",
+            "Потоки (занят / ждёт):",
+        ]
+        for thread in sorted(set(busy) | set(self.idle), key=lambda t: -busy[t]):
+            lines.append(f"  {thread}: {100 * busy[thread] / ticks:.1f}% / {100 * self.idle[thread] / ticks:.1f}%")
+        for title, counter in (("собственному времени", own), ("времени с вызванными", total)):
+            lines += ["", f"Функции по {title} (топ {top}):", "   своё%  всего%  функция"]
+            for label, _ in counter.most_common(top):
+                lines.append(f"  {100 * own[label] / ticks:6.1f}  {100 * total[label] / ticks:6.1f}  {label}")
+        return "\n".join(lines) + "\n"
+
+    def collapsed(self) -> bytes:
+        # Формат flamegraph.pl / speedscope / inferno: "поток;корень;...;вершина срезов"
+        return "".join(
+            f"{thread};{';'.join(stack)} {n}\n" for (thread, stack), n in sorted(self.stacks.items())
+        ).encode("utf-8")
+
+def parse_profile_args(args):
+    # /profile 30 — 30 секунд, /profile 500u — до 500-го обновления; вторым числом — размер топа.
+    # -> (секунд, обновлений или None, топ); ValueError на неверных аргументах
+    spec = args[0].lower() if args else "30"
+    top = int(args[1]) if len(args) > 1 else PROFILE_TOP
+    updates = None
+    if spec.endswith("u"):
+        updates = int(spec[:-1])
+        seconds = PROFILE_MAX_SECONDS
+    else:
+        seconds = float(spec.rstrip("s"))
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or (updates is not None and updates <= 0) or top <= 0:
+        raise ValueError(spec)
+    return seconds, updates, top
+
+# Группа счётчика обновлений: после основных обработчиков, так что обновление
+# считается, когда оно уже обработано
+PROFILE_HANDLER_GROUP = 1
+
+def set_profile_handler(application: Application, handler):
+    # Словарь групп заменяется целиком: add_handler и remove_handler меняют его на месте,
+    # а по нему в это время идут другие обновления (и сама команда /profile)
+    handlers = {group: h for group, h in application.handlers.items() if group != PROFILE_HANDLER_GROUP}
+    if handler is not None:
+        handlers[PROFILE_HANDLER_GROUP] = [handler]
+    application.handlers = dict(sorted(handlers.items()))
+
+@instrumented("profile_command")
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # В режиме шардов профилируется процесс, которому достаются обновления администратора
+    if update.effective_user.id != YOUR_USER_ID:
+        return
+    application = context.application
+    if "profile" in application.bot_data:
+        await update.message.reply_text("⏳ Профилирование уже идёт.")
+        return
+    try:
+        seconds, updates, top = parse_profile_args(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            "Использование: /profile 30 — записать 30 секунд, /profile 500u — 500 обновлений "
+            f"(не дольше {PROFILE_MAX_SECONDS:g} с). Вторым числом — сколько функций показать."
+        )
+        return
+
+    session = {"profiler": Profiler(PROFILE_INTERVAL_MS / 1000), "chat_id": update.effective_chat.id,
+               "top": top, "updates": updates, "seen": 0}
+    if updates:
+        set_profile_handler(application, TypeHandler(Update, count_profiled_update))
+    session["job"] = application.job_queue.run_once(finish_profile_job, seconds, name="profile")
+    application.bot_data["profile"] = session
+    session["profiler"].start()
+    what = f"{updates} обновлений" if updates else f"{seconds:g} с"
+    await update.message.reply_text(f"🔬 Профилирование: {what}. Отчёт придёт сюда.")
+
+async def count_profiled_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    session = context.application.bot_data.get("profile")
+    if session is None:
+        return
+    session["seen"] += 1
+    if session["seen"] == session["updates"]:
+        session["job"].schedule_removal()
+        await finish_profile(context.application)
+
+async def finish_profile_job(context: ContextTypes.DEFAULT_TYPE):
+    await finish_profile(context.application)
+
+async def finish_profile(application: Application):
+    session = application.bot_data.pop("profile", None)
+    if session is None:
+        return
+    if session["updates"]:
+        set_profile_handler(application, None)
+    profiler = session["profiler"]
+    profiler.stop()
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    caption = f"🔬 {profiler.seconds:.1f} с"
+    if session["updates"]:
+        caption += f", обновлений: {session['seen']}"
+    try:
+        await application.bot.send_document(
+            chat_id=session["chat_id"],
+            document=profiler.report(session["top"]).encode("utf-8"),
+            filename=f"profile_{stamp}.txt",
+            caption=caption
+        )
+        await application.bot.send_document(
+            chat_id=session["chat_id"],
+            document=profiler.collapsed(),
+            filename=f"profile_{stamp}.folded",
+            caption="Стеки для flamegraph.pl или speedscope.app"
+        )
+    except Exception as e:
+        logging.error(f"Отчёт профилирования не отправлен: {e}")
+
 # ==========================
 # Админ-панель
 # ==========================
@@ -463,117 +2435,704 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Панель администратора:", reply_markup=reply_markup)
 
+@instrumented("admin_button")
 async def admin_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    if update.effective_user.id != YOUR_USER_ID:
+        return
     data = query.data
 
-    known_users = context.application.bot_data["known_users"]
-    active_users = context.application.bot_data["active_users"]
-    birthdays = context.application.bot_data["birthdays"]
+    users = context.application.bot_data["users"]
 
     if data == 'admin_broadcast':
         await query.message.reply_text("Отправь сообщение для рассылки (текст или фото с подписью).")
         context.user_data['admin_mode'] = 'broadcast'
     elif data == 'admin_stats':
-        total = len(known_users)
-        active = len(active_users)
-        median = get_median_age(active_users, birthdays)
+        total = users.known_count
+        active = users.active_count
+        if "shards" in context.application.bot_data:
+            total, active = context.application.bot_data["storage"].count_users()
+        median = get_median_age(users, context.application.bot_data["age_index"])
         await query.message.reply_text(
             f"👥 Всего пользователей: {total}\n"
             f"✅ Активных (ввели дату): {active}\n"
-            f"🔢 Медианный возраст: {median} лет"
+            f"🔢 Медианный возраст: {median} лет\n"
+            f"{image_cache.stats_text()}"
         )
     elif data == 'admin_export':
-        with open("export_users.txt", "w", encoding="utf-8") as f:
-            for uid in known_users:
-                f.write(f"{uid}\n")
-        await query.message.reply_document(document=open("export_users.txt", "rb"))
-        os.remove("export_users.txt")
-
+        keyboard = [
+            [InlineKeyboardButton(f"{fmt.upper()}.gz", callback_data=f'admin_export:{fmt}:gz') for fmt in EXPORT_FORMATS],
+            [InlineKeyboardButton(fmt.upper(), callback_data=f'admin_export:{fmt}:plain') for fmt in EXPORT_FORMATS],
+        ]
+        await query.message.reply_text("Формат выгрузки:", reply_markup=InlineKeyboardMarkup(keyboard))
+    elif data.startswith('admin_export:'):
+        _, fmt, compression = data.split(":")
+        if fmt in EXPORT_FORMATS:
+            # Выгрузка идёт фоном: миллион строк не должен останавливать бота
+            # и не держит его остановку: BotApplication.stop её отменяет
+            track_task(context.application, context.application.create_task(
+                send_export(context.application, query.message.chat_id, fmt, compression == "gz")
+            ))
+
+@instrumented("admin_message_handler")
 async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != YOUR_USER_ID:
         return
     if context.user_data.get('admin_mode') != 'broadcast':
         return
 
+    message = update.message
+    if message.media_group_id:
+        collect_broadcast_album(context, message)
+        return
+
     context.user_data['admin_mode'] = None
-    known_users = context.application.bot_data["known_users"]
+    await launch_broadcast(context.application, broadcast_payload(message), message.chat_id)
+
+def collect_broadcast_album(context: ContextTypes.DEFAULT_TYPE, message):
+    # Альбом приходит отдельными сообщениями с общим media_group_id:
+    # собираем их и запускаем рассылку чуть позже первой части
+    payload = broadcast_payload(message)
+    if payload["kind"] not in ALBUM_MEDIA:
+        return
+    album = context.user_data.get("broadcast_album")
+    if album is None or album["group_id"] != message.media_group_id:
+        album = {"group_id": message.media_group_id, "chat_id": message.chat_id, "media": []}
+        context.user_data["broadcast_album"] = album
+        context.job_queue.run_once(
+            flush_broadcast_album,
+            ALBUM_WAIT_SECONDS,
+            data=album,
+            chat_id=message.chat_id,
+            user_id=YOUR_USER_ID
+        )
+    album["media"].append({"kind": payload["kind"], "file_id": payload["file_id"], "caption": message.caption})
+
+async def flush_broadcast_album(context: ContextTypes.DEFAULT_TYPE):
+    album = context.job.data
+    context.user_data.pop("broadcast_album", None)
+    context.user_data['admin_mode'] = None
+    await launch_broadcast(context.application, {"kind": "album", "media": album["media"]}, album["chat_id"])
+
+async def launch_broadcast(application: Application, payload, chat_id):
+    shards = application.bot_data.get("shards")
+    if shards is not None:
+        # Каждый шард рассылает своим пользователям
+        shards.send_all(("broadcast", payload, chat_id))
+        return
+    await begin_broadcast(application, payload, chat_id)
 
-    if update.message.photo:
-        caption = update.message.caption or "Сообщение от бота"
-        photo_file = await update.message.photo[-1].get_file()
-        photo_path = "admin_broadcast.jpg"
-        await photo_file.download_to_drive(photo_path)
+async def begin_broadcast(application: Application, payload, chat_id):
+    if os.path.exists(BROADCAST_STATE_FILE):
+        await application.bot.send_message(chat_id=chat_id, text="⏳ Предыдущая рассылка ещё не закончилась.")
+        return
+
+    user_ids = sorted(application.bot_data["users"].known_ids())
+    status = await application.bot.send_message(chat_id=chat_id, text=f"📨 Рассылка идёт: 0/{len(user_ids)}")
+    broadcast = Broadcast.create(application, user_ids, payload, status_message=status)
+    run_broadcast(application, broadcast)
 
+# ==========================
+# Webhook
+# ==========================
+class WebhookServer:
+    # Минимальный HTTP/1.1 сервер на asyncio: POST WEBHOOK_PATH принимает
+    # обновления от Telegram, GET /health — проверка живости для платформы.
+    # С path=None это сервер метрик: GET /health отдаёт состояние очереди,
+    # GET /metrics — метрики. Наружу смотрит только webhook.
+    def __init__(self, application: Application, host: str, port: int, path: str, secret: str):
+        self.app = application
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.server = None
+        self.accepted = 0
+        self.rejected = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
         try:
-            with open(photo_path, "rb") as f:
-                photo_data = f.read()
-
-            success = failed = 0
-            for uid in list(known_users):
-                try:
-                    await context.bot.send_photo(chat_id=uid, photo=photo_data, caption=caption)
-                    success += 1
-                except:
-                    known_users.discard(uid)
-                    failed += 1
-            context.application.bot_data["known_users"] = known_users
-            save_all(known_users, context.application.bot_data["birthdays"], context.application.bot_data["active_users"])
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), timeout=75)
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", "0"))
+                if length > WEBHOOK_MAX_BODY:
+                    await self.respond(writer, 413, "too large", close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                status, text, extra = self.route(method, target.split("?", 1)[0], headers, body)
+                close = headers.get("connection", "").lower() == "close"
+                await self.respond(writer, status, text, extra, close=close)
+                if close:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
         finally:
-            if os.path.exists(photo_path):
-                try:
-                    os.remove(photo_path)
-                except:
-                    pass
+            writer.close()
+
+    def route(self, method, path, headers, body):
+        if self.path is None:
+            return self.route_metrics(method, path)
+        if method == "GET" and path == "/health":
+            # Без подробностей: очередь и счётчики — на сервере метрик
+            return 200, '{"status": "ok"}', {"Content-Type": "application/json"}
+        if path != self.path:
+            return 404, "not found", {}
+        if method != "POST":
+            return 405, "method not allowed", {}
+        if not self.secret or not hmac.compare_digest(
+            headers.get("x-telegram-bot-api-secret-token", ""), self.secret
+        ):
+            return 403, "forbidden", {}
 
-        await update.message.reply_text(f"🖼️ Отправлено: {success}, ошибок: {failed}")
+        try:
+            update = Update.de_json(json.loads(body), self.app.bot)
+        except Exception:
+            return 400, "bad update", {}
+        try:
+            self.app.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Очередь пополняется быстрее, чем обработчики принимают обновления
+            # (см. IntakeQueue). Telegram повторит доставку сам
+            self.rejected += 1
+            return 503, "busy", {"Retry-After": "1"}
+        self.accepted += 1
+        return 200, "ok", {}
+
+    def route_metrics(self, method, path):
+        if method == "GET" and path == "/health":
+            queue = self.app.update_queue
+            return 200, json.dumps({
+                "status": "ok",
+                "queue": queue.qsize(),
+                "queue_max": queue.maxsize,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+            }), {"Content-Type": "application/json"}
+        if method == "GET" and path == "/metrics":
+            return 200, metrics.render(), {"Content-Type": "text/plain; version=0.0.4"}
+        return 404, "not found", {}
+
+    async def respond(self, writer, status, text, extra=None, close=False):
+        reasons = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                   405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+        payload = text.encode("utf-8")
+        head = [f"HTTP/1.1 {status} {reasons.get(status, '')}", f"Content-Length: {len(payload)}"]
+        head.extend(f"{k}: {v}" for k, v in (extra or {}).items())
+        if "Content-Type" not in (extra or {}):
+            head.append("Content-Type: text/plain; charset=utf-8")
+        head.append("Connection: close" if close else "Connection: keep-alive")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+        await writer.drain()
+
+def stop_on_signals():
+    # Event, который взводится по SIGINT/SIGTERM
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    return stop_event
+
+async def start_metrics_server(app: Application):
+    server = WebhookServer(app, METRICS_HOST, METRICS_PORT, None, "")
+    await server.start()
+    return server
+
+def check_webhook_secret():
+    if not WEBHOOK_SECRET and not WEBHOOK_URL:
+        raise ValueError("❗ Для BOT_MODE=webhook без WEBHOOK_URL задай WEBHOOK_SECRET")
+
+async def start_webhook_server(app: Application):
+    check_webhook_secret()
+    # Адрес регистрирует сам бот — секрет можно придумать на этот запуск
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = WebhookServer(app, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, secret)
+    await server.start()
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            allowed_updates=Update.ALL_TYPES
+        )
+    logging.info(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    return server
+
+async def run_webhook(app: Application):
+    stop_event = stop_on_signals()
+
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+
+    server = await start_webhook_server(app)
+
+    try:
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        await app.stop()
+        await app.shutdown()
+        await on_shutdown(app)
+
+# ==========================
+# Шарды
+# ==========================
+class Shards:
+    # Связь процесса-обработчика с остальными: свой номер и входящие очереди всех шардов
+    def __init__(self, index: int, inboxes):
+        self.index = index
+        self.inboxes = inboxes
+        self.count = len(inboxes)
+        self.lock_fd = None
+
+    @property
+    def key(self):
+        return self.index, self.count
+
+    def send_all(self, message):
+        for inbox in self.inboxes:
+            inbox.put(message)
+
+    def try_lead(self) -> bool:
+        # Лидер — тот, кто держит flock на SCHEDULER_LOCK_FILE. Блокировку снимает
+        # ОС при смерти процесса, и следующий sync_shard другого шарда её подхватит.
+        if self.lock_fd is not None:
+            return False
+        fd = os.open(SCHEDULER_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self.lock_fd = fd
+        return True
+
+def shard_of(update: Update, count: int) -> int:
+    user = update.effective_user
+    return user.id % count if user else 0
+
+async def route_updates(update_queue, inboxes):
+    # Обновления по одному в очередь своего шарда: порядок одного пользователя сохраняется
+    loop = asyncio.get_running_loop()
+    while True:
+        update = await update_queue.get()
+        inbox = inboxes[shard_of(update, len(inboxes))]
+        message = ("update", update.to_dict())
+        try:
+            inbox.put_nowait(message)
+        except queue.Full:
+            await loop.run_in_executor(None, inbox.put, message)
+
+async def fan_out_weekly(context: ContextTypes.DEFAULT_TYPE):
+    context.application.bot_data["shards"].send_all(("weekly", context.job.data))
+
+async def fan_out_birthdays(context: ContextTypes.DEFAULT_TYPE):
+    context.application.bot_data["shards"].send_all(("birthday",))
+
+async def sync_shard(context: ContextTypes.DEFAULT_TYPE):
+    data = context.application.bot_data
+    shards = data["shards"]
+    storage = data["storage"]
+    data["age_index"].ensure_current(data["users"])
+    storage.publish_ages(shards.index, data["age_index"].counts)
+    data["age_index"].shared = storage.shard_ages(shards.count, shards.index)
+    if shards.try_lead():
+        logging.info(f"Шард {shards.index}: веду расписание рассылок")
+        schedule_birthday_job(context.job_queue, fan_out_birthdays)
+        schedule_weekly_jobs(context.job_queue, fan_out_weekly)
+        # Отметки о рассылках общие (meta), так что пропущенное, пока лидера
+        # не было, догоняется один раз
+        catch_up_jobs(context.application, fan_out_weekly, fan_out_birthdays)
+
+def configure_shard(index: int, count: int):
+    # Файлы рассылки, лимиты и пул рендеринга — свои у каждого шарда
+    global BROADCAST_STATE_FILE, BROADCAST_QUEUE_FILE, BROADCAST_RATE, SEND_RATE, METRICS_PORT, render_pool
+    BROADCAST_STATE_FILE = f"broadcast_state.{index}.json"
+    BROADCAST_QUEUE_FILE = f"broadcast_queue.{index}.json"
+    BROADCAST_RATE = BROADCAST_RATE / count
+    SEND_RATE = SEND_RATE / count
+    if METRICS_PORT:
+        METRICS_PORT += index + 1
+    render_pool = RenderPool(RENDER_EXECUTOR, max(1, RENDER_WORKERS // count), RENDER_QUEUE_SIZE)
+
+def run_shard(index: int, inboxes, base_url=None):
+    # Точка входа процесса-обработчика. Останавливается по None из очереди;
+    # сигналы получает вся группа процессов, но гасит шарды главный процесс.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    configure_shard(index, len(inboxes))
+    asyncio.run(serve_shard(Shards(index, inboxes), base_url))
+
+async def serve_shard(shards: Shards, base_url=None):
+    app = build_application(open_storage(), base_url, shards)
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    # Первая синхронизация сразу: run_repeating с first=0 APScheduler пропускает
+    sync = app.job_queue.run_repeating(sync_shard, SHARD_SYNC_SECONDS, name="shard_sync")
+    await sync.run(app)
+
+    loop = asyncio.get_running_loop()
+    inbox = shards.inboxes[shards.index]
+    try:
+        while True:
+            message = await loop.run_in_executor(None, inbox.get)
+            if message is None:
+                break
+            kind = message[0]
+            if kind == "update":
+                await app.update_queue.put(Update.de_json(message[1], app.bot))
+            elif kind == "weekly":
+                app.job_queue.run_once(send_weekly_bucket, 0, data=message[1], name=f"weekly_bucket_{message[1]}")
+            elif kind == "birthday":
+                app.job_queue.run_once(send_birthday_greetings, 0, name="birthday_sweep")
+            elif kind == "broadcast":
+                await begin_broadcast(app, message[1], message[2])
+    finally:
+        await app.stop()
+        await app.shutdown()
+        await on_shutdown(app)
+
+def run_sharded(base_url=None):
+    if STORAGE_BACKEND != "sqlite":
+        raise ValueError("❗ Для BOT_WORKERS > 1 нужно STORAGE_BACKEND=sqlite")
+    # Схема и импорт из JSON — до старта шардов, чтобы они не делали это одновременно
+    open_storage().close()
+    ctx = multiprocessing.get_context("spawn")
+    inboxes = [ctx.Queue(SHARD_QUEUE_SIZE) for _ in range(BOT_WORKERS)]
+    asyncio.run(run_front(ctx, inboxes, base_url))
+
+async def run_front(ctx, inboxes, base_url=None):
+    # Главный процесс только принимает обновления (polling или webhook)
+    # и раскладывает их по шардам; порядок обновлений одного пользователя сохраняется
+    def spawn(index):
+        process = ctx.Process(target=run_shard, args=(index, inboxes, base_url), name=f"shard-{index}")
+        process.start()
+        return process
+
+    workers = [spawn(i) for i in range(len(inboxes))]
+    stop_event = stop_on_signals()
+
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(make_request("api"))
+        .get_updates_request(make_request("updates"))
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None).update_queue(asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE))
+    app = builder.build()
+    await app.initialize()
+
+    server = None
+    if BOT_MODE == "webhook":
+        server = await start_webhook_server(app)
     else:
-        text = update.message.text
-        success = failed = 0
-        for uid in list(known_users):
-            try:
-                await context.bot.send_message(chat_id=uid, text=text)
-                success += 1
-            except:
-                known_users.discard(uid)
-                failed += 1
-        context.application.bot_data["known_users"] = known_users
-        save_all(known_users, context.application.bot_data["birthdays"], context.application.bot_data["active_users"])
-        await update.message.reply_text(f"✅ Отправлено: {success}, ошибок: {failed}")
+        await app.updater.start_polling()
+    # Шарды слушают METRICS_PORT + 1 + номер, главный процесс — сам METRICS_PORT
+    metrics_server = await start_metrics_server(app) if METRICS_PORT else None
+
+    async def supervise():
+        while True:
+            await asyncio.sleep(1)
+            for i, process in enumerate(workers):
+                if not process.is_alive():
+                    logging.error(f"Шард {i} завершился (код {process.exitcode}), перезапускаю")
+                    workers[i] = spawn(i)
+
+    tasks = [asyncio.create_task(route_updates(app.update_queue, inboxes)), asyncio.create_task(supervise())]
+    logging.info(f"Запущено шардов: {len(workers)}")
+    try:
+        await stop_event.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if server is not None:
+            await server.stop()
+        else:
+            await app.updater.stop()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        for inbox in inboxes:
+            inbox.put(None)
+        for process in workers:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.kill()
+        await app.shutdown()
 
 # ==========================
 # Запуск
 # ==========================
-def main():
-    if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
-        raise ValueError("❗ Замени BOT_TOKEN на токен от @BotFather")
-    if YOUR_USER_ID == 123456789:
-        raise ValueError("❗ Замени YOUR_USER_ID на свой ID из @userinfobot")
-
-    known_users, user_birthdays, active_users = load_data()
+async def on_startup(app: Application):
+    render_pool.start()
+
+    if METRICS_PORT:
+        app.bot_data["metrics_server"] = await start_metrics_server(app)
+
+    state = load_broadcast_state()
+    if state:
+        logging.info(f"Продолжаю рассылку с {state['offset']}/{state['total']}")
+        run_broadcast(app, Broadcast(app, state))
+
+async def warm_up(context: ContextTypes.DEFAULT_TYPE):
+    # Всё, что не нужно для первого ответа, — уже после старта опроса:
+    # индекс возрастов, пропущенные рассылки (у шардов их догоняет лидер,
+    # см. sync_shard), процессы рендеринга
+    data = context.application.bot_data
+    data["age_index"].ensure_current(data["users"])
+    if "shards" not in data:
+        catch_up_jobs(context.application)
+    resume_waves(context.application)
+    await render_pool.warm()
+
+async def on_shutdown(app: Application):
+    render_pool.shutdown()
+    if "metrics_server" in app.bot_data:
+        await app.bot_data.pop("metrics_server").stop()
+    app.bot_data["reaper"].flush()
+    await save_snapshot(app)
+    app.bot_data["storage"].close()
+
+def track_task(application: Application, task):
+    # Долгие фоновые задачи, которые BotApplication.stop отменяет, а не ждёт
+    tasks = application.bot_data.setdefault("long_tasks", set())
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+async def cancel_long_tasks(application: Application):
+    tasks = list(application.bot_data.get("long_tasks", ()))
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+class BotApplication(Application):
+    # Application.stop ждёт все задачи create_task, а рассылка может идти часами:
+    # остановка висела бы до SIGKILL, и on_shutdown (снимок, очистка, закрытие базы)
+    # не выполнился бы. post_stop вызывается уже после stop, поэтому отмена — здесь.
+    # Смещение рассылки на диске, после запуска она продолжится с него.
+    async def stop(self):
+        await cancel_long_tasks(self)
+        await super().stop()
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Обновления разных пользователей обрабатываются параллельно, одного — строго
+    # по порядку (ввод даты и сразу «Моя статистика» видят уже сохранённую дату).
+    # Принято в работу не больше limit + pending обновлений. Семафор PTB этого
+    # не обеспечивает: Application заводит задачу на каждое обновление, как только
+    # достал его из update_queue, и семафор ждут уже эти задачи. Поэтому место
+    # берёт сама очередь (IntakeQueue.get -> admit), а освобождает process_update.
+    # Выполняются одновременно не больше limit: слот берётся после очереди
+    # пользователя, поэтому его ждущие обновления слоты не занимают.
+    def __init__(self, limit: int, pending: int):
+        super().__init__(limit + pending)
+        self.limit = limit
+        self.running = 0
+        self.accepted = 0
+        self._intake = asyncio.Semaphore(limit + pending)
+        self._slots = asyncio.Semaphore(limit)
+        # user_id -> [asyncio.Lock, сколько его обновлений ждут или обрабатываются]
+        self._users = {}
+
+    async def admit(self):
+        await self._intake.acquire()
+
+    def release(self):
+        self._intake.release()
+
+    async def process_update(self, update, coroutine):
+        # Application вызывает его для каждого обновления, взятого из IntakeQueue
+        self.accepted += 1
+        try:
+            await super().process_update(update, coroutine)
+        finally:
+            self.accepted -= 1
+            self.release()
 
-    request = HTTPXRequest(
-        connect_timeout=20.0,
-        read_timeout=20.0,
-        write_timeout=20.0,
-        pool_timeout=20.0
+    async def _run(self, coroutine):
+        async with self._slots:
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await self._run(coroutine)
+            return
+        entry = self._users.get(user.id)
+        if entry is None:
+            entry = self._users[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[user.id]
+
+    def waiting(self):
+        # Обновления, стоящие в очереди за предыдущими обновлениями своего пользователя
+        return sum(n for _, n in self._users.values()) - len(self._users)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class IntakeQueue(asyncio.Queue):
+    # update_queue при параллельной обработке: следующее обновление отдаётся
+    # Application, только когда процессор готов его принять. До тех пор обновления
+    # ждут здесь, а заполненная очередь останавливает опрос (put ждёт) или
+    # заставляет webhook отвечать 503.
+    def __init__(self, processor: PerUserUpdateProcessor, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.processor = processor
+
+    async def get(self):
+        await self.processor.admit()
+        try:
+            return await super().get()
+        except BaseException:
+            self.processor.release()
+            raise
+
+def check_http_version():
+    # Без h2 httpx падает только на первом запросе, и непонятно почему
+    if HTTP_VERSION == "2" and importlib.util.find_spec("h2") is None:
+        raise ValueError("❗ Для HTTP_VERSION=2 установи python-telegram-bot[http2]")
+
+def make_request(pool: str):
+    # "updates" — только getUpdates: одно соединение, к read_timeout PTB сам прибавляет
+    # время long polling. "api" — все остальные вызовы Bot API.
+    updates = pool == "updates"
+    if not updates:
+        check_http_version()
+    request = InstrumentedRequest(
+        pool=pool,
+        connection_pool_size=1 if updates else HTTP_POOL_SIZE,
+        keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+        http_version="1.1" if updates else HTTP_VERSION,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        write_timeout=HTTP_WRITE_TIMEOUT,
+        media_write_timeout=HTTP_MEDIA_WRITE_TIMEOUT,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+    )
+    metrics.gauge(lambda: [
+        ("bot_http_pool_in_use", request.pool_labels, request.in_use),
+        ("bot_http_pool_size", request.pool_labels, request.pool_size),
+    ])
+    return request
+
+def build_application(storage, base_url=None, shards=None) -> Application:
+    # base_url — другой адрес Bot API (локальный сервер, нагрузочный тест).
+    # shards — процесс-обработчик: свои пользователи, обновления приходят от главного процесса
+    if shards is not None:
+        users = storage.load(shards.key)
+    else:
+        users = storage.load()
+
+    builder = (
+        Application.builder()
+        .application_class(BotApplication)
+        .token(BOT_TOKEN)
+        .request(make_request("api"))
+        .get_updates_request(make_request("updates"))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if shards is not None:
+        builder = builder.updater(None)
+    # Webhook отвечает 503, когда очередь полна. При опросе и у шардов хватает
+    # одной пачки getUpdates (до 100 обновлений): дальше ждёт тот, кто кладёт
+    queue_size = WEBHOOK_QUEUE_SIZE if BOT_MODE == "webhook" and shards is None else 100
+    if UPDATE_CONCURRENCY > 1:
+        processor = PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_PENDING)
+        builder = builder.concurrent_updates(processor).update_queue(IntakeQueue(processor, queue_size))
+        metrics.gauge(lambda: [
+            ("bot_updates_accepted", (), processor.accepted),
+            ("bot_updates_running", (), processor.running),
+            ("bot_updates_waiting_user", (), processor.waiting()),
+        ])
+    elif BOT_MODE == "webhook" and shards is None:
+        builder = builder.update_queue(asyncio.Queue(maxsize=queue_size))
+    app = builder.build()
+
+    app.bot_data["storage"] = storage
+    app.bot_data["users"] = users
+
+    # Индекс возрастов строится в warm_up, уже после старта опроса
+    # (или при первом запросе статистики, если тот случится раньше)
+    app.bot_data["age_index"] = AgeIndex()
+
+    reaper = Reaper(app.bot_data)
+    app.bot_data["reaper"] = reaper
+    app.job_queue.run_repeating(reap_dead_users, REAPER_INTERVAL_SECONDS, name="reaper")
+    if SNAPSHOT_INTERVAL_SECONDS:
+        app.job_queue.run_repeating(
+            snapshot_job, SNAPSHOT_INTERVAL_SECONDS, first=SNAPSHOT_INTERVAL_SECONDS, name="snapshot"
+        )
+    # JobQueue запускается после начала опроса, так что это первое, что он выполнит
+    app.job_queue.run_once(warm_up, 0, name="warm_up")
+    metrics.gauge(lambda: [("bot_users_reap_pending", (), len(reaper.pending))])
+    if shards is not None:
+        # Расписание заведёт тот шард, который станет лидером (см. sync_shard)
+        app.bot_data["shards"] = shards
+    else:
+        schedule_birthday_job(app.job_queue)
+        schedule_weekly_jobs(app.job_queue)
+    app.job_queue.run_daily(
+        rollover_age_index,
+        time=datetime.strptime("00:00:05", "%H:%M:%S").time(),
+        name="age_index_rollover"
     )
-
-    app = Application.builder().token(BOT_TOKEN).request(request).get_updates_request(request).build()
-
-    app.bot_data["known_users"] = known_users
-    app.bot_data["birthdays"] = user_birthdays
-    app.bot_data["active_users"] = active_users
 
     # ✅ КРИТИЧЕСКИ ВАЖНЫЙ ПОРЯДОК ОБРАБОТЧИКОВ
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("stop", stop))
     app.add_handler(CommandHandler("time_units", time_units))
     app.add_handler(CommandHandler("admin", admin_panel))
+    app.add_handler(CommandHandler("profile", profile_command))
 
     app.add_handler(MessageHandler(filters.TEXT & filters.User(YOUR_USER_ID), admin_message_handler))
-    app.add_handler(MessageHandler(filters.PHOTO & filters.User(YOUR_USER_ID), admin_message_handler))
+    app.add_handler(MessageHandler(
+        (filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.Document.ALL | filters.AUDIO | filters.VOICE)
+        & filters.User(YOUR_USER_ID),
+        admin_message_handler
+    ))
 
     app.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND & ~filters.User(YOUR_USER_ID),
@@ -581,9 +3140,31 @@ def main():
     ))
 
     app.add_handler(CallbackQueryHandler(admin_button))
+    return app
+
+def main():
+    if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
+        raise ValueError("❗ Замени BOT_TOKEN на токен от @BotFather")
+    if YOUR_USER_ID == 123456789:
+        raise ValueError("❗ Замени YOUR_USER_ID на свой ID из @userinfobot")
+    if BOT_MODE == "webhook":
+        check_webhook_secret()
+    check_image_format()
+    if EXPORT_PART_BYTES < EXPORT_MIN_PART_BYTES:
+        raise ValueError(f"❗ EXPORT_PART_BYTES должен быть не меньше {EXPORT_MIN_PART_BYTES}")
+
+    if BOT_WORKERS > 1:
+        print(f"✅ Бот запущен: {BOT_WORKERS} процессов-обработчиков.")
+        run_sharded()
+        return
+
+    app = build_application(open_storage())
 
     print("✅ Бот запущен. Команды работают. Зелёные клетки. Разбивка по 5 годам.")
-    app.run_polling()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
 
 # ==========================
 # ОДИНОЧНЫЙ ЗАПУСК — БЕЗ ЦИКЛА
@@ -0,0 +1,435 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime, timedelta, date
+from email.parser import BytesParser
+from urllib.parse import parse_qsl
+
+# Бот работает против локального сервера, реальный токен не нужен
+TOKEN = "123456:loadtest"
+ADMIN_ID = 1
+os.environ.setdefault("BOT_TOKEN", TOKEN)
+os.environ.setdefault("YOUR_USER_ID", str(ADMIN_ID))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot
+
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendMediaGroup", "sendDocument", "sendVideo",
+                "sendAnimation", "sendAudio", "sendVoice"}
+BROADCAST_TEXT = "Нагрузочный тест: рассылка"
+BOT_USER = {"id": 999, "is_bot": True, "first_name": "LoadBot", "username": "loadtest_bot"}
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+# ==========================
+# Поддельный Bot API
+# ==========================
+class FakeBotApi:
+    # Отвечает на getUpdates/send*/edit* как Telegram, с задержкой и ошибками 429/403
+    def __init__(self, latency=(0.02, 0.08), rate_429=0.0, retry_after=1, blocked=()):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.blocked = set(blocked)
+        self.updates = []
+        self.update_id = 0
+        self.new_updates = asyncio.Event()
+        self.message_id = 0
+        self.file_id = 0
+        self.calls = {}
+        self.on_send = None
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def push(self, update: dict):
+        self.update_id += 1
+        update["update_id"] = self.update_id
+        self.updates.append(update)
+        self.new_updates.set()
+
+    def count(self, method, outcome):
+        key = f"{method}:{outcome}"
+        self.calls[key] = self.calls.get(key, 0) + 1
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+
+                method = target.rsplit("/", 1)[-1]
+                status, payload = await self.call(method, self.parse(headers.get("content-type", ""), body))
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def parse(content_type, body):
+        # Параметры приходят формой; с файлом — multipart, сам файл не нужен
+        if content_type.startswith("multipart/"):
+            message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            params = {}
+            for part in message.get_payload():
+                name = part.get_param("name", header="content-disposition")
+                if part.get_filename() is None:
+                    params[name] = part.get_payload(decode=True).decode("utf-8")
+                else:
+                    params[name] = "<file>"
+            return params
+        return dict(parse_qsl(body.decode("utf-8")))
+
+    def message(self, chat_id, **fields):
+        self.message_id += 1
+        return {"message_id": self.message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER, **fields}
+
+    async def call(self, method, params):
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self.get_updates(params)}
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if method not in SEND_METHODS and not method.startswith("edit"):
+            return 200, {"ok": True, "result": True}
+
+        await asyncio.sleep(random.uniform(*self.latency))
+        chat_id = int(params.get("chat_id", 0))
+        if chat_id in self.blocked:
+            self.count(method, "403")
+            outcome = 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        elif self.rate_429 and random.random() < self.rate_429:
+            self.count(method, "429")
+            outcome = 429, {"ok": False, "error_code": 429,
+                            "description": f"Too Many Requests: retry after {self.retry_after}",
+                            "parameters": {"retry_after": self.retry_after}}
+        else:
+            self.count(method, "ok")
+            if method == "sendPhoto":
+                self.file_id += 1
+                photo = {"file_id": params["photo"] if params["photo"] != "<file>" else f"photo{self.file_id}",
+                         "file_unique_id": f"u{self.file_id}", "width": bot.IMAGE_W, "height": bot.IMAGE_H}
+                result = self.message(chat_id, photo=[photo])
+            elif method == "sendMediaGroup":
+                result = [self.message(chat_id) for _ in json.loads(params.get("media", "[]"))]
+            else:
+                result = self.message(chat_id, text=params.get("text", ""))
+            outcome = 200, {"ok": True, "result": result}
+
+        if method in SEND_METHODS and self.on_send and params.get("text") != BROADCAST_TEXT:
+            self.on_send(chat_id, outcome[0] == 200)
+        return outcome
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset", 0))
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), float(params.get("timeout", 0)))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get("limit", 100))]
+
+# ==========================
+# Синтетическая нагрузка
+# ==========================
+def user_json(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+def message_update(user_id, text):
+    message = {"message_id": random.randrange(1, 1 << 30), "date": int(time.time()),
+               "chat": {"id": user_id, "type": "private"}, "from": user_json(user_id), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"message": message}
+
+def callback_update(user_id, data):
+    return {"callback_query": {
+        "id": str(random.randrange(1, 1 << 30)), "from": user_json(user_id), "chat_instance": "loadtest",
+        "data": data, "message": {"message_id": 1, "date": int(time.time()),
+                                  "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "-"},
+    }}
+
+def random_birth_date(rnd):
+    return datetime(1950, 1, 1) + timedelta(days=rnd.randrange(365 * 60))
+
+class Replay:
+    # Шлёт обновления с заданной частотой; у каждого пользователя не больше одного
+    # обновления в обработке, поэтому ответы однозначно относятся к своему обновлению
+    MIX = (("start", 0.2), ("date", 0.3), ("stats", 0.4), ("units", 0.1))
+    STUCK_SECONDS = 30
+
+    def __init__(self, api: FakeBotApi, user_ids, has_birthday, seed=1):
+        self.api = api
+        self.rnd = random.Random(seed)
+        self.idle = list(user_ids)
+        self.has_birthday = has_birthday
+        self.pending = {}
+        self.first_reply = []
+        self.complete = []
+        self.sent = 0
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        api.on_send = self.on_send
+
+    def pick(self):
+        kinds, weights = zip(*self.MIX)
+        return self.rnd.choices(kinds, weights)[0]
+
+    def dispatch(self):
+        if not self.idle:
+            self.skipped += 1
+            return
+        user_id = self.idle.pop(self.rnd.randrange(len(self.idle)))
+        kind = self.pick()
+        if kind == "start":
+            text, expected = "/start", 1
+        elif kind == "date":
+            text, expected = random_birth_date(self.rnd).strftime("%d.%m.%Y"), 2
+            self.has_birthday.add(user_id)
+        elif kind == "stats":
+            text, expected = "📊 Моя статистика", 2 if user_id in self.has_birthday else 1
+        else:
+            text, expected = "🕒 Мои единицы времени", 1
+        self.pending[user_id] = [time.perf_counter(), expected, None]
+        self.api.push(message_update(user_id, text))
+        self.sent += 1
+
+    def on_send(self, chat_id, ok):
+        entry = self.pending.get(chat_id)
+        if entry is None:
+            return
+        now = time.perf_counter()
+        if entry[2] is None:
+            entry[2] = now
+            self.first_reply.append(now - entry[0])
+        entry[1] -= 1
+        if not ok:
+            # Ошибка отправки прерывает обработчик — остальных ответов не будет
+            self.failed += 1
+        elif entry[1] > 0:
+            return
+        else:
+            self.complete.append(now - entry[0])
+            self.done += 1
+        del self.pending[chat_id]
+        self.idle.append(chat_id)
+
+    def reap_stuck(self):
+        now = time.perf_counter()
+        for chat_id, entry in list(self.pending.items()):
+            if now - entry[0] > self.STUCK_SECONDS:
+                self.failed += 1
+                del self.pending[chat_id]
+                self.idle.append(chat_id)
+
+    async def run(self, rate, duration, on_tick=None):
+        started = time.perf_counter()
+        n = 0
+        while True:
+            elapsed = time.perf_counter() - started
+            if elapsed >= duration:
+                break
+            due = int(elapsed * rate)
+            while n < due:
+                self.dispatch()
+                n += 1
+            if on_tick:
+                on_tick(elapsed)
+            self.reap_stuck()
+            await asyncio.sleep(0.005)
+        # Даём дообработать то, что уже отправлено
+        deadline = time.perf_counter() + self.STUCK_SECONDS
+        while self.pending and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        self.reap_stuck()
+        return time.perf_counter() - started
+
+    def summary(self, wall):
+        return {
+            "updates_sent": self.sent,
+            "updates_done": self.done,
+            "updates_failed": self.failed,
+            "updates_skipped": self.skipped,
+            "updates_per_s": self.done / wall if wall else 0,
+            "first_reply_p50_ms": (percentile(self.first_reply, 0.5) or 0) * 1000,
+            "first_reply_p99_ms": (percentile(self.first_reply, 0.99) or 0) * 1000,
+            "complete_p50_ms": (percentile(self.complete, 0.5) or 0) * 1000,
+            "complete_p99_ms": (percentile(self.complete, 0.99) or 0) * 1000,
+        }
+
+# ==========================
+# Сценарий
+# ==========================
+def seed_storage(users: int, blocked_share: float, seed=7):
+    rnd = random.Random(seed)
+    user_ids = list(range(1_000_000, 1_000_000 + users))
+    birthdays = {uid: random_birth_date(rnd) for uid in user_ids if rnd.random() < 0.8}
+    users = bot.UserStore()
+    for uid in user_ids:
+        users.set_known(uid)
+    for uid, birth_date in birthdays.items():
+        users.set_birth_date(uid, birth_date)
+        users.set_active(uid)
+    storage = bot.open_storage()
+    storage.save_users(user_ids, users)
+    blocked = {uid for uid in user_ids if rnd.random() < blocked_share}
+    return storage, user_ids, birthdays, blocked
+
+async def wait_broadcast(timeout):
+    started = time.perf_counter()
+    while not os.path.exists(bot.BROADCAST_STATE_FILE):
+        if time.perf_counter() - started > 5:
+            return None
+        await asyncio.sleep(0.01)
+    while os.path.exists(bot.BROADCAST_STATE_FILE):
+        if time.perf_counter() - started > timeout:
+            return None
+        await asyncio.sleep(0.05)
+    return time.perf_counter() - started
+
+async def run_weekly_wave(app, weekday):
+    finished = asyncio.Event()
+    timing = {}
+
+    async def wave(context):
+        started = time.perf_counter()
+        await bot.send_weekly_bucket(context)
+        timing["seconds"] = time.perf_counter() - started
+        finished.set()
+
+    size = len(app.bot_data["users"].weekday_ids(weekday))
+    app.job_queue.run_once(wave, 0, data=weekday, name="loadtest_weekly")
+    await finished.wait()
+    plan = bot.send_plans["weekly"]
+    return {"weekday": weekday, "users": size, "seconds": timing["seconds"],
+            "sends_per_s": size / timing["seconds"] if timing["seconds"] else 0,
+            "planned_seconds": plan.offsets[-1] if plan.offsets else 0, "max_slot_lag_s": plan.max_lag}
+
+async def scenario(args):
+    # Окно волны по умолчанию — час; здесь волна идёт сразу, если не задано иное
+    bot.SEND_WINDOW_MINUTES = args.send_window / 60
+    bot.SEND_RATE = args.send_rate
+    storage, user_ids, birthdays, blocked = seed_storage(args.users, args.blocked)
+    api = FakeBotApi((args.latency_min / 1000, args.latency_max / 1000), args.rate_429, args.retry_after, blocked)
+    await api.start()
+
+    app = bot.build_application(storage, base_url=api.base_url)
+    await app.initialize()
+    await bot.on_startup(app)
+    await app.updater.start_polling(timeout=args.poll_timeout)
+    await app.start()
+
+    results = {"config": vars(args)}
+    try:
+        # Заблокировавшие бота сами не пишут
+        replay = Replay(api, [uid for uid in user_ids if uid not in blocked][:args.active], set(birthdays))
+        broadcast = {}
+
+        def on_tick(elapsed):
+            if args.broadcast and not broadcast and elapsed >= args.duration / 2:
+                broadcast["started"] = time.perf_counter()
+                api.push(message_update(ADMIN_ID, "/admin"))
+                api.push(callback_update(ADMIN_ID, "admin_broadcast"))
+                api.push(message_update(ADMIN_ID, BROADCAST_TEXT))
+                broadcast["task"] = asyncio.ensure_future(wait_broadcast(args.timeout))
+
+        wall = await replay.run(args.rate, args.duration, on_tick)
+        results["replay"] = replay.summary(wall)
+        print(f"replay: {json.dumps(results['replay'])}", flush=True)
+
+        if broadcast:
+            seconds = await broadcast["task"]
+            results["broadcast"] = {"users": len(user_ids), "seconds": seconds,
+                                    "sends_per_s": len(user_ids) / seconds if seconds else None}
+            print(f"broadcast: {json.dumps(results['broadcast'])}", flush=True)
+
+        if args.weekly:
+            api.on_send = None
+            results["weekly"] = await run_weekly_wave(app, args.weekday)
+            print(f"weekly: {json.dumps(results['weekly'])}", flush=True)
+    finally:
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        await bot.on_shutdown(app)
+        await api.stop()
+
+    results["api_calls"] = dict(sorted(api.calls.items()))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота против локального Bot API")
+    parser.add_argument("--users", type=int, default=10000, help="пользователей в базе")
+    parser.add_argument("--active", type=int, default=2000, help="сколько из них пишут боту во время теста")
+    parser.add_argument("--rate", type=float, default=50, help="обновлений в секунду")
+    parser.add_argument("--duration", type=float, default=20, help="длительность потока обновлений, с")
+    parser.add_argument("--latency-min", type=float, default=20, help="задержка Bot API, мс")
+    parser.add_argument("--latency-max", type=float, default=80)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля отправок, получающих 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked", type=float, default=0.02, help="доля пользователей, заблокировавших бота (403)")
+    parser.add_argument("--no-broadcast", dest="broadcast", action="store_false")
+    parser.add_argument("--no-weekly", dest="weekly", action="store_false")
+    parser.add_argument("--weekday", type=int, default=date.today().weekday())
+    parser.add_argument("--send-window", type=float, default=0, help="окно еженедельной волны, с")
+    parser.add_argument("--send-rate", type=float, default=0, help="бюджет волны, сообщений/с (0 — без ограничения)")
+    parser.add_argument("--poll-timeout", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=600, help="предел ожидания рассылки, с")
+    parser.add_argument("--output", help="куда записать результаты (JSON)")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # Все файлы бота (база, состояние рассылки) — во временной папке
+        os.chdir(workdir)
+        try:
+            results = asyncio.run(scenario(args))
+        finally:
+            os.chdir(cwd)
+
+    print(f"api: {json.dumps(results['api_calls'])}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+# bot.py читает настройки из окружения при импорте; сеть тестам не нужна
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("YOUR_USER_ID", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Файлы бота (база, снимки, JSON) — во временной папке
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def today(monkeypatch):
+    # today(date(...)) — подменяет date.today() внутри bot
+    import bot
+
+    def set_today(day):
+        class FixedDate(bot.date):
+            @classmethod
+            def today(cls):
+                return day
+        monkeypatch.setattr(bot, "date", FixedDate)
+        return day
+    return set_today
+
+@pytest.fixture
+def offline_app():
+    # offline_app() — BotApplication, которому не нужна сеть: getMe не вызывается,
+    # а updater нет. initialize/start/stop/shutdown работают как обычно.
+    # configure(builder) -> builder — остальные настройки ApplicationBuilder
+    import bot
+    from telegram import User
+
+    def make(configure=None):
+        builder = (
+            bot.Application.builder()
+            .application_class(bot.BotApplication)
+            .token(os.environ["BOT_TOKEN"])
+            .updater(None)
+        )
+        app = (configure(builder) if configure else builder).build()
+        app.bot._bot_user = User(1, "bot", True, username="test_bot")
+        app.bot._initialized = True
+        return app
+    return make
+
+@pytest.fixture
+def random_users():
+    # random_users(n) — UserStore на n случайных пользователей и их записи
+    # {user_id: (known, active, birth_date)}; у 80% дата рождения есть
+    import bot
+
+    def make(n, seed=1):
+        rnd = random.Random(seed)
+        users = bot.UserStore()
+        expected = {}
+        for _ in range(n):
+            uid = rnd.randrange(1, 1 << 40)
+            bd = datetime(1940, 1, 1) + timedelta(days=rnd.randrange(30000)) if rnd.random() < 0.8 else None
+            users.set_known(uid)
+            users.set_birth_date(uid, bd)
+            users.set_active(uid, bd is not None)
+            expected[uid] = (True, bd is not None, bd)
+        return users, expected
+    return make
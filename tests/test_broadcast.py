@@ -0,0 +1,298 @@
+import asyncio
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram import PhotoSize
+from telegram.error import Forbidden
+from telegram.request import BaseRequest
+
+import bot
+
+class FakeBot:
+    # Отправленное по порядку; после hang_after сообщений зависает, как оборванная сеть
+    def __init__(self, dead=(), hang_after=None):
+        self.sent = []
+        self.edits = []
+        self.dead = set(dead)
+        self.hang_after = hang_after
+
+    async def send_message(self, chat_id, text):
+        if self.hang_after is not None and len(self.sent) >= self.hang_after:
+            await asyncio.Event().wait()
+        if chat_id in self.dead:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        self.sent.append(chat_id)
+
+    async def edit_message_text(self, chat_id, message_id, text):
+        self.edits.append(text)
+
+class FakeStorage:
+    def save_users(self, user_ids, users):
+        pass
+
+def make_app(fake_bot, user_ids):
+    users = bot.UserStore()
+    for uid in user_ids:
+        users.set_known(uid)
+    bot_data = {"users": users, "age_index": bot.AgeIndex(), "storage": FakeStorage()}
+    bot_data["reaper"] = bot.Reaper(bot_data)
+    return SimpleNamespace(bot=fake_bot, bot_data=bot_data)
+
+def test_token_bucket_keeps_the_rate():
+    async def main():
+        bucket = bot.TokenBucket(100, capacity=5)
+        started = time.monotonic()
+        for _ in range(25):
+            await bucket.acquire()
+        # 5 токенов из запаса сразу, остальные 20 — по одному в 1/100 с
+        assert 0.18 <= time.monotonic() - started < 0.5
+    asyncio.run(main())
+
+def test_token_bucket_waits_out_a_pause():
+    async def main():
+        bucket = bot.TokenBucket(100, capacity=5)
+        bucket.pause(0.1)
+        started = time.monotonic()
+        await bucket.acquire()
+        assert time.monotonic() - started >= 0.1
+    asyncio.run(main())
+
+def test_token_bucket_refills_from_the_end_of_a_pause():
+    async def main():
+        bucket = bot.TokenBucket(50, capacity=5)
+        bucket.pause(0.05)
+        started = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        # Запас за паузу не копится: после неё токены идут в темпе rate
+        assert time.monotonic() - started >= 0.05 + 4 / 50
+    asyncio.run(main())
+
+def test_broadcast_resumes_from_checkpoint(workdir, monkeypatch):
+    monkeypatch.setattr(bot, "BROADCAST_CHUNK", 10)
+    monkeypatch.setattr(bot, "BROADCAST_RATE", 10000)
+    user_ids = list(range(100, 145))
+    status = SimpleNamespace(chat_id=1, message_id=7)
+
+    async def interrupted():
+        app = make_app(FakeBot(dead=[103], hang_after=25), user_ids)
+        broadcast = bot.Broadcast.create(app, user_ids, {"kind": "text", "text": "привет"}, status_message=status)
+        task = asyncio.ensure_future(broadcast.run())
+        await asyncio.sleep(0.2)
+        # Остановка бота посреди третьего куска
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return app
+
+    first = asyncio.run(interrupted())
+    state = bot.load_broadcast_state()
+    assert state["offset"] == 20
+    assert state["user_ids"] == user_ids
+    assert (state["success"], state["dropped"]) == (19, 1)
+    # Недоступные удаляются пачкой позже, вместе с упавшими в других отправках
+    assert first.bot_data["reaper"].pending == {103}
+
+    async def resumed():
+        app = make_app(FakeBot(), user_ids)
+        await bot.Broadcast(app, state).run()
+        return app
+
+    second = asyncio.run(resumed())
+    # Повторяется не больше одного куска: оборванный начинается заново
+    assert second.bot.sent == user_ids[20:]
+    assert sorted(set(first.bot.sent + second.bot.sent)) == [u for u in user_ids if u != 103]
+    assert second.bot.edits[-1].startswith("✅ Рассылка завершена: 45/45")
+    assert not os.path.exists(bot.BROADCAST_STATE_FILE)
+    assert not os.path.exists(bot.BROADCAST_QUEUE_FILE)
+
+def test_failed_broadcast_is_set_aside(workdir):
+    user_ids = [1, 2, 3]
+    status = SimpleNamespace(chat_id=1, message_id=7)
+
+    async def main():
+        app = make_app(FakeBot(), user_ids)
+        broadcast = bot.Broadcast.create(app, user_ids, {"kind": "text", "text": "привет"}, status_message=status)
+
+        async def fail():
+            raise RuntimeError("диск заполнен")
+
+        broadcast.run = fail
+        await bot.start_broadcast(app, broadcast)
+        return app
+
+    app = asyncio.run(main())
+    # Следующий запуск её не подхватит, а файлы остались для разбора
+    assert bot.load_broadcast_state() is None
+    assert os.path.exists(bot.BROADCAST_STATE_FILE + ".failed")
+    assert os.path.exists(bot.BROADCAST_QUEUE_FILE + ".failed")
+    assert app.bot.edits[-1].startswith("❌ Рассылка прервана (диск заполнен)")
+
+def test_stop_cancels_a_running_broadcast(workdir, monkeypatch, offline_app):
+    monkeypatch.setattr(bot, "BROADCAST_CHUNK", 10)
+    monkeypatch.setattr(bot, "BROADCAST_RATE", 10000)
+    user_ids = list(range(100, 130))
+    status = SimpleNamespace(chat_id=1, message_id=7)
+
+    async def main():
+        app = offline_app()
+        await app.initialize()
+        await app.start()
+        fake = make_app(FakeBot(hang_after=15), user_ids)
+        bot.run_broadcast(app, bot.Broadcast.create(fake, user_ids, {"kind": "text", "text": "привет"}, status_message=status))
+        await asyncio.sleep(0.2)
+        # Application.stop сам по себе ждал бы зависшую рассылку
+        await asyncio.wait_for(app.stop(), 2)
+        await app.shutdown()
+        assert not app.bot_data["long_tasks"]
+
+    asyncio.run(main())
+    # Рассылка не считается упавшей: продолжится со второго куска
+    assert bot.load_broadcast_state()["offset"] == 10
+    assert not os.path.exists(bot.BROADCAST_STATE_FILE + ".failed")
+
+class ApiRecorder(BaseRequest):
+    # Bot API без сети: вызовы (метод, параметры) по порядку. После hang_after
+    # отправок пользователям зависает, как оборванная сеть
+    def __init__(self, hang_after=None):
+        self.calls = []
+        self.hang_after = hang_after
+
+    def sent(self):
+        return [(method, params) for method, params in self.calls if params.get("chat_id") != 1]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        name = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if self.hang_after is not None and params.get("chat_id") != 1 and len(self.sent()) >= self.hang_after:
+            await asyncio.Event().wait()
+        self.calls.append((name, params))
+        message = {"message_id": 7, "date": 0, "chat": {"id": params.get("chat_id", 1), "type": "private"}}
+        result = [message] if name == "sendMediaGroup" else message
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+def media_message(kind, file_id, caption=None, media_group_id=None):
+    message = SimpleNamespace(chat_id=1, text=None, caption=caption, media_group_id=media_group_id)
+    for media in bot.BROADCAST_MEDIA:
+        setattr(message, media, None)
+    if kind == "photo":
+        message.photo = (PhotoSize("small", "u1", 90, 90), PhotoSize(file_id, "u2", 1280, 1280))
+    else:
+        setattr(message, kind, SimpleNamespace(file_id=file_id))
+    return message
+
+def admin_context(app):
+    user_data = app.user_data[bot.YOUR_USER_ID]
+    user_data["admin_mode"] = "broadcast"
+    return SimpleNamespace(application=app, user_data=user_data, job_queue=app.job_queue)
+
+def admin_update(message):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=bot.YOUR_USER_ID), message=message)
+
+def with_users(app, user_ids):
+    fake = make_app(None, user_ids)
+    app.bot_data.update(fake.bot_data)
+    return app
+
+async def until_broadcast_ends(app):
+    while not app.bot_data.get("long_tasks"):
+        await asyncio.sleep(0.01)
+    while app.bot_data["long_tasks"]:
+        await asyncio.sleep(0.01)
+
+@pytest.mark.parametrize("kind, method", [
+    ("photo", "sendPhoto"), ("video", "sendVideo"), ("document", "sendDocument"),
+])
+def test_media_broadcast_sends_by_file_id(workdir, monkeypatch, offline_app, kind, method):
+    monkeypatch.setattr(bot, "BROADCAST_RATE", 10000)
+    user_ids = [100, 101, 102]
+    request = ApiRecorder()
+
+    async def main():
+        app = with_users(offline_app(lambda builder: builder.request(request)), user_ids)
+        await app.initialize()
+        await app.start()
+        try:
+            message = media_message(kind, f"{kind}-id", caption="подпись")
+            await bot.admin_message_handler(admin_update(message), admin_context(app))
+            await until_broadcast_ends(app)
+        finally:
+            await app.stop()
+            await app.shutdown()
+
+    asyncio.run(main())
+    # Вложение уходит по file_id: ни getFile, ни загрузки файла
+    assert sorted(params["chat_id"] for _, params in request.sent()) == user_ids
+    for name, params in request.sent():
+        assert name == method
+        assert params[kind] == f"{kind}-id"
+        assert params["caption"] == "подпись"
+    assert "getFile" not in [name for name, _ in request.calls]
+
+def test_album_goes_out_as_one_media_group_and_resumes(workdir, monkeypatch, offline_app):
+    monkeypatch.setattr(bot, "ALBUM_WAIT_SECONDS", 0.05)
+    monkeypatch.setattr(bot, "BROADCAST_CHUNK", 2)
+    monkeypatch.setattr(bot, "BROADCAST_CONCURRENCY", 1)
+    monkeypatch.setattr(bot, "BROADCAST_RATE", 10000)
+    user_ids = [100, 101, 102, 103, 104]
+    request = ApiRecorder(hang_after=3)
+    album = [
+        media_message("photo", "photo-1", caption="альбом", media_group_id="g"),
+        media_message("video", "video-2", media_group_id="g"),
+        media_message("document", "doc-3", media_group_id="g"),
+    ]
+
+    async def main():
+        app = with_users(offline_app(lambda builder: builder.request(request)), user_ids)
+        await app.initialize()
+        await app.start()
+        try:
+            context = admin_context(app)
+            for message in album:
+                await bot.admin_message_handler(admin_update(message), context)
+            # Части альбома копятся ALBUM_WAIT_SECONDS, рассылка — одна на весь альбом
+            assert not app.bot_data.get("long_tasks")
+            while len(request.sent()) < 3:
+                await asyncio.sleep(0.01)
+            await asyncio.wait_for(app.stop(), 2)
+        finally:
+            if app.running:
+                await app.stop()
+            await app.shutdown()
+
+    asyncio.run(main())
+    first = request.sent()
+    assert [name for name, _ in first] == ["sendMediaGroup"] * 3
+    media = [(item["type"], item["media"]) for item in first[0][1]["media"]]
+    assert media == [("photo", "photo-1"), ("video", "video-2"), ("document", "doc-3")]
+    assert first[0][1]["media"][0]["caption"] == "альбом"
+
+    # Альбом пережил остановку в файле состояния и продолжается с начала куска
+    state = bot.load_broadcast_state()
+    assert state["kind"] == "album"
+    assert [item["file_id"] for item in state["media"]] == ["photo-1", "video-2", "doc-3"]
+    assert state["offset"] == 2
+    resumed = ApiRecorder()
+
+    async def resume():
+        app = with_users(offline_app(lambda builder: builder.request(resumed)), user_ids)
+        await app.initialize()
+        try:
+            await bot.Broadcast(app, state).run()
+        finally:
+            await app.shutdown()
+
+    asyncio.run(resume())
+    assert [params["chat_id"] for _, params in resumed.sent()] == user_ids[2:]
+    for name, params in resumed.sent():
+        assert name == "sendMediaGroup"
+        assert [item["media"] for item in params["media"]] == ["photo-1", "video-2", "doc-3"]
+    assert not os.path.exists(bot.BROADCAST_STATE_FILE)
@@ -0,0 +1,132 @@
+import asyncio
+import gzip
+import json
+import random
+from types import SimpleNamespace
+
+import pytest
+from telegram.request import BaseRequest
+
+import bot
+
+HEADER = "user_id,known,active,birth_date\n"
+
+def make_rows(n, seed=1):
+    rnd = random.Random(seed)
+    rows = []
+    for _ in range(n):
+        birth = f"{rnd.randrange(1940, 2015)}-{rnd.randrange(1, 13):02d}-{rnd.randrange(1, 29):02d}T00:00:00"
+        has_birth = rnd.random() < 0.8
+        rows.append((rnd.randrange(1, 1 << 40), 1, int(has_birth), birth if has_birth else None))
+    return rows
+
+def parse(fmt, text):
+    if fmt == "jsonl":
+        return [json.loads(line) for line in text.splitlines()]
+    assert text.startswith(HEADER)
+    return text[len(HEADER):].splitlines()
+
+def expected(fmt, rows):
+    return parse(fmt, (HEADER if fmt == "csv" else "") + "".join(bot.export_line(fmt, r) for r in rows))
+
+def test_export_line_formats():
+    row = (42, 1, 0, "1990-05-17T00:00:00")
+    assert bot.export_line("csv", row) == "42,1,0,1990-05-17\n"
+    assert json.loads(bot.export_line("jsonl", row)) == {
+        "user_id": 42, "known": True, "active": False, "birth_date": "1990-05-17",
+    }
+    assert json.loads(bot.export_line("jsonl", (7, 1, 0, None)))["birth_date"] is None
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl"])
+def test_plain_parts_split_on_size(fmt):
+    rows = make_rows(3000)
+    part_bytes = 20_000
+    parts = list(bot.export_parts(rows, fmt, False, part_bytes))
+    assert len(parts) > 1
+    longest = max(len(bot.export_line(fmt, r)) for r in rows)
+    got = []
+    for part in parts:
+        # Часть закрывается на строке, которая перешла границу
+        assert len(part) < part_bytes + longest
+        got += parse(fmt, part.decode("utf-8"))
+    assert got == expected(fmt, rows)
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl"])
+def test_compressed_parts_fit_the_limit(fmt):
+    rows = make_rows(60_000)
+    part_bytes = 1024 * 1024
+    parts = list(bot.export_parts(rows, fmt, True, part_bytes))
+    assert len(parts) > 1
+    got = []
+    for part in parts:
+        assert len(part) <= part_bytes
+        # Каждая часть — отдельный gzip-файл
+        got += parse(fmt, gzip.decompress(part).decode("utf-8"))
+    assert got == expected(fmt, rows)
+
+def test_no_rows_no_parts():
+    assert list(bot.export_parts([], "csv", True)) == []
+
+@pytest.mark.parametrize("part_bytes", [64 * 1024, 256 * 1024])
+def test_small_compressed_parts_stay_whole(part_bytes):
+    rows = make_rows(60_000)
+    parts = list(bot.export_parts(rows, "csv", True, part_bytes))
+    # Запас на хвост сжатого потока не съедает часть целиком: не по строке на часть
+    assert 1 < len(parts) < 100
+    got = []
+    for part in parts[:-1]:
+        assert len(part) >= part_bytes // 2
+    for part in parts:
+        got += parse("csv", gzip.decompress(part).decode("utf-8"))
+    assert got == expected("csv", rows)
+
+class HangingRequest(BaseRequest):
+    # Bot API без сети: sendDocument не отвечает никогда, остальное — успешно
+    def __init__(self):
+        self.methods = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        self.methods.append(url.rsplit("/", 1)[-1])
+        if url.endswith("/sendDocument"):
+            await asyncio.Event().wait()
+        return 200, b'{"ok": true, "result": true}'
+
+class RowStorage:
+    def iter_users(self):
+        return iter(make_rows(100))
+
+def test_stop_cancels_a_running_export(offline_app):
+    request = HangingRequest()
+
+    async def main():
+        app = offline_app(lambda builder: builder.request(request))
+        app.bot_data["users"] = bot.UserStore()
+        app.bot_data["storage"] = RowStorage()
+
+        async def answer():
+            pass
+
+        query = SimpleNamespace(answer=answer, data="admin_export:csv:gz", message=SimpleNamespace(chat_id=1))
+        update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=bot.YOUR_USER_ID))
+        context = SimpleNamespace(application=app, user_data={})
+        await app.initialize()
+        await app.start()
+        try:
+            await bot.admin_button(update, context)
+            while "sendDocument" not in request.methods:
+                await asyncio.sleep(0.01)
+            # Application.stop сам по себе ждал бы зависшую выгрузку
+            await asyncio.wait_for(app.stop(), 2)
+        finally:
+            if app.running:
+                await app.stop()
+            await app.shutdown()
+        assert not app.bot_data["long_tasks"]
+        assert not app.bot_data["export_running"]
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from telegram.error import TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+
+import bot
+
+def counter(name, pool):
+    return bot.metrics.counters.get((name, (("pool", pool),)), 0)
+
+def test_api_and_updates_use_separate_pools(monkeypatch):
+    monkeypatch.setattr(bot, "HTTP_POOL_SIZE", 2)
+    api = bot.make_request("api")
+    updates = bot.make_request("updates")
+    assert (api.pool_size, updates.pool_size) == (2, 1)
+    assert api.pool_labels != updates.pool_labels
+
+def test_pool_saturation_timeouts_and_media_write_timeout(monkeypatch):
+    monkeypatch.setattr(bot, "HTTP_POOL_SIZE", 2)
+    monkeypatch.setattr(bot, "HTTP_MEDIA_WRITE_TIMEOUT", 77)
+    request = bot.make_request("api")
+    release = asyncio.Event()
+    write_timeouts = []
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        write_timeouts.append(write_timeout)
+        if url.endswith("/getMe"):
+            raise TimedOut() from httpx.PoolTimeout("pool is full")
+        await release.wait()
+        return 200, b'{"ok": true, "result": true}'
+
+    monkeypatch.setattr(HTTPXRequest, "do_request", do_request)
+    saturated = counter("bot_http_pool_saturated_total", "api")
+    timeouts = counter("bot_http_pool_timeouts_total", "api")
+    text = SimpleNamespace(multipart_data=None)
+    photo = SimpleNamespace(multipart_data={"photo": b"png"})
+
+    async def main():
+        calls = [
+            asyncio.ensure_future(request.do_request("https://api/sendMessage", "POST", text)),
+            asyncio.ensure_future(request.do_request("https://api/sendPhoto", "POST", photo)),
+        ]
+        await asyncio.sleep(0)
+        assert request.in_use == 2
+        # Оба соединения заняты: третий запрос ждёт свободного
+        calls.append(asyncio.ensure_future(request.do_request("https://api/sendMessage", "POST", text)))
+        await asyncio.sleep(0)
+        assert counter("bot_http_pool_saturated_total", "api") == saturated + 1
+        release.set()
+        await asyncio.gather(*calls)
+        with pytest.raises(TimedOut):
+            await request.do_request("https://api/getMe", "POST")
+        assert request.in_use == 0
+
+    asyncio.run(main())
+    assert counter("bot_http_pool_timeouts_total", "api") == timeouts + 1
+    # Загрузка файла получает своё время записи, текст — обычное
+    assert write_timeouts[:3] == [BaseRequest.DEFAULT_NONE, 77, BaseRequest.DEFAULT_NONE]
+
+def test_http2_needs_h2(monkeypatch):
+    monkeypatch.setattr(bot, "HTTP_VERSION", "2")
+    monkeypatch.setattr(bot.importlib.util, "find_spec", lambda name: None)
+    with pytest.raises(ValueError, match="http2"):
+        bot.make_request("api")
+    # getUpdates всегда по HTTP/1.1
+    bot.make_request("updates")
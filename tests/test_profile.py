@@ -0,0 +1,67 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+@pytest.mark.parametrize("args, expected", [
+    ([], (30.0, None, bot.PROFILE_TOP)),
+    (["10"], (10.0, None, bot.PROFILE_TOP)),
+    (["2.5s", "5"], (2.5, None, 5)),
+    (["500u"], (bot.PROFILE_MAX_SECONDS, 500, bot.PROFILE_TOP)),
+    (["500U", "10"], (bot.PROFILE_MAX_SECONDS, 500, 10)),
+])
+def test_parse_profile_args(args, expected):
+    assert bot.parse_profile_args(args) == expected
+
+@pytest.mark.parametrize("args", [["0"], ["-1"], [str(bot.PROFILE_MAX_SECONDS + 1)], ["0u"], ["10", "0"], ["abc"], ["u"]])
+def test_parse_profile_args_rejects(args):
+    with pytest.raises(ValueError):
+        bot.parse_profile_args(args)
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+def test_profiler_samples_busy_and_idle_threads():
+    stop = threading.Event()
+    busy = threading.Thread(target=busy_loop, args=(stop,), name="busy")
+    idle = threading.Thread(target=stop.wait, name="idle")
+    busy.start()
+    idle.start()
+    profiler = bot.Profiler(0.002)
+    profiler.start()
+    time.sleep(0.2)
+    profiler.stop()
+    stop.set()
+    busy.join()
+    idle.join()
+
+    assert profiler.ticks > 10
+    assert 0.15 < profiler.seconds < 1
+    # Ожидание на Event — простой, а не стек в отчёте
+    assert profiler.idle["idle"] > 0
+    assert all(thread != "idle" for thread, _ in profiler.stacks)
+    assert any(thread == "busy" and "busy_loop" in " ".join(stack) for thread, stack in profiler.stacks)
+
+    report = profiler.report(5)
+    assert "busy:" in report and "busy_loop" in report
+    lines = profiler.collapsed().decode("utf-8").splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any(line.startswith("busy;") and "busy_loop" in line for line in lines)
+
+def test_set_profile_handler_keeps_other_groups():
+    main = object()
+    app = SimpleNamespace(handlers={0: [main], 2: [object()]})
+    handlers = app.handlers
+    counter = object()
+    bot.set_profile_handler(app, counter)
+    assert list(app.handlers) == [0, bot.PROFILE_HANDLER_GROUP, 2]
+    assert app.handlers[bot.PROFILE_HANDLER_GROUP] == [counter]
+    # Старый словарь не меняется: по нему могут идти обновления
+    assert bot.PROFILE_HANDLER_GROUP not in handlers
+    bot.set_profile_handler(app, None)
+    assert list(app.handlers) == [0, 2]
+    assert app.handlers[0] == [main]
@@ -0,0 +1,111 @@
+import io
+from datetime import datetime
+
+import pytest
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+import bot
+
+def baseline_weeks_image(lived_weeks, birth_date):
+    # Исходная отрисовка: каждая клетка сетки — отдельный прямоугольник
+    CELL_SIZE = 12
+    GRID_WIDTH = 52
+    LIFESPAN_YEARS = 90
+    GRID_HEIGHT = LIFESPAN_YEARS
+    MARGIN = 20
+    TOP_PAD = 60
+    BOTTOM_PAD = 60
+
+    W = GRID_WIDTH * CELL_SIZE + 2 * MARGIN
+    H = GRID_HEIGHT * CELL_SIZE + TOP_PAD + BOTTOM_PAD
+
+    img = Image.new("RGB", (W, H), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+
+    font_large = font_small = None
+    try:
+        font_large = ImageFont.truetype("arial.ttf", 20)
+        font_small = ImageFont.truetype("arial.ttf", 12)
+    except OSError:
+        try:
+            font_large = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 20)
+            font_small = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 12)
+        except OSError:
+            pass
+
+    age_years = (datetime.today() - birth_date).days // 365
+    title = f"Ты прожил(а) {lived_weeks} недель ({age_years} лет)"
+    draw.text((MARGIN, 10), title, fill=(30, 30, 30), font=font_large)
+
+    draw.rectangle([MARGIN, 40, MARGIN + 15, 55], fill=(76, 175, 80))
+    draw.text((MARGIN + 20, 40), "Прожито", fill=(30, 30, 30), font=font_small)
+
+    draw.rectangle([MARGIN + 100, 40, MARGIN + 115, 55], fill=(220, 220, 220))
+    draw.text((MARGIN + 120, 40), "Осталось", fill=(30, 30, 30), font=font_small)
+
+    total = GRID_WIDTH * GRID_HEIGHT
+    lived = min(lived_weeks, total)
+    for i in range(total):
+        row = i // GRID_WIDTH
+        col = i % GRID_WIDTH
+        x0 = MARGIN + col * CELL_SIZE
+        y0 = TOP_PAD + row * CELL_SIZE
+        x1 = x0 + CELL_SIZE - 2
+        y1 = y0 + CELL_SIZE - 2
+        color = (76, 175, 80) if i < lived else (230, 230, 230)
+        draw.rectangle([x0, y0, x1, y1], fill=color, outline=(245, 245, 245))
+
+    for year in range(5, LIFESPAN_YEARS + 1, 5):
+        x_center = MARGIN + (GRID_WIDTH * CELL_SIZE) // 2
+        y_text = TOP_PAD + (year * CELL_SIZE) + 2
+        draw.text((x_center - 8, y_text), str(year), fill=(100, 100, 100), font=font_small)
+        y_line = TOP_PAD + (year * CELL_SIZE)
+        draw.line([MARGIN, y_line, MARGIN + GRID_WIDTH * CELL_SIZE, y_line], fill=(200, 200, 200), width=1)
+
+    draw.text(
+        (MARGIN, H - 30),
+        "1 клетка = 1 неделя жизни • Всего ~4680 недель (90 лет)",
+        fill=(100, 100, 100),
+        font=font_small
+    )
+    return img
+
+@pytest.mark.parametrize("lived_weeks", [0, 1, 51, 52, 53, 1000, 1871, 4679, 4680, 5000])
+def test_weeks_image_matches_baseline(lived_weeks):
+    birth_date = datetime(1990, 5, 17)
+    expected = baseline_weeks_image(lived_weeks, birth_date)
+    age_years = (datetime.today() - birth_date).days // 365
+    img = bot.create_weeks_image(lived_weeks, age_years).convert("RGB")
+    assert img.size == expected.size
+    diff = ImageChops.difference(img, expected)
+    # Ниже заголовка картинка совпадает точно. Числа заголовка в палитре сглажены
+    # TITLE_LEVELS градациями, так что отличаются не больше чем на полшага
+    assert diff.crop((0, bot.TITLE_HEIGHT, *img.size)).getbbox() is None
+    step = 255 / (bot.TITLE_LEVELS - 1)
+    assert max(high for _, high in diff.getextrema()) <= step / 2
+
+@pytest.mark.parametrize("fmt, pil_format", [
+    ("png8", "PNG"), ("png", "PNG"), ("webp", "WEBP"), ("webp_lossy", "WEBP"), ("jpeg", "JPEG"),
+])
+def test_encode_image_formats(fmt, pil_format):
+    img = bot.create_weeks_image(1000, 19)
+    decoded = Image.open(io.BytesIO(bot.encode_image(img, fmt)))
+    assert decoded.format == pil_format
+    assert decoded.size == img.size
+
+def test_lossy_webp_uses_the_quality():
+    img = bot.create_weeks_image(1000, 19)
+    low = bot.encode_image(img, "webp_lossy", 20)
+    high = bot.encode_image(img, "webp_lossy", 95)
+    assert len(low) < len(high)
+    # Без потерь качество — только усилие сжатия: картинка та же
+    lossless = Image.open(io.BytesIO(bot.encode_image(img, "webp", 20))).convert("RGB")
+    assert ImageChops.difference(lossless, img.convert("RGB")).getbbox() is None
+
+def test_image_format_is_checked(monkeypatch, caplog):
+    monkeypatch.setattr(bot, "IMAGE_FORMAT", "gif")
+    with pytest.raises(ValueError):
+        bot.check_image_format()
+    monkeypatch.setattr(bot, "IMAGE_FORMAT", "jpeg")
+    bot.check_image_format()
+    assert "IMAGE_FORMAT=jpeg" in caplog.text
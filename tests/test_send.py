@@ -0,0 +1,227 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest, Forbidden, NetworkError, TimedOut
+
+import bot
+
+@pytest.mark.parametrize("error, kind", [
+    (Forbidden("Forbidden: bot was blocked by the user"), "dead"),
+    (Forbidden("Forbidden: user is deactivated"), "dead"),
+    (BadRequest("Chat not found"), "dead"),
+    (TimedOut(), "retry"),
+    (NetworkError("Connection reset by peer"), "retry"),
+    (BadRequest("Message is too long"), "failed"),
+    (ValueError("boom"), "failed"),
+])
+def test_classify_send_error(error, kind):
+    assert bot.classify_send_error(error) == kind
+
+class FakeStorage:
+    def __init__(self):
+        self.saved = []
+
+    def save_users(self, user_ids, users):
+        self.saved.append(list(user_ids))
+
+def test_reaper_removes_dead_users_in_one_write():
+    users = bot.UserStore()
+    for uid in (1, 2, 3):
+        users.set_known(uid)
+        users.set_birth_date(uid, datetime(1990, 5, uid))
+        users.set_active(uid)
+    age_index = bot.AgeIndex()
+    age_index.rebuild(users)
+    data = {"users": users, "age_index": age_index, "storage": FakeStorage()}
+    reaper = bot.Reaper(data)
+
+    reaper.add(1)
+    reaper.add(2)
+    reaper.add(2)
+    # Написал боту до очистки — остаётся
+    reaper.spare(2)
+    assert reaper.flush() == 1
+    assert reaper.flush() == 0
+    assert data["storage"].saved == [[1]]
+    assert users.record(1) == (False, False, None)
+    assert users.record(2)[1]
+    assert reaper.reaped == 1
+
+def test_menu_button_spares_a_reaped_user():
+    async def main():
+        users = bot.UserStore()
+        users.set_known(5)
+        data = {"users": users, "age_index": bot.AgeIndex(), "storage": FakeStorage()}
+        reaper = bot.Reaper(data)
+        data["reaper"] = reaper
+        reaper.add(5)
+        replies = []
+
+        async def reply_text(text, **kwargs):
+            replies.append(text)
+
+        update = SimpleNamespace(
+            effective_user=SimpleNamespace(id=5),
+            message=SimpleNamespace(text="📅 Ввести дату рождения", reply_text=reply_text),
+        )
+        context = SimpleNamespace(application=SimpleNamespace(bot_data=data))
+        await bot.handle_message(update, context)
+        assert replies and "ДД.ММ.ГГГГ" in replies[0]
+        assert reaper.flush() == 0
+        assert users.is_known(5)
+    asyncio.run(main())
+
+def test_stats_survive_a_reap_while_the_report_is_sent(monkeypatch):
+    async def main():
+        users = bot.UserStore()
+        users.set_known(5)
+        users.set_birth_date(5, datetime(1990, 5, 17))
+        users.set_active(5)
+        age_index = bot.AgeIndex()
+        age_index.rebuild(users)
+        data = {"users": users, "age_index": age_index, "storage": FakeStorage()}
+        reaper = bot.Reaper(data)
+        photos = []
+
+        async def reply_text(text, **kwargs):
+            # Пока уходит отчёт, пришёл 403 волны и Reaper удалил пользователя
+            reaper.add(5)
+            reaper.flush()
+
+        async def send_weeks_photo(reply_photo, days):
+            photos.append(days)
+
+        monkeypatch.setattr(bot, "send_weeks_photo", send_weeks_photo)
+        update = SimpleNamespace(
+            effective_user=SimpleNamespace(id=5),
+            message=SimpleNamespace(reply_text=reply_text, reply_photo=None),
+        )
+        context = SimpleNamespace(application=SimpleNamespace(bot_data=data))
+        await bot.show_my_stats(update, context)
+        assert not users.is_known(5)
+        assert photos == [(datetime.today() - datetime(1990, 5, 17)).days]
+    asyncio.run(main())
+
+def test_send_plan_is_stable_and_within_the_rate():
+    user_ids = list(range(1000, 6000))
+    plan = bot.SendPlan("weekly", user_ids, 2, 3600, 2)
+    again = bot.SendPlan("weekly", list(reversed(user_ids)), 2, 3600, 2)
+    # Время пользователя зависит только от его id
+    assert [user_ids[i] for i in plan.order] == [user_ids[::-1][i] for i in again.order]
+    assert plan.offsets == again.offsets
+    assert sorted(plan.order) == list(range(len(user_ids)))
+    assert all(b - a >= 1 - 1e-9 for a, b in zip(plan.offsets, plan.offsets[1:]))
+    assert 0 <= plan.offsets[0] < 3600
+    # 5000 пользователей по 2 сообщения при 2/с не влезают в час — волна растягивается
+    assert plan.offsets[-1] >= len(user_ids) - 1 - 1e-6
+    assert plan.offsets[-1] > 3600
+
+def test_send_plan_spreads_over_the_window():
+    user_ids = list(range(1, 201))
+    plan = bot.SendPlan("birthday", user_ids, 1, 3600, 1000)
+    assert plan.offsets[-1] < 3600
+    # Хеш раскидывает пользователей по всему окну, а не в его начало
+    assert plan.offsets[len(plan) // 2] > 900
+    assert plan.offsets[-1] > 2700
+
+def test_send_plan_runs_in_plan_order():
+    async def main():
+        user_ids = list(range(1, 51))
+        plan = bot.SendPlan("test", user_ids, 1, 0.05, 10000)
+        sent = []
+        prepared = []
+
+        async def send(i):
+            sent.append(i)
+
+        async def prepare(i):
+            prepared.append(i)
+
+        await plan.run(send, prepare, concurrency=1)
+        assert sent == plan.order
+        assert plan.done == len(user_ids)
+        assert plan.planned() == len(user_ids)
+        assert set(prepared) <= set(plan.order)
+    asyncio.run(main())
+
+def test_stopped_wave_resumes_where_it_left_off(workdir, offline_app, monkeypatch):
+    monkeypatch.setattr(bot, "SEND_WINDOW_MINUTES", 0.001)
+    monkeypatch.setattr(bot, "SEND_RATE", 100000)
+
+    async def main():
+        app = offline_app()
+        storage = bot.SqliteStorage(str(workdir / "users.db"))
+        app.bot_data["storage"] = storage
+        user_ids = list(range(1, 101))
+        order = bot.SendPlan("weekly", user_ids, 2, 1, 1).order
+        sent = []
+        hang = asyncio.Event()
+
+        async def send(i):
+            if len(sent) >= 20:
+                await hang.wait()
+            sent.append(i)
+
+        await app.initialize()
+        await app.start()
+        try:
+            wave = asyncio.ensure_future(bot.run_wave(app, "weekly", 3, user_ids, 2, send))
+            while not app.bot_data.get("long_tasks") or len(sent) < 20:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+            # Остановка не ждёт конца окна
+            await asyncio.wait_for(app.stop(), 5)
+            assert await wave is False
+        finally:
+            hang.set()
+            if app.running:
+                await app.stop()
+        assert sent == order[:20]
+        state = bot.unfinished_wave(app, "weekly")
+        assert state["data"] == 3
+        assert storage.get_meta("job:weekly")
+
+        # После перезапуска волна продолжается с того же места
+        await app.start()
+        try:
+            bot.resume_waves(app)
+            assert [job.name for job in app.job_queue.jobs()] == ["weekly_bucket_3"]
+            for job in app.job_queue.jobs():
+                job.schedule_removal()
+            resumed = []
+
+            async def send_rest(i):
+                resumed.append(i)
+
+            assert await bot.run_wave(app, "weekly", 3, user_ids, 2, send_rest) is True
+        finally:
+            await app.stop()
+            await app.shutdown()
+        assert resumed == order[20:]
+        assert bot.unfinished_wave(app, "weekly") is None
+        storage.close()
+    asyncio.run(main())
+
+def test_failed_sends_do_not_stop_the_wave():
+    async def main():
+        user_ids = list(range(1, 51))
+        plan = bot.SendPlan("test", user_ids, 1, 0.05, 10000)
+        # Первая падает, пока план ещё раздаёт слоты, последняя — уже после
+        broken = {plan.order[0], plan.order[-1]}
+        sent = []
+        points = []
+
+        async def send(i):
+            await asyncio.sleep(0)
+            if i in broken:
+                raise RuntimeError("boom")
+            sent.append(i)
+
+        await plan.run(send, checkpoint=points.append)
+        assert sorted(sent) == sorted(set(plan.order) - broken)
+        assert plan.done == len(user_ids)
+        assert plan.failed == 2
+        assert points[-1] is None
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import queue
+import threading
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+import bot
+
+def update_from(update_id, user_id):
+    user = User(user_id, "user", False)
+    message = Message(update_id, datetime(2024, 1, 1), Chat(user_id, "private"), from_user=user, text=str(update_id))
+    return Update(update_id, message=message)
+
+def test_shard_of_routes_by_user_id():
+    assert [bot.shard_of(update_from(1, uid), 3) for uid in (3, 4, 5, 6)] == [0, 1, 2, 0]
+    # Обновления без пользователя — первому шарду
+    assert bot.shard_of(Update(1), 3) == 0
+
+def test_route_updates_keeps_each_users_order():
+    # Очереди по одному месту: часть обновлений идёт через ожидание свободного
+    inboxes = [queue.Queue(1) for _ in range(3)]
+    received = [[] for _ in inboxes]
+    user_ids = [10, 11, 12, 13, 14]
+    updates = [update_from(n, user_ids[n % len(user_ids)]) for n in range(60)]
+
+    def drain(index):
+        while True:
+            message = inboxes[index].get()
+            if message is None:
+                return
+            received[index].append(message)
+
+    threads = [threading.Thread(target=drain, args=(i,)) for i in range(len(inboxes))]
+    for thread in threads:
+        thread.start()
+
+    async def main():
+        update_queue = asyncio.Queue()
+        for update in updates:
+            update_queue.put_nowait(update)
+        router = asyncio.ensure_future(bot.route_updates(update_queue, inboxes))
+        while not update_queue.empty() or sum(map(len, received)) < len(updates):
+            await asyncio.sleep(0.01)
+        router.cancel()
+
+    try:
+        asyncio.run(main())
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+        for thread in threads:
+            thread.join()
+    for index, messages in enumerate(received):
+        for kind, data in messages:
+            assert kind == "update"
+            assert data["message"]["from"]["id"] % len(inboxes) == index
+    for uid in user_ids:
+        got = [data["update_id"] for _, data in received[uid % len(inboxes)] if data["message"]["from"]["id"] == uid]
+        assert got == [u.update_id for u in updates if u.effective_user.id == uid]
+
+def test_leadership_passes_when_the_lock_is_released(workdir, monkeypatch):
+    monkeypatch.setattr(bot, "SCHEDULER_LOCK_FILE", str(workdir / "scheduler.lock"))
+    first = bot.Shards(0, [None, None])
+    second = bot.Shards(1, [None, None])
+    assert first.try_lead()
+    # flock у каждого своего открытия файла: второй шард в том же процессе ждёт
+    assert not second.try_lead()
+    assert not first.try_lead()
+    # Лидер умер — ОС закрыла его fd и сняла блокировку
+    os.close(first.lock_fd)
+    assert second.try_lead()
+    os.close(second.lock_fd)
+
+def test_shards_share_age_histograms(workdir):
+    storage = bot.SqliteStorage(bot.DB_FILE)
+    assert storage.shard_ages(3, 1) is None
+    storage.publish_ages(0, [1, 2, 3])
+    storage.publish_ages(1, [100, 100, 100])
+    storage.publish_ages(2, [10, 20, 30])
+    # Свою гистограмму шард считает сам, из meta — только чужие
+    assert storage.shard_ages(3, 1) == [11, 22, 33]
+    storage.publish_ages(2, [0, 0, 1])
+    assert storage.shard_ages(3, 1) == [1, 2, 4]
+    storage.close()
@@ -0,0 +1,143 @@
+import json
+import os
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+def records(users):
+    return {uid: users.record(uid) for uid in users.user_ids()}
+
+def snapshot(storage, users, shard=None):
+    # Как save_snapshot, только без потока
+    seq = storage.change_seq()
+    storage.write_snapshot(users.snapshot_parts(seq), shard)
+    storage.commit_snapshot(seq, shard)
+
+def test_snapshot_round_trip(random_users):
+    users, _ = random_users(3000)
+    users.remove(users.user_ids()[0])
+    restored, seq = bot.UserStore.from_snapshot(b"".join(users.snapshot_parts(17)))
+    assert seq == 17
+    assert records(restored) == records(users)
+    assert (restored.known_count, restored.active_count) == (users.known_count, users.active_count)
+    # Восстановленный store продолжает расти
+    restored.set_known(7)
+    assert restored.is_known(7)
+
+def test_snapshot_rejects_damaged_data(random_users):
+    data = b"".join(random_users(10)[0].snapshot_parts(1))
+    for bad in (data[:-1], b"XXXX" + data[4:], data[:10]):
+        with pytest.raises(ValueError):
+            bot.UserStore.from_snapshot(bad)
+
+def test_storage_snapshot_plus_changes(workdir, random_users):
+    storage = bot.SqliteStorage(bot.DB_FILE)
+    users, _ = random_users(2000)
+    storage.save_users(users.user_ids(), users)
+    snapshot(storage, users)
+    assert storage.conn.execute("SELECT COUNT(*) FROM changes").fetchone()[0] == 0
+
+    # Изменения после снимка: новая дата, удаление, новый пользователь
+    first, second = users.user_ids()[:2]
+    users.set_birth_date(first, datetime(2001, 5, 5))
+    users.remove(second)
+    users.set_known(5)
+    storage.save_users([first, second, 5], users)
+
+    loaded = storage.load()
+    assert records(loaded) == records(users)
+    # Без снимка — то же самое из базы целиком
+    storage.close()
+    os.remove(storage.snapshot_path())
+    assert records(bot.SqliteStorage(bot.DB_FILE).load()) == records(users)
+
+def test_storage_shards_and_layout_change(workdir, random_users):
+    storage = bot.SqliteStorage(bot.DB_FILE)
+    users, _ = random_users(1000)
+    storage.save_users(users.user_ids(), users)
+    shards = [(i, 2) for i in range(2)]
+    for shard in shards:
+        snapshot(storage, storage.load(shard), shard)
+
+    # Шард видит только своих пользователей
+    part = storage.load(shards[1])
+    assert records(part) == {uid: r for uid, r in records(users).items() if uid % 2 == 1}
+
+    # Бот поработал без шардов: снимок 1 шарда чистит журнал, снимки шардов устаревают
+    uid = next(u for u in users.user_ids() if u % 2 == 0)
+    users.set_birth_date(uid, datetime(2002, 2, 2))
+    storage.save_users([uid], users)
+    snapshot(storage, storage.load())
+    assert records(storage.load(shards[0])) == {u: r for u, r in records(users).items() if u % 2 == 0}
+    assert storage.get_meta("snapshot:2:0") is None
+    storage.close()
+
+def write_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+def test_json_is_imported_once(workdir):
+    write_json(bot.USERS_FILE, [1, 2, 3])
+    write_json(bot.ACTIVE_FILE, [2])
+    write_json(bot.BIRTHDAYS_FILE, {"2": "1990-05-17T00:00:00", "3": "2001-01-31T00:00:00"})
+    storage = bot.SqliteStorage(bot.DB_FILE)
+    assert storage.get_meta("json_imported")
+    assert records(storage.load()) == {
+        1: (True, False, None),
+        2: (True, True, datetime(1990, 5, 17)),
+        3: (True, False, datetime(2001, 1, 31)),
+    }
+    storage.close()
+
+    # Старые файлы остаются на месте, но второй раз не читаются
+    write_json(bot.USERS_FILE, [1, 2, 3, 4])
+    storage = bot.SqliteStorage(bot.DB_FILE)
+    assert sorted(storage.load().user_ids()) == [1, 2, 3]
+    storage.close()
+
+def test_persist_users_writes_only_the_given_ids(workdir, random_users):
+    storage = bot.SqliteStorage(bot.DB_FILE)
+    users, _ = random_users(100)
+    storage.save_users(users.user_ids(), users)
+    before = records(storage.load())
+    seq = storage.change_seq()
+    changed, removed = users.user_ids()[:2]
+    stranger = max(users.user_ids()) + 1
+    users.set_birth_date(changed, datetime(2003, 3, 3))
+    users.remove(removed)
+    users.set_known(stranger)
+    users.set_known(5)
+
+    context = SimpleNamespace(application=SimpleNamespace(bot_data={"storage": storage, "users": users}))
+    bot.persist_users(context, [changed, removed, 5])
+    after = records(storage.load())
+    assert after[changed] == users.record(changed)
+    assert removed not in after
+    assert after[5] == (True, False, None)
+    # Чужие изменения в памяти в базу не попали
+    assert stranger not in after
+    assert {uid: r for uid, r in after.items() if uid not in (changed, 5)} == {
+        uid: r for uid, r in before.items() if uid not in (changed, removed)
+    }
+    journal = storage.conn.execute("SELECT user_id FROM changes WHERE seq > ?", (seq,)).fetchall()
+    assert sorted(uid for uid, in journal) == sorted([changed, removed, 5])
+    storage.close()
+
+def test_json_storage_writes_atomically(workdir, random_users):
+    users, _ = random_users(50)
+    storage = bot.JsonStorage()
+    storage.save_users([], users)
+    assert records(storage.load()) == records(users)
+    assert not [name for name in os.listdir(workdir) if name.endswith(".tmp")]
+
+    # Запись упала посреди файла: прежний файл цел
+    with open(bot.USERS_FILE, "rb") as f:
+        saved = f.read()
+    with pytest.raises(TypeError):
+        bot._dump_json(bot.USERS_FILE, [1, 2, object()])
+    with open(bot.USERS_FILE, "rb") as f:
+        assert f.read() == saved
+    assert records(storage.load()) == records(users)
@@ -0,0 +1,115 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import bot
+
+def make_update(update_id, user_id):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": "x",
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+        },
+    }, None)
+
+def test_updates_of_one_user_run_in_order():
+    async def main():
+        processor = bot.PerUserUpdateProcessor(limit=4, pending=100)
+        seen = {}
+        peak = 0
+
+        async def handle(update):
+            nonlocal peak
+            peak = max(peak, processor.running)
+            # Первые обновления засыпают дольше: без очереди пользователя они бы отстали
+            await asyncio.sleep(0.01 if update.update_id % 5 == 0 else 0)
+            seen.setdefault(update.effective_user.id, []).append(update.update_id)
+
+        updates = [make_update(i, 100 + i % 3) for i in range(30)]
+        await asyncio.gather(*(processor.do_process_update(u, handle(u)) for u in updates))
+        assert peak <= 4
+        for user_id, ids in seen.items():
+            assert ids == sorted(ids)
+        assert sum(len(ids) for ids in seen.values()) == 30
+        assert processor.waiting() == 0
+        assert processor._users == {}
+    asyncio.run(main())
+
+def test_different_users_run_concurrently():
+    async def main():
+        processor = bot.PerUserUpdateProcessor(limit=8, pending=8)
+        release = asyncio.Event()
+        peak = 0
+
+        async def handle():
+            nonlocal peak
+            peak = max(peak, processor.running)
+            await release.wait()
+
+        tasks = [
+            asyncio.ensure_future(processor.do_process_update(make_update(i, user_id), handle()))
+            for i, user_id in enumerate((1, 2, 3, 1, 1))
+        ]
+        await asyncio.sleep(0.01)
+        # Три пользователя работают, два обновления первого ждут своей очереди
+        assert processor.running == 3
+        assert processor.waiting() == 2
+        release.set()
+        await asyncio.gather(*tasks)
+        assert peak == 3
+    asyncio.run(main())
+
+def test_updates_without_user_are_not_serialized():
+    async def main():
+        processor = bot.PerUserUpdateProcessor(limit=4, pending=4)
+        release = asyncio.Event()
+
+        async def handle():
+            await release.wait()
+
+        tasks = [asyncio.ensure_future(processor.do_process_update(object(), handle())) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert processor.running == 3
+        release.set()
+        await asyncio.gather(*tasks)
+    asyncio.run(main())
+
+def test_intake_stops_at_limit_plus_pending(offline_app):
+    async def main():
+        processor = bot.PerUserUpdateProcessor(limit=2, pending=3)
+        app = offline_app(
+            lambda builder: builder.concurrent_updates(processor).update_queue(bot.IntakeQueue(processor, 100))
+        )
+        release = asyncio.Event()
+        handled = []
+
+        async def handle(update, context):
+            await release.wait()
+            handled.append(update.update_id)
+
+        app.add_handler(TypeHandler(Update, handle))
+        await app.initialize()
+        await app.start()
+        try:
+            for i in range(50):
+                await app.update_queue.put(make_update(i, 100 + i))
+            await asyncio.sleep(0.05)
+            # Принято limit + pending, выполняются limit, остальные ждут в очереди
+            assert processor.accepted == 5
+            assert processor.running == 2
+            assert app.update_queue.qsize() == 45
+            tasks = [t for t in asyncio.all_tasks() if "process_concurrent_update" in t.get_name()]
+            assert len(tasks) == 5
+
+            release.set()
+            await asyncio.sleep(0.05)
+            assert sorted(handled) == list(range(50))
+            assert processor.accepted == 0
+        finally:
+            release.set()
+            await app.stop()
+            await app.shutdown()
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+from datetime import date, datetime
+
+import bot
+
+def test_store_grows_and_finds_every_user(random_users):
+    users, expected = random_users(5000)
+    # Таблица поиска растёт при заполнении наполовину
+    assert len(users._slots) >= 2 * len(users.ids)
+    for uid, record in expected.items():
+        assert users.record(uid) == record
+    assert users.record(424242424242) == (False, False, None)
+    assert users.known_count == len(expected)
+    assert users.active_count == sum(1 for r in expected.values() if r[1])
+
+def test_store_remove_and_put_again(random_users):
+    users, expected = random_users(1000)
+    removed = list(expected)[::3]
+    for uid in removed:
+        users.remove(uid)
+    for uid in removed:
+        assert users.record(uid) == (False, False, None)
+        assert not users.is_known(uid)
+    assert users.known_count == len(expected) - len(removed)
+    assert set(users.known_ids()) == set(expected) - set(removed)
+
+    # Строка остаётся, пользователь возвращается в неё же
+    rows = len(users.ids)
+    users.put(removed[0], True, True, date(2000, 2, 29).toordinal(), 2 * 32 + 29)
+    assert len(users.ids) == rows
+    assert users.record(removed[0]) == (True, True, datetime(2000, 2, 29))
+
+def test_store_colliding_ids():
+    # id, отличающиеся на степень двойки, попадают в соседние ячейки
+    users = bot.UserStore()
+    ids = [i << 32 for i in range(1, 200)]
+    for uid in ids:
+        users.set_known(uid)
+    assert all(users.is_known(uid) for uid in ids)
+    assert not users.is_known(12345)
+
+def test_age_counts_match_age_on_around_feb_29():
+    users = bot.UserStore()
+    births = [datetime(2000, 2, 28), datetime(2000, 2, 29), datetime(2000, 3, 1),
+              datetime(2001, 2, 28), datetime(2001, 3, 1), datetime(1999, 12, 31)]
+    for uid, bd in enumerate(births, 1):
+        users.set_birth_date(uid, bd)
+        users.set_active(uid)
+    for day in (date(2023, 2, 28), date(2023, 3, 1), date(2024, 2, 28), date(2024, 2, 29), date(2024, 3, 1)):
+        expected = [0] * (bot.AgeIndex.MAX_AGE + 1)
+        for bd in births:
+            expected[bot.age_on(bd, day)] += 1
+        assert users.age_counts(day, bot.AgeIndex.MAX_AGE) == expected, day
+
+def test_birthday_of_feb_29_is_due_on_feb_28_in_common_years():
+    users = bot.UserStore()
+    users.set_birth_date(1, datetime(2000, 2, 29))
+    users.set_active(1)
+    assert users.due_on(date(2023, 2, 28)) == [1]
+    assert users.due_on(date(2024, 2, 28)) == []
+    assert users.due_on(date(2024, 2, 29)) == [1]
+
+def test_age_index_rollover_matches_rebuild(today, random_users):
+    users, _ = random_users(3000, seed=2)
+    for uid, bd in ((1, datetime(2000, 2, 29)), (2, datetime(2001, 2, 28)), (3, datetime(2001, 3, 1))):
+        users.set_birth_date(uid, bd)
+        users.set_active(uid)
+
+    index = bot.AgeIndex()
+    today(date(2023, 2, 26))
+    index.ensure_current(users)
+    # День за днём через 28 февраля и 1 марта невисокосного года
+    for day in (date(2023, 2, 27), date(2023, 2, 28), date(2023, 3, 1), date(2023, 3, 2)):
+        today(day)
+        index.ensure_current(users)
+        fresh = bot.AgeIndex()
+        fresh.rebuild(users)
+        assert index.as_of == day
+        assert index.counts == fresh.counts, day
+        assert index.total == fresh.total
+
+class FakeStorage:
+    def save_users(self, user_ids, users):
+        pass
+
+def test_users_change_before_the_age_index_is_built(random_users):
+    # Обновления приходят до warm_up: индекс ещё не построен
+    users, expected = random_users(500, seed=3)
+    data = {"users": users, "age_index": bot.AgeIndex(), "storage": FakeStorage()}
+    bot.set_user_birth_date(data, 1, datetime(1990, 5, 17))
+    someone = next(uid for uid, record in expected.items() if record[1])
+    assert bot.unsubscribe_user(data, someone)
+    assert users.record(1) == (True, True, datetime(1990, 5, 17))
+    assert not users.is_known(someone)
+
+    data["age_index"].ensure_current(users)
+    fresh = bot.AgeIndex()
+    fresh.rebuild(users)
+    assert data["age_index"].counts == fresh.counts
+    assert data["age_index"].total == fresh.total == users.active_count
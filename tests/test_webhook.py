@@ -0,0 +1,122 @@
+import asyncio
+import json
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import bot
+
+SECRET = "s3cret"
+
+def update_body(update_id, user_id):
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": "x",
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+        },
+    }).encode()
+
+async def request(port, method, path, body=b"", headers=None):
+    # Один запрос на соединение -> (статус, тело)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    head = [f"{method} {path} HTTP/1.1", "Host: test", f"Content-Length: {len(body)}", "Connection: close"]
+    head.extend(f"{k}: {v}" for k, v in (headers or {}).items())
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+    response = await reader.read()
+    writer.close()
+    status_line, _, rest = response.partition(b"\r\n")
+    return int(status_line.split()[1]), rest.partition(b"\r\n\r\n")[2].decode("utf-8")
+
+async def post_update(port, update_id, user_id, secret=SECRET):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret is not None else {}
+    status, _ = await request(port, "POST", "/telegram", update_body(update_id, user_id), headers)
+    return status
+
+async def start_server(app):
+    server = bot.WebhookServer(app, "127.0.0.1", 0, "/telegram", SECRET)
+    await server.start()
+    return server, server.server.sockets[0].getsockname()[1]
+
+def test_webhook_checks_the_secret_token(offline_app):
+    async def main():
+        app = offline_app(lambda builder: builder.update_queue(asyncio.Queue(maxsize=10)))
+        server, port = await start_server(app)
+        try:
+            assert await post_update(port, 1, 100, secret=None) == 403
+            assert await post_update(port, 2, 100, secret="wrong") == 403
+            assert await post_update(port, 3, 100, secret=SECRET + "x") == 403
+            assert app.update_queue.qsize() == 0
+            assert await post_update(port, 4, 100) == 200
+            assert (await app.update_queue.get()).update_id == 4
+            assert (await request(port, "GET", "/telegram"))[0] == 405
+            assert (await request(port, "POST", "/other"))[0] == 404
+            status, _ = await request(port, "POST", "/telegram", b"{not json", {
+                "X-Telegram-Bot-Api-Secret-Token": SECRET,
+            })
+            assert status == 400
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+def test_webhook_answers_503_while_handlers_are_busy(offline_app):
+    async def main():
+        processor = bot.PerUserUpdateProcessor(limit=2, pending=1)
+        app = offline_app(
+            lambda builder: builder.concurrent_updates(processor).update_queue(bot.IntakeQueue(processor, 4))
+        )
+        release = asyncio.Event()
+        handled = []
+
+        async def handle(update, context):
+            await release.wait()
+            handled.append(update.update_id)
+
+        app.add_handler(TypeHandler(Update, handle))
+        await app.initialize()
+        await app.start()
+        server, port = await start_server(app)
+        try:
+            statuses = []
+            for i in range(20):
+                statuses.append(await post_update(port, i, 100 + i))
+                await asyncio.sleep(0.005)
+            # 3 обновления приняты в работу, 4 ждут в очереди, остальные Telegram повторит
+            assert statuses == [200] * 7 + [503] * 13
+            assert (server.accepted, server.rejected) == (7, 13)
+
+            release.set()
+            await asyncio.sleep(0.05)
+            assert sorted(handled) == list(range(7))
+            assert await post_update(port, 20, 120) == 200
+        finally:
+            release.set()
+            await server.stop()
+            await app.stop()
+            await app.shutdown()
+    asyncio.run(main())
+
+def test_health_on_both_listeners(offline_app):
+    async def main():
+        app = offline_app(lambda builder: builder.update_queue(asyncio.Queue(maxsize=10)))
+        server, port = await start_server(app)
+        metrics_server = bot.WebhookServer(app, "127.0.0.1", 0, None, "")
+        await metrics_server.start()
+        metrics_port = metrics_server.server.sockets[0].getsockname()[1]
+        try:
+            # Публичный порт: только «жив», без секрета и без метрик
+            status, body = await request(port, "GET", "/health")
+            assert (status, json.loads(body)) == (200, {"status": "ok"})
+            assert (await request(port, "GET", "/metrics"))[0] == 404
+
+            status, body = await request(metrics_port, "GET", "/health")
+            assert status == 200
+            assert json.loads(body)["queue_max"] == 10
+            status, body = await request(metrics_port, "GET", "/metrics")
+            assert status == 200 and "# TYPE" in body
+            assert (await request(metrics_port, "POST", "/telegram"))[0] == 404
+        finally:
+            await server.stop()
+            await metrics_server.stop()
+    asyncio.run(main())